@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List
+
+# queued -> parsing -> encoding -> upserting -> done | failed
+JOB_STATES = ("queued", "parsing", "encoding", "upserting", "done", "failed")
+
+
+class IngestJob:
+    def __init__(self, collection: str, source: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.collection = collection
+        self.source = source
+        self.status = "queued"
+        self.total_chunks = 0
+        self.new_chunks = 0
+        self.encoded_chunks = 0
+        self.upserted_chunks = 0
+        self.removed_chunks = 0
+        self.result: dict | None = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.done = threading.Event()
+
+    def update(self, status: str | None = None, **counts: int) -> None:
+        if status is not None:
+            self.status = status
+        for name, value in counts.items():
+            setattr(self, name, value)
+        self.updated_at = time.time()
+
+    def finish(self, result: dict) -> None:
+        self.result = result
+        self.update("done")
+        self.done.set()
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        self.update("failed")
+        self.done.set()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "collection": self.collection,
+            "source": self.source,
+            "total_chunks": self.total_chunks,
+            "new_chunks": self.new_chunks,
+            "encoded_chunks": self.encoded_chunks,
+            "upserted_chunks": self.upserted_chunks,
+            "removed_chunks": self.removed_chunks,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobRegistry:
+    """In-memory job table; keeps the most recent ``max_jobs`` jobs."""
+
+    def __init__(self, max_jobs: int = 200) -> None:
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, collection: str, source: str) -> IngestJob:
+        job = IngestJob(collection, source)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if not oldest.done.is_set():
+                    break
+                del self._jobs[oldest_id]
+        return job
+
+    def get(self, job_id: str) -> IngestJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            jobs: List[IngestJob] = list(self._jobs.values())
+        return [j.to_dict() for j in reversed(jobs)]
+
+    def active(self) -> Dict[str, int]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts: Dict[str, int] = {}
+        for job in jobs:
+            if not job.done.is_set():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
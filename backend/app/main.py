@@ -1,30 +1,152 @@
+import asyncio
 import hashlib
+import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 from typing import Dict, List, Tuple
 
-import chromadb
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, ConfigDict
 from pypdf import PdfReader
-from docx import Document
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
-# Add src directory to path to import answerers
+# Add project root to path to import the shared src package
 ROOT_DIR = Path(__file__).resolve().parents[2]
-sys.path.insert(0, str(ROOT_DIR / "src"))
-from answerers import build_answerer
+sys.path.insert(0, str(ROOT_DIR))
+from src.answer_cache import ANSWER_CACHE_FILE, AnswerCache, text_hash
+from src.answerers import AnswerService, AnswerStats
+from src.batching import MicroBatcher
+from src.cache import EmbeddingStore, cache_space, cached_encode
+from src.chunking import CHUNKERS, get_chunker, model_token_limits
+from src.context import ContextStats, TokenCounter, pack_context
+from src.embedding import ModelRegistry, model_fingerprint
+from src.loaders import docx_text
+from src.lexical import LEXICAL_FILE, SEARCH_MODES, LexicalIndex
+from src.manifest import Manifest, chunk_params
+from src.pipeline import remove_stale
+from src.query_cache import QueryCache, normalize_question
+from src.rerank import RERANK_FETCH, Reranker, load_reranker
+from src.retrieval import Hit, hybrid_hits, lexical_hits, search_batch, where_key
+from src.vectordb import CollectionRegistry, query_chunks, store_root, update_metadatas, where_filter
+
+from .jobs import IngestJob, JobRegistry
 
 DATA_DIR = ROOT_DIR / "data"
 DB_DIR = ROOT_DIR / "chroma_db"
+CACHE_DIR = ROOT_DIR / "cache"
+CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", "0")) or None
 # Mặc định đặt model trong thư mục models/all-MiniLM-L6-v2
 MODEL_DIR = ROOT_DIR / "models" / "all-MiniLM-L6-v2"
-
-# Simple in-process cache to avoid reloading the same model directory
-MODEL_CACHE: Dict[str, SentenceTransformer] = {}
-
-app = FastAPI(title="Mini-RAG API", version="0.1.0")
+# torch (SentenceTransformer) hoặc onnx (onnxruntime, CPU)
+EMBED_ENGINE = os.getenv("EMBED_ENGINE", "torch")
+ONNX_VARIANT = os.getenv("ONNX_VARIANT", "auto")
+# chroma | numpy (tìm chính xác trên ma trận memory-mapped) | hnsw (xấp xỉ, cần hnswlib)
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+# Với numpy: float16/int8 để quét trên bản nén rồi re-rank bằng float32
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float32")
+
+# Model nạp sẵn lúc startup (PRELOAD_MODELS, phân tách bằng dấu phẩy) và warm-up trước khi /health báo sẵn sàng;
+# MODEL_MEMORY_MB giới hạn tổng bộ nhớ, model nhàn rỗi lâu nhất bị bỏ trước
+PRELOAD_MODELS = [p for p in os.getenv("PRELOAD_MODELS", str(MODEL_DIR)).split(",") if p.strip()]
+MODEL_MEMORY_MB = int(os.getenv("MODEL_MEMORY_MB", "0")) or None
+MODELS = ModelRegistry(
+    EMBED_ENGINE,
+    ONNX_VARIANT,
+    max_bytes=MODEL_MEMORY_MB * 2**20 if MODEL_MEMORY_MB else None,
+    min_idle=float(os.getenv("MODEL_MIN_IDLE", "300")),
+)
+READINESS: Dict[str, object] = {"ready": False, "error": None}
+EMBED_STORE: EmbeddingStore | None = None
+MANIFEST: Manifest | None = None
+LEXICAL: LexicalIndex | None = None
+
+# Parse PDF/DOCX (CPU, thuần Python) trong process pool; encode/upsert của ingest chạy trên một
+# thread riêng, tách khỏi pool phục vụ query để query không phải xếp hàng sau ingest.
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "4"))
+INGEST_BATCH = 128
+# fixed: cắt theo số ký tự; sentence: theo câu/đoạn/heading DOCX, không vượt max_seq_length token của model
+CHUNKER = os.getenv("CHUNKER", "fixed")
+PARSE_EXECUTOR: ProcessPoolExecutor | None = None
+INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+JOBS = JobRegistry()
+# Micro-batching cho encode câu hỏi: gom request trong cửa sổ vài ms hoặc tới max batch
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "3"))
+QUERY_MAX_BATCH = int(os.getenv("QUERY_MAX_BATCH", "32"))
+QUERY_BATCHERS: Dict[str, MicroBatcher] = {}
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "10000"))
+# Cache câu hỏi -> embedding và (collection, version, embedding, top_k) -> hits; ingest bump version
+QUERY_CACHE = QueryCache(
+    max_entries=int(os.getenv("QUERY_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("QUERY_CACHE_TTL", "300")) or None,
+)
+REGISTRY: CollectionRegistry | None = None
+REGISTRY_LOCK = threading.Lock()
+# Re-rank bằng cross-encoder khi request có rerank=true: lấy RERANK_CANDIDATES (mặc định top_k x 4) ứng viên,
+# chấm theo batch và dừng khi tổng thời gian query vượt RERANK_BUDGET_MS (0 = không giới hạn)
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+RERANK_ENGINE = os.getenv("RERANK_ENGINE", "torch")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "0")) or None
+RERANK_BATCH = int(os.getenv("RERANK_BATCH", "16"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "500")) or None
+RERANKER: Reranker | None = None
+RERANKER_LOCK = threading.Lock()
+ANSWER_STATS = AnswerStats()  # TTFT / thời gian sinh câu trả lời, xem /api/metrics
+# Một client LLM cho cả tiến trình: mỗi câu trả lời tối đa LLM_TIMEOUT_S giây (quá hạn thì dùng DummyAnswerer),
+# tối đa LLM_MAX_CONCURRENCY lời gọi cùng lúc, lỗi tạm thời (429/5xx) thử lại LLM_RETRIES lần với backoff.
+# GEMINI_ENDPOINT trỏ tới host khác (vd. server giả lập chạy local)
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_BACKOFF_MS = float(os.getenv("LLM_BACKOFF_MS", "500"))
+ANSWER_SERVICE: AnswerService | None = None
+ANSWER_SERVICE_LOCK = threading.Lock()
+# Ngân sách token cho CONTEXT của prompt; đếm bằng tokenizer.json cục bộ (mặc định của model embedding)
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "2000"))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "")
+TOKEN_COUNTER: TokenCounter | None = None
+TOKEN_COUNTER_LOCK = threading.Lock()
+# Cache câu trả lời (SQLite cạnh manifest): câu hỏi gần giống (cosine >= ngưỡng) trên đúng tập chunk đã lấy
+# thì trả lại câu trả lời cũ, không gọi LLM; ingest lại / xoá chunk thì các câu trả lời dựa trên nó bị bỏ
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "0")) or None
+ANSWER_CACHE: AnswerCache | None = None
+ANSWER_CACHE_LOCK = threading.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _ensure_dirs()
+    await asyncio.to_thread(_registry)
+    # Mở sẵn để handler không phải mở SQLite / tạo client LLM trên event loop ở request đầu tiên
+    await asyncio.to_thread(_answer_cache)
+    await asyncio.to_thread(_answer_service)
+    warm_task = asyncio.create_task(_warm_up())
+    yield
+    warm_task.cancel()
+    for batcher in QUERY_BATCHERS.values():
+        await batcher.close()
+    INGEST_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    QUERY_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    if PARSE_EXECUTOR is not None:
+        PARSE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    global REGISTRY
+    if REGISTRY is not None:
+        REGISTRY.close()
+        REGISTRY = None
+
+
+app = FastAPI(title="Mini-RAG API", version="0.1.0", lifespan=lifespan)
 
 # Allow local dev origins; tighten in production
 app.add_middleware(
@@ -40,14 +162,38 @@ app.add_middleware(
 )
 
 
+async def _warm_up() -> None:
+    READINESS.update(ready=False, error=None)
+    try:
+        paths = [_resolve_model_path(Path(p.strip())) for p in PRELOAD_MODELS]
+        await asyncio.to_thread(MODELS.preload, paths)
+        if RERANK_MODEL:
+            reranker = await asyncio.to_thread(_reranker)
+            await asyncio.to_thread(reranker.model.predict, [("warm up", "warm up")])
+    except Exception as exc:
+        READINESS["error"] = f"{type(exc).__name__}: {exc}"
+        return
+    READINESS["ready"] = True
+
+
 @app.get("/health")
-async def health() -> dict:
-    return {
-        "status": "ok",
+async def health():
+    ready = bool(READINESS["ready"])
+    body = {
+        "status": "ok" if ready else ("error" if READINESS["error"] else "warming_up"),
+        "ready": ready,
+        "error": READINESS["error"],
+        "models": MODELS.stats(),
         "data_dir": str(DATA_DIR),
         "db_dir": str(DB_DIR),
         "model_dir": str(MODEL_DIR),
+        "embed_engine": EMBED_ENGINE,
+        "vector_store": VECTOR_STORE,
+        "vector_dtype": VECTOR_DTYPE,
+        "active_jobs": JOBS.active(),
     }
+    # 503 cho tới khi warm-up xong để load balancer/readiness probe chưa chuyển traffic vào
+    return JSONResponse(status_code=200 if ready else 503, content=body)
 
 
 def _ensure_dirs() -> None:
@@ -66,15 +212,96 @@ def _resolve_model_path(model_path: Path) -> Path:
     return candidate_models
 
 
-def _load_model(model_path: Path) -> SentenceTransformer:
+def _load_model(model_path: Path):
     resolved = _resolve_model_path(model_path)
     if not resolved.exists():
         raise HTTPException(status_code=400, detail=f"Model directory not found: {resolved}")
 
-    key = str(resolved)
-    if key not in MODEL_CACHE:
-        MODEL_CACHE[key] = SentenceTransformer(str(resolved))
-    return MODEL_CACHE[key]
+    return MODELS.get(resolved)
+
+
+def _reranker() -> Reranker:
+    global RERANKER
+    if RERANKER is None:
+        with RERANKER_LOCK:
+            if RERANKER is None:
+                model_path = _resolve_model_path(Path(RERANK_MODEL))
+                model = load_reranker(
+                    model_path if model_path.exists() else RERANK_MODEL, engine=RERANK_ENGINE, onnx_variant=ONNX_VARIANT
+                )
+                RERANKER = Reranker(model, batch_size=RERANK_BATCH, budget_ms=RERANK_BUDGET_MS)
+    return RERANKER
+
+
+def _token_counter() -> TokenCounter:
+    global TOKEN_COUNTER
+    if TOKEN_COUNTER is None:
+        with TOKEN_COUNTER_LOCK:
+            if TOKEN_COUNTER is None:
+                TOKEN_COUNTER = TokenCounter(_resolve_model_path(Path(CONTEXT_TOKENIZER)) if CONTEXT_TOKENIZER else MODEL_DIR)
+    return TOKEN_COUNTER
+
+
+def _pack(hits: List[Hit], max_tokens: int | None) -> Tuple[List[str], ContextStats]:
+    return pack_context(hits, max_tokens or CONTEXT_TOKENS, _token_counter())
+
+
+def _embedding_store() -> EmbeddingStore:
+    global EMBED_STORE
+    if EMBED_STORE is None:
+        EMBED_STORE = EmbeddingStore(CACHE_DIR, max_bytes=CACHE_MAX_MB * 2**20 if CACHE_MAX_MB else None)
+    return EMBED_STORE
+
+
+def _parse_executor() -> ProcessPoolExecutor:
+    global PARSE_EXECUTOR
+    if PARSE_EXECUTOR is None:
+        PARSE_EXECUTOR = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return PARSE_EXECUTOR
+
+
+def _manifest() -> Manifest:
+    global MANIFEST
+    if MANIFEST is None:
+        MANIFEST = Manifest(store_root(DB_DIR, VECTOR_STORE) / "ingest_manifest.sqlite3")
+    return MANIFEST
+
+
+def _lexical() -> LexicalIndex:
+    # Chỉ mục BM25 nằm cạnh manifest, cập nhật cùng lúc với collection
+    global LEXICAL
+    if LEXICAL is None:
+        LEXICAL = LexicalIndex(store_root(DB_DIR, VECTOR_STORE) / LEXICAL_FILE)
+    return LEXICAL
+
+
+def _answer_service() -> AnswerService:
+    global ANSWER_SERVICE
+    if ANSWER_SERVICE is None:
+        with ANSWER_SERVICE_LOCK:
+            if ANSWER_SERVICE is None:
+                ANSWER_SERVICE = AnswerService.from_env(
+                    prefer_gemini=True,
+                    timeout=LLM_TIMEOUT_S,
+                    max_concurrency=LLM_MAX_CONCURRENCY,
+                    retries=LLM_RETRIES,
+                    backoff=LLM_BACKOFF_MS / 1000,
+                )
+    return ANSWER_SERVICE
+
+
+def _answer_cache() -> AnswerCache:
+    global ANSWER_CACHE
+    if ANSWER_CACHE is None:
+        with ANSWER_CACHE_LOCK:
+            if ANSWER_CACHE is None:
+                ANSWER_CACHE = AnswerCache(
+                    store_root(DB_DIR, VECTOR_STORE) / ANSWER_CACHE_FILE,
+                    max_entries=ANSWER_CACHE_SIZE,
+                    threshold=ANSWER_CACHE_THRESHOLD,
+                    ttl=ANSWER_CACHE_TTL,
+                )
+    return ANSWER_CACHE
 
 
 def _chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
@@ -103,9 +330,7 @@ def _extract_pdf(path: Path) -> List[Tuple[int, str]]:
 
 
 def _extract_docx(path: Path) -> str:
-    doc = Document(str(path))
-    parts = [para.text for para in doc.paragraphs if para.text]
-    return "\n".join(parts)
+    return docx_text(path)
 
 
 def _extract_txt(path: Path) -> str:
@@ -116,63 +341,116 @@ def _hash_id(text: str) -> str:
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-def _client() -> chromadb.PersistentClient:
-    return chromadb.PersistentClient(path=str(DB_DIR))
+def _registry() -> CollectionRegistry:
+    # Một client cho cả tiến trình, tạo lúc startup; handle collection được cache trong registry
+    global REGISTRY
+    if REGISTRY is None:
+        with REGISTRY_LOCK:
+            if REGISTRY is None:
+                REGISTRY = CollectionRegistry(DB_DIR, VECTOR_STORE, VECTOR_DTYPE)
+    return REGISTRY
 
 
-@app.post("/api/ingest")
-async def ingest(
-    file: UploadFile = File(...),
-    collection: str = Form("my_docs"),
-    chunk_size: int = Form(800),
-    overlap: int = Form(150),
-    model_dir: str = Form(str(MODEL_DIR)),
-) -> dict:
-    _ensure_dirs()
+def _parse_upload(
+    path: str, ext: str, chunk_size: int, overlap: int, chunker: str = "fixed", tokens=None
+) -> List[Tuple[int, List[str]]]:
+    """Runs in the parse process pool: extract text by type and chunk it per page.
 
-    filename = file.filename or "uploaded_file"
-    ext = Path(filename).suffix.lower()
-    if ext not in {".pdf", ".docx", ".txt"}:
-        raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF/DOCX/TXT.")
-
-    save_path = DATA_DIR / filename
-    content = await file.read()
-    save_path.write_bytes(content)
-
-    # Extract text by type
+    ``tokens`` = ``model_token_limits(model)`` bounds the ``sentence`` chunker."""
+    save_path = Path(path)
+    if chunker == "fixed":
+        split = partial(_chunk_text, chunk_size=chunk_size, overlap=overlap)
+    else:
+        split = get_chunker(chunker, chunk_size, overlap, tokens)
     page_chunks: List[Tuple[int, List[str]]] = []
     if ext == ".pdf":
         extracted = _extract_pdf(save_path)
         for page_num, text in extracted:
-            chunks = _chunk_text(text, chunk_size, overlap)
+            chunks = split(text)
             if chunks:
                 page_chunks.append((page_num, chunks))
     elif ext == ".docx":
         text = _extract_docx(save_path)
-        chunks = _chunk_text(text, chunk_size, overlap)
+        chunks = split(text)
         if chunks:
             page_chunks.append((1, chunks))
     else:  # .txt
         text = _extract_txt(save_path)
-        chunks = _chunk_text(text, chunk_size, overlap)
+        chunks = split(text)
         if chunks:
             page_chunks.append((1, chunks))
-
+    return page_chunks
+
+
+def _run_ingest(
+    job: IngestJob,
+    save_path: Path,
+    ext: str,
+    digest: str,
+    chunk_size: int,
+    overlap: int,
+    model_dir: str,
+    chunker: str = "fixed",
+) -> None:
+    try:
+        job.finish(_ingest_sync(job, save_path, ext, digest, chunk_size, overlap, model_dir, chunker))
+    except HTTPException as exc:
+        job.fail(str(exc.detail))
+    except Exception as exc:
+        job.fail(f"{type(exc).__name__}: {exc}")
+
+
+def _ingest_sync(
+    job: IngestJob,
+    save_path: Path,
+    ext: str,
+    digest: str,
+    chunk_size: int,
+    overlap: int,
+    model_dir: str,
+    chunker: str = "fixed",
+) -> dict:
+    collection = job.collection
+    filename = job.source
+    manifest = _manifest()
+    params = chunk_params(chunk_size, overlap, chunker)
+    previous = manifest.get(collection, filename)
+    if previous and previous["content_hash"] == digest and previous["params"] == params:
+        job.update(total_chunks=previous["chunk_count"])
+        return {
+            "stored_chunks": previous["chunk_count"],
+            "new_chunks": 0,
+            "removed_chunks": 0,
+            "collection": collection,
+            "source": filename,
+            "unchanged": True,
+        }
+
+    job.update("parsing")
+    # Chunk theo câu cần tokenizer + max_seq_length của chính model sẽ encode
+    tokens = model_token_limits(_load_model(Path(model_dir))) if chunker != "fixed" else None
+    page_chunks = (
+        _parse_executor().submit(_parse_upload, str(save_path), ext, chunk_size, overlap, chunker, tokens).result()
+    )
     if not page_chunks:
         raise HTTPException(status_code=400, detail="No text extracted from file.")
 
     model = _load_model(Path(model_dir))
-    client = chromadb.PersistentClient(path=str(DB_DIR))
-    coll = client.get_or_create_collection(name=collection)
+    coll = _registry().get(collection)
 
     all_chunks: List[str] = []
     metadatas: List[dict] = []
     ids: List[str] = []
+    seen = set()
 
     for page_num, chunks in page_chunks:
         for idx, chunk in enumerate(chunks, start=1):
+            chunk_id = _hash_id(chunk)
+            if chunk_id in seen:
+                continue
+            seen.add(chunk_id)
             all_chunks.append(chunk)
-            ids.append(_hash_id(chunk))
+            ids.append(chunk_id)
             metadatas.append(
                 {
                     "source": filename,
@@ -181,75 +459,475 @@ async def ingest(
                 }
             )
 
-    embeddings = model.encode(all_chunks, normalize_embeddings=True).tolist()
-
-    coll.upsert(ids=ids, documents=all_chunks, embeddings=embeddings, metadatas=metadatas)
+    # Chỉ encode chunk mới; chunk đã có từ lần trước chỉ cập nhật metadata
+    old = manifest.chunk_hashes(collection, filename)
+    kept = [i for i, cid in enumerate(ids) if cid in old]
+    fresh = [i for i, cid in enumerate(ids) if cid not in old]
+    job.update("encoding", total_chunks=len(ids), new_chunks=len(fresh))
+    if kept:
+        update_metadatas(coll, [ids[i] for i in kept], [metadatas[i] for i in kept])
+        QUERY_CACHE.bump(collection)
+    if fresh:
+        space = cache_space(
+            model_fingerprint(_resolve_model_path(Path(model_dir)), EMBED_ENGINE, ONNX_VARIANT), normalize=True
+        )
+        # Encode/upsert theo batch nhỏ để không chiếm CPU quá lâu mỗi lần và báo tiến độ
+        for start in range(0, len(fresh), INGEST_BATCH):
+            part = fresh[start : start + INGEST_BATCH]
+            part_ids = [ids[i] for i in part]
+            part_chunks = [all_chunks[i] for i in part]
+            job.update("encoding")
+            embeddings, _ = cached_encode(_embedding_store(), space, model, part_ids, part_chunks, normalize=True)
+            job.update("upserting", encoded_chunks=job.encoded_chunks + len(part))
+            coll.upsert(
+                ids=part_ids,
+                documents=part_chunks,
+                embeddings=embeddings,
+                metadatas=[metadatas[i] for i in part],
+            )
+            QUERY_CACHE.bump(collection)
+            job.update(upserted_chunks=job.upserted_chunks + len(part))
+    if _lexical().add(collection, ids, all_chunks):
+        QUERY_CACHE.bump(collection)
+    removed = remove_stale(coll, manifest, filename, old, seen, id_fn=lambda h: h, lexical=_lexical())
+    if removed:
+        QUERY_CACHE.bump(collection)
+    job.update(removed_chunks=removed)
+    manifest.record(collection, filename, digest, params, ids)
+    _answer_cache().invalidate(collection, old | seen)
 
     return {
         "stored_chunks": len(all_chunks),
+        "new_chunks": len(fresh),
+        "removed_chunks": removed,
         "collection": collection,
         "source": filename,
     }
 
 
+@app.post("/api/ingest")
+async def ingest(
+    file: UploadFile = File(...),
+    collection: str = Form("my_docs"),
+    chunk_size: int = Form(800),
+    overlap: int = Form(150),
+    model_dir: str = Form(str(MODEL_DIR)),
+    wait: bool = Form(False),
+    chunker: str = Form(CHUNKER),
+):
+    """Queue an ingest job and return its id (202); with wait=true, block until it finishes."""
+    _ensure_dirs()
+
+    filename = file.filename or "uploaded_file"
+    ext = Path(filename).suffix.lower()
+    if ext not in {".pdf", ".docx", ".txt"}:
+        raise HTTPException(status_code=400, detail="Unsupported file type. Use PDF/DOCX/TXT.")
+    if chunk_size <= 0 or overlap < 0 or overlap >= chunk_size:
+        raise HTTPException(status_code=400, detail="Invalid chunk_size/overlap")
+    if chunker not in CHUNKERS:
+        raise HTTPException(status_code=400, detail=f"chunker must be one of {', '.join(CHUNKERS)}")
+    resolved = _resolve_model_path(Path(model_dir))
+    if not resolved.exists():
+        raise HTTPException(status_code=400, detail=f"Model directory not found: {resolved}")
+
+    save_path = DATA_DIR / filename
+    content = await file.read()
+    await asyncio.to_thread(save_path.write_bytes, content)
+    digest = hashlib.sha256(content).hexdigest()
+
+    job = JOBS.create(collection, filename)
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        INGEST_EXECUTOR, _run_ingest, job, save_path, ext, digest, chunk_size, overlap, model_dir, chunker
+    )
+    if not wait:
+        return JSONResponse(status_code=202, content=job.to_dict())
+
+    await future
+    if job.status == "failed":
+        raise HTTPException(status_code=400, detail=job.error)
+    return job.result
+
+
+@app.get("/api/jobs")
+async def list_jobs() -> dict:
+    return {"jobs": JOBS.list()}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
 class QueryRequest(BaseModel):
     model_config = ConfigDict(protected_namespaces=())
     question: str
     collection: str = "my_docs"
     top_k: int = 5
     model_dir: str = str(MODEL_DIR)
+    use_llm: bool = True  # Whether to generate answer using LLM
+    mode: str = "dense"  # dense | lexical (BM25, no encoding) | hybrid (RRF of both)
+    rerank: bool = False  # Re-rank candidates with the cross-encoder (RERANK_MODEL)
+    rerank_candidates: int | None = None
+    context_tokens: int | None = None  # ngân sách token của CONTEXT khi sinh câu trả lời (mặc định CONTEXT_TOKENS)
+    # Bộ lọc: chỉ tìm trong các file (metadata "source") và/hoặc khoảng trang cho trước
+    sources: List[str] | None = None
+    page_from: int | None = None
+    page_to: int | None = None
+
+
+def _query_batcher(model_dir: str) -> Tuple[str, MicroBatcher]:
+    resolved = _resolve_model_path(Path(model_dir))
+    key = MODELS.key(resolved)
+    batcher = QUERY_BATCHERS.get(key)
+    if batcher is None:
+
+        def encode(texts: List[str]):
+            return _load_model(resolved).encode(texts, normalize_embeddings=True, batch_size=len(texts))
+
+        batcher = MicroBatcher(encode, QUERY_BATCH_WINDOW_MS, QUERY_MAX_BATCH, executor=QUERY_EXECUTOR)
+        QUERY_BATCHERS[key] = batcher
+    return key, batcher
+
+
+def _search(body: QueryRequest, query_emb: np.ndarray | None, top_k: int, where: dict | None) -> List[Hit]:
+    """Runs in the query executor: search the collection with an already-encoded question (None for lexical)."""
+    if body.mode == "lexical":
+        return _registry().call(body.collection, lambda coll: lexical_hits(coll, _lexical(), body.question, top_k, where))
+    if body.mode == "hybrid":
+        return _registry().call(
+            body.collection, lambda coll: hybrid_hits(coll, _lexical(), body.question, query_emb, top_k, where)
+        )
+    return _registry().call(body.collection, lambda coll: query_chunks(coll, query_emb, top_k, where))
 
 
-    use_llm: bool = True  # Whether to generate answer using LLM
-@app.post("/api/query")
-async def query(body: QueryRequest) -> dict:
+def _where(body) -> dict | None:
+    if body.sources is not None and not body.sources:
+        raise HTTPException(status_code=400, detail="sources is empty")
+    if body.page_from is not None and body.page_to is not None and body.page_from > body.page_to:
+        raise HTTPException(status_code=400, detail="page_from must be <= page_to")
+    return where_filter(body.sources, body.page_from, body.page_to)
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEARCH_MODES)}")
+
+
+def _format_hits(hits: List[Hit]) -> List[dict]:
+    return [
+        {
+            "rank": idx,
+            "distance": dist,
+            "metadata": meta,
+            "text": doc,
+        }
+        for idx, (doc, meta, dist) in enumerate(hits, start=1)
+    ]
+
+
+async def _retrieve(
+    body: QueryRequest, started: float
+) -> Tuple[List[Hit], dict | None, Dict[str, float], np.ndarray | None]:
+    """Validate, encode (micro-batched, cached), search and optionally re-rank:
+    (hits, rerank info, timings, question embedding or None for lexical)."""
     if not body.question.strip():
         raise HTTPException(status_code=400, detail="Question is empty")
     if body.top_k <= 0:
         raise HTTPException(status_code=400, detail="top_k must be > 0")
+    _check_mode(body.mode)
+    where = _where(body)
+    if body.rerank and not RERANK_MODEL:
+        raise HTTPException(status_code=400, detail="Re-ranking is not configured (set RERANK_MODEL)")
+
+    timings: Dict[str, float] = {}
+    loop = asyncio.get_running_loop()
+    fetch_k = (body.rerank_candidates or body.top_k * RERANK_FETCH) if body.rerank else body.top_k
+    query_emb = None
+    if body.mode == "lexical":
+        # Chỉ tra chỉ mục ngược, không encode câu hỏi
+        key = QUERY_CACHE.text_key(body.collection, body.question, fetch_k, (body.mode, where_key(where)))
+    else:
+        batcher_key, batcher = _query_batcher(body.model_dir)
+        query_emb = QUERY_CACHE.get_embedding(batcher_key, body.question)
+        if query_emb is None:
+            # Các câu hỏi đến cùng lúc được gom lại encode một lần
+            query_emb = await batcher.encode(body.question)
+            QUERY_CACHE.put_embedding(batcher_key, body.question, query_emb)
+        if body.mode == "hybrid":
+            extra = (body.mode, normalize_question(body.question), where_key(where))
+        else:
+            extra = where_key(where)
+        key = QUERY_CACHE.result_key(body.collection, query_emb, fetch_k, extra)
+    t0 = time.perf_counter()
+    timings["encode_ms"] = 1000 * (t0 - started)
+    hits = QUERY_CACHE.results.get(key)
+    if hits is None:
+        hits = await loop.run_in_executor(QUERY_EXECUTOR, _search, body, query_emb, fetch_k, where)
+        QUERY_CACHE.results.put(key, hits)
+    timings["search_ms"] = 1000 * (time.perf_counter() - t0)
+
+    rerank = None
+    if body.rerank:
+        # Budget tính từ đầu request: encode/search chậm thì re-rank ít đi hoặc bỏ qua
+        reranker = await loop.run_in_executor(QUERY_EXECUTOR, _reranker)
+        hits, info = await loop.run_in_executor(
+            QUERY_EXECUTOR, reranker.rerank, body.question, hits, body.top_k, None, started
+        )
+        rerank = info.to_dict()
+        timings["rerank_ms"] = rerank["ms"]
+    return hits, rerank, timings, query_emb
 
-    model = _load_model(Path(body.model_dir))
-    client = _client()
-    coll = client.get_or_create_collection(name=body.collection)
 
-    query_emb = model.encode([body.question], normalize_embeddings=True).tolist()[0]
-    result = coll.query(
-        query_embeddings=[query_emb],
-        n_results=body.top_k,
-        include=["documents", "metadatas", "distances"],
-    )
+def _answer_key(body, answerer, hits: List[Hit]) -> Tuple[str, List[str]]:
+    """(variant, chunk hashes) of an answer: the same question only reuses an answer of the same
+    answerer, embedding model and context budget, built on the same chunks."""
+    model_key = "" if body.mode == "lexical" else MODELS.key(_resolve_model_path(Path(body.model_dir)))
+    variant = f"{answerer.name}|{model_key}|{body.context_tokens or CONTEXT_TOKENS}"
+    return variant, [text_hash(doc) for doc, _, _ in hits if doc]
 
-    documents = result.get("documents", [[]])[0]
-    metadatas = result.get("metadatas", [[]])[0]
-    distances = result.get("distances", [[]])[0]
 
-    hits = []
-    for idx, (doc, meta, dist) in enumerate(zip(documents, metadatas, distances), start=1):
-        hits.append(
-            {
-                "rank": idx,
-                "distance": dist,
-                "metadata": meta,
-                "text": doc,
-            }
-        )
-# Generate answer using LLM if requested
+@app.post("/api/query")
+async def query(body: QueryRequest) -> dict:
+    started = time.perf_counter()
+    hits, rerank, timings, query_emb = await _retrieve(body, started)
+
+    # Generate answer using LLM if requested (I/O-bound: default thread pool, not the inference pool)
     answer = None
-    if body.use_llm and documents:
-        answerer = build_answerer(prefer_gemini=True)
-        answer = answerer.answer(body.question, documents)
+    context = None
+    cached = False
+    if body.use_llm and hits:
+        answerer = _answer_service()
+        variant, hashes = _answer_key(body, answerer, hits)
+        t0 = time.perf_counter()
+        answer = await asyncio.to_thread(
+            _answer_cache().lookup, body.collection, variant, hashes, body.question, query_emb
+        )
+        cached = answer is not None
+        if answer is None:
+            documents, stats = await asyncio.to_thread(_pack, hits, body.context_tokens)
+            context = stats.to_dict()
+            t0 = time.perf_counter()
+            outcome: dict = {}
+            answer = await asyncio.to_thread(answerer.answer, body.question, documents, outcome)
+            ANSWER_STATS.record(None, time.perf_counter() - t0, streamed=False)
+            # Câu trả lời dự phòng (LLM lỗi / quá hạn) không cache
+            if not outcome.get("fallback"):
+                await asyncio.to_thread(
+                    _answer_cache().put, body.collection, variant, hashes, body.question, query_emb, answer
+                )
+        timings["answer_ms"] = 1000 * (time.perf_counter() - t0)
+    timings["total_ms"] = 1000 * (time.perf_counter() - started)
 
     return {
         "question": body.question,
         "collection": body.collection,
-        "results": hits,
-        "answer": answer,  # Generated answer from LLMdy.collection,
-        "results": hits,
+        "results": _format_hits(hits),
+        "answer": answer,  # Generated answer from LLM
+        "answer_cached": cached,  # answer reused from the answer cache, no LLM call
+        "rerank": rerank,
+        "context": context,  # tokens before/after packing the prompt context
+        "timings": timings,
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/query/stream")
+async def query_stream(body: QueryRequest) -> StreamingResponse:
+    """Server-Sent Events: ``hits`` (retrieval result) first, then ``token`` chunks as the LLM
+    produces them, then ``done`` with timings (``ttft_ms`` counts from the start of the request)."""
+    started = time.perf_counter()
+    # Lỗi kiểm tra/tìm kiếm trả về mã HTTP bình thường, trước khi mở stream
+    hits, rerank, timings, query_emb = await _retrieve(body, started)
+    documents, context, cached = [], None, None
+    answerer, variant, hashes = None, "", []
+    if body.use_llm and hits:
+        answerer = _answer_service()
+        variant, hashes = _answer_key(body, answerer, hits)
+        cached = await asyncio.to_thread(
+            _answer_cache().lookup, body.collection, variant, hashes, body.question, query_emb
+        )
+        if cached is None:
+            documents, stats = await asyncio.to_thread(_pack, hits, body.context_tokens)
+            context = stats.to_dict()
+
+    async def events():
+        yield _sse(
+            "hits",
+            {
+                "question": body.question,
+                "collection": body.collection,
+                "results": _format_hits(hits),
+                "rerank": rerank,
+                "context": context,
+                "answer_cached": cached is not None,
+                "timings": dict(timings),
+            },
+        )
+        if cached is not None:
+            # Câu trả lời đã cache: gửi một lần, không gọi LLM
+            timings["ttft_ms"] = 1000 * (time.perf_counter() - started)
+            yield _sse("token", {"text": cached})
+        elif documents:
+            t0 = time.perf_counter()
+            first = None
+            parts: List[str] = []
+            failed = False
+            outcome: dict = {}
+            stop = threading.Event()
+            chunks = answerer.stream(body.question, documents, outcome, stop)
+            try:
+                while True:
+                    # Mỗi chunk lấy trong thread: model/API chặn không giữ event loop
+                    text = await asyncio.to_thread(next, chunks, None)
+                    if text is None:
+                        break
+                    if first is None:
+                        first = time.perf_counter()
+                        timings["ttft_ms"] = 1000 * (first - started)
+                        timings["answer_ttft_ms"] = 1000 * (first - t0)
+                    parts.append(text)
+                    yield _sse("token", {"text": text})
+            except Exception as exc:
+                failed = True
+                yield _sse("error", {"detail": str(exc)})
+            finally:
+                # Client ngắt giữa chừng (GeneratorExit/CancelledError): dừng đọc LLM, trả slot
+                stop.set()
+                try:
+                    chunks.close()
+                except ValueError:
+                    pass  # next() còn chạy trong thread: nó thấy ``stop`` và tự kết thúc
+            timings["answer_ms"] = 1000 * (time.perf_counter() - t0)
+            ANSWER_STATS.record(None if first is None else first - t0, time.perf_counter() - t0, streamed=True)
+            if parts and not failed and not outcome.get("fallback"):
+                await asyncio.to_thread(
+                    _answer_cache().put, body.collection, variant, hashes, body.question, query_emb, "".join(parts)
+                )
+        timings["total_ms"] = 1000 * (time.perf_counter() - started)
+        yield _sse("done", {"timings": timings})
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+class BatchQueryRequest(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    questions: List[str]
+    collection: str = "my_docs"
+    top_k: int = 5
+    model_dir: str = str(MODEL_DIR)
+    use_llm: bool = False  # Generate an answer per question (slow for large batches)
+    mode: str = "dense"
+    sources: List[str] | None = None
+    page_from: int | None = None
+    page_to: int | None = None
+    context_tokens: int | None = None
+
+
+def _search_batch(body: BatchQueryRequest, where: dict | None) -> List[List[Hit]]:
+    """Runs in the query executor: one encode call for all uncached questions, one vectorized search."""
+    resolved = _resolve_model_path(Path(body.model_dir))
+    model = None if body.mode == "lexical" else _load_model(resolved)
+    return _registry().call(
+        body.collection,
+        lambda coll: search_batch(
+            model, coll, body.questions, body.top_k, QUERY_CACHE, MODELS.key(resolved), batch_size=QUERY_MAX_BATCH,
+            mode=body.mode, lexical=_lexical(), where=where,
+        ),
+    )
+
+
+@app.post("/api/query/batch")
+async def query_batch(body: BatchQueryRequest) -> dict:
+    if not body.questions:
+        raise HTTPException(status_code=400, detail="questions is empty")
+    if len(body.questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUESTIONS} questions per request")
+    if any(not q.strip() for q in body.questions):
+        raise HTTPException(status_code=400, detail="Question is empty")
+    if body.top_k <= 0:
+        raise HTTPException(status_code=400, detail="top_k must be > 0")
+    _check_mode(body.mode)
+    where = _where(body)
+
+    loop = asyncio.get_running_loop()
+    all_hits = await loop.run_in_executor(QUERY_EXECUTOR, _search_batch, body, where)
+
+    answers: List[str | None] = [None] * len(all_hits)
+    if body.use_llm:
+        answerer = _answer_service()
+        model_key = "" if body.mode == "lexical" else MODELS.key(_resolve_model_path(Path(body.model_dir)))
+
+        def answer(question: str, hits: List[Hit]) -> str:
+            variant, hashes = _answer_key(body, answerer, hits)
+            # Embedding vừa encode cho search_batch vẫn nằm trong QUERY_CACHE (nếu chưa bị đẩy ra)
+            emb = QUERY_CACHE.get_embedding(model_key, question) if model_key else None
+            text = _answer_cache().lookup(body.collection, variant, hashes, question, emb)
+            if text is None:
+                outcome: dict = {}
+                text = answerer.answer(question, _pack(hits, body.context_tokens)[0], outcome)
+                if not outcome.get("fallback"):
+                    _answer_cache().put(body.collection, variant, hashes, question, emb, text)
+            return text
+
+        answers = await asyncio.gather(
+            *(
+                asyncio.to_thread(answer, q, hits) if hits else asyncio.sleep(0)
+                for q, hits in zip(body.questions, all_hits)
+            )
+        )
+
+    return {
+        "collection": body.collection,
+        "results": [
+            {"question": q, "results": _format_hits(hits), "answer": answer}
+            for q, hits, answer in zip(body.questions, all_hits, answers)
+        ],
+    }
+
+
+@app.get("/api/metrics")
+async def metrics() -> dict:
+    # stats() của cache câu trả lời đếm trong SQLite (và lần đầu mở file): không chạy trên event loop
+    answer_cache = await asyncio.to_thread(lambda: _answer_cache().stats())
+    llm = await asyncio.to_thread(lambda: _answer_service().stats())
+    return {
+        "query_batching": {
+            "window_ms": QUERY_BATCH_WINDOW_MS,
+            "max_batch": QUERY_MAX_BATCH,
+            "models": {key: b.stats.to_dict() for key, b in QUERY_BATCHERS.items()},
+        },
+        "query_cache": QUERY_CACHE.stats(),
+        "models": MODELS.stats(),
+        "rerank": {"model": RERANK_MODEL or None, "loaded": RERANKER is not None, "budget_ms": RERANK_BUDGET_MS},
+        "answers": ANSWER_STATS.to_dict(),
+        "answer_cache": answer_cache,
+        "llm": llm,
+        "jobs": JOBS.active(),
     }
 
 
 @app.get("/api/collections")
 async def list_collections() -> dict:
-    client = _client()
-    cols = client.list_collections()
-    return {"collections": [c.name for c in cols]}
+    return {"collections": await asyncio.to_thread(_registry().names)}
+
+
+@app.delete("/api/collections/{name}")
+async def delete_collection(name: str) -> dict:
+    registry = _registry()
+    if name not in await asyncio.to_thread(registry.names):
+        raise HTTPException(status_code=404, detail="Collection not found")
+    await asyncio.to_thread(registry.delete, name)
+    await asyncio.to_thread(_manifest().drop, name)
+    await asyncio.to_thread(_lexical().drop, name)
+    await asyncio.to_thread(lambda: _answer_cache().drop(name))
+    QUERY_CACHE.bump(name)
+    return {"deleted": name}
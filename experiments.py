@@ -1,86 +1,216 @@
 # Hướng dẫn: python experiments.py --file data\your_file.pdf --model .\all-MiniLM-L6-v2
 # Cài đặt: python -m pip install -r requirements.txt
 import argparse
+import csv
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, Sequence
 
-from src.chunking import build_chunks
-from src.embedding import encode_texts, load_model
+import numpy as np
+
+from src.cache import EmbeddingStore, cache_space, cached_encode
+from src.chunking import CHUNKERS, build_chunks, model_token_limits
+from src.embedding import load_model, model_fingerprint
+from src.evaluation import LabelledQuery, load_labelled_queries, recall_at_k, reciprocal_rank
 from src.loaders import load_document
-from src.vectordb import get_collection, query_chunks, upsert_chunks
+from src.rerank import RERANK_FETCH, Reranker, load_reranker
+from src.retrieval import encode_queries
+from src.vectordb import STORES, VECTOR_DTYPES, Record, get_collection, query_records_batch, upsert_chunks
 
 
-Config = Tuple[int, int, int]
+DEFAULT_QUERIES = [
+    LabelledQuery("Tóm tắt nội dung chính"),
+    LabelledQuery("Các ý quan trọng cần lưu ý"),
+    LabelledQuery("Chi tiết cụ thể về tài liệu"),
+]
+UPSERT_BATCH = 5000
+COLUMNS = [
+    "chunker", "chunk_size", "overlap", "top_k", "chunks", "build_s", "index_mb",
+    "search_p50_ms", "search_p95_ms", "rerank_ms", "recall", "mrr",
+]
 
 
-def ingest_for_config(
-    file_path: Path,
-    model,
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def evaluate_chunking(
     db_dir: Path,
-    collection_name: str,
     chunk_size: int,
     overlap: int,
-) -> None:
+    ids: Sequence[str],
+    chunks: Sequence[str],
+    metas: Sequence[dict],
+    embeddings: np.ndarray,
+    query_embs: np.ndarray,
+    fetch_k: int,
+    vector_store: str = "chroma",
+    vector_dtype: str = "float32",
+    chunker: str = "fixed",
+) -> dict:
+    """Runs in a worker process: index one (chunker, chunk_size, overlap) and search every query once at ``fetch_k``."""
+    name = f"exp_cs{chunk_size}_ov{overlap}" + ("" if chunker == "fixed" else f"_{chunker}")
+    # Mỗi cấu hình một thư mục riêng: các tiến trình không ghi chung một Chroma/SQLite
+    path = Path(db_dir) / name
+    shutil.rmtree(path, ignore_errors=True)
+    collection = get_collection(path, name, vector_store, vector_dtype)
+    t0 = time.perf_counter()
+    for start in range(0, len(ids), UPSERT_BATCH):
+        end = start + UPSERT_BATCH
+        upsert_chunks(collection, ids[start:end], chunks[start:end], metas[start:end], embeddings[start:end])
+    build_s = time.perf_counter() - t0
+    hits: List[List[Record]] = []
+    latencies: List[float] = []
+    for q in query_embs:
+        t0 = time.perf_counter()
+        hits.append(query_records_batch(collection, q[None, :], fetch_k)[0])
+        latencies.append(time.perf_counter() - t0)
+    if hasattr(collection, "close"):
+        collection.close()
+    return {"build_s": build_s, "index_bytes": _dir_size(path), "latencies": latencies, "hits": hits}
+
+
+def run_experiments(
+    file_path: Path,
+    model_path: Path,
+    db_dir: Path,
+    engine: str = "torch",
+    cache_dir: Path = Path("./cache"),
+    vector_store: str = "chroma",
+    vector_dtype: str = "float32",
+    reranker: Reranker | None = None,
+    chunk_sizes: Sequence[int] = (500, 800, 1200),
+    overlaps: Sequence[int] = (50, 150, 250),
+    top_ks: Sequence[int] = (3, 5),
+    queries: List[LabelledQuery] | None = None,
+    workers: int | None = None,
+    chunkers: Sequence[str] = ("fixed",),
+) -> List[dict]:
+    """Sweep every (chunker, chunk_size, overlap, top_k); returns one result row per config (see ``COLUMNS``).
+
+    The document is parsed once and chunked once per (chunker, chunk_size, overlap); chunks are encoded
+    through the shared embedding cache, and every top_k is read off one search at the largest k.
+    """
+    queries = queries or DEFAULT_QUERIES
+    configs = [(ch, cs, ov) for ch in chunkers for cs in chunk_sizes for ov in overlaps if ov < cs]
+    max_k = max(top_ks)
+    fetch_k = max_k * RERANK_FETCH if reranker is not None else max_k
+
+    t0 = time.perf_counter()
     pages = load_document(file_path)
-    chunks, ids, metas = build_chunks(file_path, pages, chunk_size, overlap)
-    embeddings = encode_texts(model, chunks, normalize=True)
-    collection = get_collection(db_dir, collection_name)
-    upsert_chunks(collection, ids, chunks, metas, embeddings)
-
-
-def run_experiments(file_path: Path, model_path: Path, db_dir: Path) -> None:
-    queries = [
-        "Tóm tắt nội dung chính",
-        "Các ý quan trọng cần lưu ý",
-        "Chi tiết cụ thể về tài liệu",
-    ]
-    configs: List[Config] = [
-        (500, 50, 3),
-        (500, 50, 5),
-        (500, 150, 3),
-        (500, 150, 5),
-        (500, 250, 3),
-        (500, 250, 5),
-        (800, 50, 3),
-        (800, 50, 5),
-        (800, 150, 3),
-        (800, 150, 5),
-        (800, 250, 3),
-        (800, 250, 5),
-        (1200, 50, 3),
-        (1200, 50, 5),
-        (1200, 150, 3),
-        (1200, 150, 5),
-        (1200, 250, 3),
-        (1200, 250, 5),
-    ]
-
-    model = load_model(model_path)
-
-    for chunk_size, overlap, top_k in configs:
-        coll_name = f"exp_cs{chunk_size}_ov{overlap}_k{top_k}"
-        ingest_for_config(file_path, model, db_dir, coll_name, chunk_size, overlap)
-        collection = get_collection(db_dir, coll_name)
-
-        print(f"\n=== Config: chunk_size={chunk_size}, overlap={overlap}, top_k={top_k} ===")
-        for q in queries:
-            q_emb = encode_texts(model, [q], normalize=True)[0]
-            results = query_chunks(collection, q_emb, top_k)
-            if not results:
-                print(f"Query: {q} -> No results")
-                continue
-            doc, meta, dist = results[0]
-            source = meta.get("source", "") if isinstance(meta, dict) else ""
-            page = meta.get("page", "?") if isinstance(meta, dict) else "?"
-            preview = (doc or "")[:200].replace("\n", " ")
-            print(f"Query: {q}\n  top1_dist={dist:.4f} | source={source} | page={page}\n  preview: {preview}")
+    parse_s = time.perf_counter() - t0
+
+    model = load_model(model_path, engine=engine)
+    store = EmbeddingStore(cache_dir)
+    space = cache_space(model_fingerprint(model_path, engine), normalize=True)
+    tokens = model_token_limits(model) if any(ch != "fixed" for ch in chunkers) else None
+    chunked = {}
+    chunk_s: Dict[str, float] = {}
+    for ch, cs, ov in configs:
+        t0 = time.perf_counter()
+        chunked[(ch, cs, ov)] = build_chunks(file_path, pages, cs, ov, chunker=ch, tokens=tokens)
+        chunk_s[ch] = chunk_s.get(ch, 0.0) + time.perf_counter() - t0
+    # Chunk trùng nhau giữa các cấu hình (và giữa các lần chạy) chỉ encode một lần
+    texts: Dict[str, str] = {}
+    for chunks, _, _ in chunked.values():
+        texts.update((sha256(c.encode("utf-8")).hexdigest(), c) for c in chunks)
+    hashes = list(texts)
+    t0 = time.perf_counter()
+    embeddings, encoded = cached_encode(store, space, model, hashes, [texts[h] for h in hashes], normalize=True)
+    encode_s = time.perf_counter() - t0
+    row_of = {h: i for i, h in enumerate(hashes)}
+    query_embs = encode_queries(model, [q.question for q in queries])
+    print(f"Parsed {len(pages)} pages in {parse_s:.1f}s; {len(hashes)} unique chunks, {encoded} encoded in {encode_s:.1f}s")
+    for ch, seconds in chunk_s.items():
+        n = sum(len(c) for (name, _, _), (c, _, _) in chunked.items() if name == ch)
+        print(f"Chunker {ch}: {n} chunks in {seconds:.2f}s ({n / max(seconds, 1e-9):.0f} chunks/s)")
+
+    jobs = {}
+    workers = workers or min(len(configs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for config, (chunks, ids, metas) in chunked.items():
+            chunker, chunk_size, overlap = config
+            rows = [row_of[sha256(c.encode("utf-8")).hexdigest()] for c in chunks]
+            jobs[config] = pool.submit(
+                evaluate_chunking, db_dir, chunk_size, overlap, ids, chunks, metas, embeddings[rows], query_embs, fetch_k,
+                vector_store, vector_dtype, chunker,
+            )
+        results = {config: job.result() for config, job in jobs.items()}
+
+    table: List[dict] = []
+    for (chunker, chunk_size, overlap), out in results.items():
+        ranked = [[(doc, meta, dist) for _, doc, meta, dist in hits] for hits in out["hits"]]
+        rerank_ms = None
+        if reranker is not None:
+            # Re-rank một lần xuống max_k; top_k nhỏ hơn là tiền tố của danh sách đó
+            reranked = [reranker.rerank(q.question, hits, max_k) for q, hits in zip(queries, ranked)]
+            ranked = [hits for hits, _ in reranked]
+            rerank_ms = float(np.mean([1000 * info.seconds for _, info in reranked]))
+        matches = [q.matches(hits) for q, hits in zip(queries, ranked)]
+        labelled = [(m, q.n_relevant) for m, q in zip(matches, queries) if q.n_relevant]
+        p50, p95 = np.percentile(np.asarray(out["latencies"]) * 1000, [50, 95])
+        for top_k in sorted(set(top_ks)):
+            table.append(
+                {
+                    "chunker": chunker,
+                    "chunk_size": chunk_size,
+                    "overlap": overlap,
+                    "top_k": top_k,
+                    "chunks": len(chunked[(chunker, chunk_size, overlap)][0]),
+                    "build_s": out["build_s"],
+                    "index_mb": out["index_bytes"] / 2**20,
+                    "search_p50_ms": float(p50),
+                    "search_p95_ms": float(p95),
+                    "rerank_ms": rerank_ms,
+                    "recall": float(np.mean([recall_at_k(m, n, top_k) for m, n in labelled])) if labelled else None,
+                    "mrr": float(np.mean([reciprocal_rank(m, top_k) for m, _ in labelled])) if labelled else None,
+                }
+            )
+    return table
+
+
+def print_table(table: List[dict]) -> None:
+    print(" | ".join(COLUMNS))
+    for row in table:
+        cells = [f"{row[c]:.3f}" if isinstance(row[c], float) else "-" if row[c] is None else str(row[c]) for c in COLUMNS]
+        print(" | ".join(cells))
+
+
+def write_table(table: List[dict], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".json":
+        path.write_text(json.dumps(table, ensure_ascii=False, indent=2), encoding="utf-8")
+        return
+    with path.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(table)
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Chunk/overlap/top_k sweep experiments")
+    parser = argparse.ArgumentParser(description="Chunker/chunk/overlap/top_k sweep experiments")
     parser.add_argument("--file", required=True, help="Path to PDF/DOCX/TXT file")
     parser.add_argument("--model", required=True, help="Path or name of SentenceTransformer model")
     parser.add_argument("--db", default="./chroma_db_exp", help="ChromaDB directory for experiments")
+    parser.add_argument("--engine", choices=["torch", "onnx"], default="torch", help="Embedding engine")
+    parser.add_argument("--cache-dir", default="./cache", help="Directory of the shared embedding cache")
+    parser.add_argument("--store", choices=STORES, default="chroma", help="Vector store: chroma, numpy or hnsw")
+    parser.add_argument("--store-dtype", choices=VECTOR_DTYPES, default="float32", help="numpy store: float32, float16 or int8 scan codes")
+    parser.add_argument("--rerank-model", default=None, help="Cross-encoder: retrieve top_k x 4, re-rank to top_k")
+    parser.add_argument("--rerank-engine", choices=["torch", "onnx"], default="torch", help="Cross-encoder engine")
+    parser.add_argument("--rerank-budget-ms", type=float, default=None, help="Per-query re-ranking latency budget")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[500, 800, 1200])
+    parser.add_argument("--overlaps", type=int, nargs="+", default=[50, 150, 250])
+    parser.add_argument("--chunkers", choices=CHUNKERS, nargs="+", default=["fixed"], help="Chunkers to compare (sentence: limited by the model's max_seq_length)")
+    parser.add_argument("--top-ks", type=int, nargs="+", default=[3, 5])
+    parser.add_argument("--queries", default=None, help='Labelled queries for recall/MRR (JSONL: {"question": ..., "relevant": [snippets], "source": ..., "page": ...})')
+    parser.add_argument("--workers", type=int, default=None, help="Processes indexing/searching configs in parallel (default: CPU count)")
+    parser.add_argument("--output", default=None, help="Write the results table to this .csv or .json file")
     return parser.parse_args()
 
 
@@ -91,8 +221,30 @@ def main():
         raise FileNotFoundError(file_path)
     model_path = Path(args.model)
     db_dir = Path(args.db)
-
-    run_experiments(file_path, model_path, db_dir)
+    reranker = None
+    if args.rerank_model:
+        reranker = Reranker(load_reranker(args.rerank_model, engine=args.rerank_engine), budget_ms=args.rerank_budget_ms)
+
+    table = run_experiments(
+        file_path,
+        model_path,
+        db_dir,
+        engine=args.engine,
+        cache_dir=Path(args.cache_dir),
+        vector_store=args.store,
+        vector_dtype=args.store_dtype,
+        reranker=reranker,
+        chunk_sizes=args.chunk_sizes,
+        overlaps=args.overlaps,
+        top_ks=args.top_ks,
+        queries=load_labelled_queries(Path(args.queries)) if args.queries else None,
+        workers=args.workers,
+        chunkers=args.chunkers,
+    )
+    print_table(table)
+    if args.output:
+        write_table(table, Path(args.output))
+        print(f"Wrote {len(table)} rows to {args.output}")
 
 
 if __name__ == "__main__":
@@ -6,21 +6,44 @@ export type IngestParams = {
   chunk_size?: number;
   overlap?: number;
   model_dir?: string;
+  chunker?: "fixed" | "sentence";
 };
 
 export type IngestResponse = {
   stored_chunks: number;
+  new_chunks?: number;
+  removed_chunks?: number;
+  unchanged?: boolean;
   collection: string;
   source: string;
 };
 
-export async function ingestFile(params: IngestParams): Promise<IngestResponse> {
+export type IngestJobStatus = "queued" | "parsing" | "encoding" | "upserting" | "done" | "failed";
+
+export type IngestJob = {
+  job_id: string;
+  status: IngestJobStatus;
+  collection: string;
+  source: string;
+  total_chunks: number;
+  new_chunks: number;
+  encoded_chunks: number;
+  upserted_chunks: number;
+  removed_chunks: number;
+  result: IngestResponse | null;
+  error: string | null;
+  created_at: number;
+  updated_at: number;
+};
+
+export async function startIngest(params: IngestParams): Promise<IngestJob> {
   const form = new FormData();
   form.append("file", params.file);
   if (params.collection) form.append("collection", params.collection);
   if (params.chunk_size != null) form.append("chunk_size", String(params.chunk_size));
   if (params.overlap != null) form.append("overlap", String(params.overlap));
   if (params.model_dir) form.append("model_dir", params.model_dir);
+  if (params.chunker) form.append("chunker", params.chunker);
 
   const res = await fetch(`${API_BASE}/api/ingest`, {
     method: "POST",
@@ -33,12 +56,49 @@ export async function ingestFile(params: IngestParams): Promise<IngestResponse>
   return res.json();
 }
 
+export async function getIngestJob(jobId: string): Promise<IngestJob> {
+  const res = await fetch(`${API_BASE}/api/jobs/${jobId}`);
+  if (!res.ok) {
+    const msg = await res.text();
+    throw new Error(msg || res.statusText);
+  }
+  return res.json();
+}
+
+// Upload rồi poll trạng thái job cho tới khi xong
+export async function ingestFile(
+  params: IngestParams,
+  onProgress?: (job: IngestJob) => void,
+  pollMs = 500,
+): Promise<IngestResponse> {
+  let job = await startIngest(params);
+  onProgress?.(job);
+  while (job.status !== "done" && job.status !== "failed") {
+    await new Promise((resolve) => setTimeout(resolve, pollMs));
+    job = await getIngestJob(job.job_id);
+    onProgress?.(job);
+  }
+  if (job.status === "failed" || !job.result) {
+    throw new Error(job.error || "Ingest failed");
+  }
+  return job.result;
+}
+
+// dense: embedding; lexical: BM25 only (distance = -score); hybrid: reciprocal rank fusion of both
+export type SearchMode = "dense" | "lexical" | "hybrid";
+
 export type QueryParams = {
   question: string;
   collection?: string;
   top_k?: number;
   model_dir?: string;
   use_llm?: boolean;
+  mode?: SearchMode;
+  rerank?: boolean;
+  rerank_candidates?: number;
+  sources?: string[];
+  page_from?: number;
+  page_to?: number;
 };
 
 export type QueryHit = {
@@ -48,6 +108,7 @@ export type QueryHit = {
     source?: string;
     page?: number;
     chunk_in_page?: number;
+    rerank_score?: number;
   };
   text: string;
 };
@@ -57,6 +118,16 @@ export type QueryResponse = {
   collection: string;
   results: QueryHit[];
   answer?: string | null;
+  answer_cached?: boolean;
+  rerank?: {
+    candidates: number;
+    scored: number;
+    batches: number;
+    skipped: boolean;
+    truncated: boolean;
+    ms: number;
+  } | null;
+  timings?: Record<string, number>;
 };
 
 export async function queryRag(params: QueryParams): Promise<QueryResponse> {
@@ -71,3 +142,75 @@ export async function queryRag(params: QueryParams): Promise<QueryResponse> {
   }
   return res.json();
 }
+
+export type QueryStreamHandlers = {
+  onHits?: (hits: Omit<QueryResponse, "answer">) => void;
+  onToken?: (text: string) => void;
+  onDone?: (timings: Record<string, number>) => void;
+};
+
+// POST /api/query/stream (Server-Sent Events): "hits" first, then "token" chunks, then "done" with timings.
+export async function queryRagStream(params: QueryParams, handlers: QueryStreamHandlers): Promise<string> {
+  const res = await fetch(`${API_BASE}/api/query/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(params),
+  });
+  if (!res.ok || !res.body) {
+    const msg = await res.text();
+    throw new Error(msg || res.statusText);
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let answer = "";
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let end: number;
+    while ((end = buffer.indexOf("\n\n")) >= 0) {
+      const raw = buffer.slice(0, end);
+      buffer = buffer.slice(end + 2);
+      const event = raw.match(/^event: (.*)$/m)?.[1];
+      const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] ?? "{}");
+      if (event === "hits") handlers.onHits?.(data);
+      else if (event === "token") {
+        answer += data.text;
+        handlers.onToken?.(data.text);
+      } else if (event === "done") handlers.onDone?.(data.timings);
+      else if (event === "error") throw new Error(data.detail);
+    }
+  }
+  return answer;
+}
+
+export type BatchQueryParams = {
+  questions: string[];
+  collection?: string;
+  top_k?: number;
+  model_dir?: string;
+  use_llm?: boolean;
+  mode?: SearchMode;
+  sources?: string[];
+  page_from?: number;
+  page_to?: number;
+};
+
+export type BatchQueryResponse = {
+  collection: string;
+  results: { question: string; results: QueryHit[]; answer?: string | null }[];
+};
+
+export async function queryRagBatch(params: BatchQueryParams): Promise<BatchQueryResponse> {
+  const res = await fetch(`${API_BASE}/api/query/batch`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(params),
+  });
+  if (!res.ok) {
+    const msg = await res.text();
+    throw new Error(msg || res.statusText);
+  }
+  return res.json();
+}
@@ -6,7 +6,7 @@ import { Input } from './Input';
 import { Textarea } from './Textarea';
 import { Button } from './Button';
 import { Search, FileText, TrendingUp, MessageSquare } from 'lucide-react';
-import { queryRag, QueryHit } from '../api';
+import { queryRagStream, QueryHit } from '../api';
 
 interface QueryResult {
   title: string;
@@ -34,17 +34,23 @@ export function QueryCard() {
     setError(null);
 
     try {
-      const response = await queryRag({
-        question: query,
-        collection,
-        top_k: parseInt(topK),
-        model_dir: modelDir,
-        use_llm: true
-      });
-      
-      setResults(response.results || []);
-      setAnswer(response.answer || null);
-      setSearched(true);
+      // Kết quả tìm kiếm hiện ngay, câu trả lời hiện dần theo từng đoạn
+      await queryRagStream(
+        {
+          question: query,
+          collection,
+          top_k: parseInt(topK),
+          model_dir: modelDir,
+          use_llm: true
+        },
+        {
+          onHits: (response) => {
+            setResults(response.results || []);
+            setSearched(true);
+          },
+          onToken: (text) => setAnswer((prev) => (prev ?? '') + text),
+        }
+      );
     } catch (err) {
       setError(err instanceof Error ? err.message : 'Lỗi không xác định');
     } finally {
@@ -1,14 +1,22 @@
 import argparse
+import time
 from hashlib import sha256
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Tuple
 
-from src.chunking import build_chunks
-from src.embedding import encode_texts, load_model
-from src.loaders import load_document
-from src.vectordb import get_collection, query_chunks, upsert_chunks
-from src.answerers import build_answerer
-from src.cache import load_cache, append_cache
+from src.answer_cache import ANSWER_CACHE_FILE, AnswerCache
+from src.embedding import load_model, model_fingerprint
+from src.lexical import LEXICAL_FILE, SEARCH_MODES, LexicalIndex
+from src.manifest import Manifest
+from src.pipeline import discover_files, ingest_paths, ingest_stream
+from src.query_cache import QueryCache
+from src.rerank import RERANK_FETCH, Reranker, load_reranker
+from src.retrieval import search
+from src.vectordb import STORES, VECTOR_DTYPES, get_collection, store_root, where_filter
+from src.answerers import AnswerService
+from src.context import CONTEXT_TOKENS, TokenCounter, pack_context
+from src.cache import EmbeddingStore, cache_space, migrate_jsonl
+from src.chunking import CHUNKERS
 
 
 def ingest(
@@ -21,69 +29,126 @@ def ingest(
     device: str | None,
     batch_size: int,
     cache_dir: Path,
+    engine: str = "torch",
+    onnx_variant: str = "auto",
+    cache_dtype: str = "float32",
+    cache_max_mb: int | None = None,
+    ingest_batch: int = 256,
+    resume: bool = True,
+    recursive: bool = False,
+    pattern: str = "*",
+    workers: int | None = None,
+    force: bool = False,
+    vector_store: str = "chroma",
+    vector_dtype: str = "float32",
+    lexical: LexicalIndex | None = None,
+    chunker: str = "fixed",
 ) -> Tuple[object, object]:
+    """Ingest one file, or every PDF/DOCX/TXT under a directory when file_path is a directory."""
     if not file_path.exists():
         raise FileNotFoundError(file_path)
 
-    pages = load_document(file_path)
-    raw_chunks, _, metas = build_chunks(file_path, pages, chunk_size, chunk_overlap)
-    if not raw_chunks:
-        raise ValueError("No text found to ingest.")
-
-    seen_hashes: Dict[str, bool] = {}
-    chunks: List[str] = []
-    ids: List[str] = []
-    metas_dedup: List[dict] = []
-    hashes: List[str] = []
-    for chunk, meta in zip(raw_chunks, metas):
-        h = sha256(chunk.encode("utf-8")).hexdigest()
-        if h in seen_hashes:
-            continue
-        seen_hashes[h] = True
-        chunk_id = f"sha256_{h}"
-        chunks.append(chunk)
-        ids.append(chunk_id)
-        meta_copy = dict(meta)
-        meta_copy["hash"] = h
-        metas_dedup.append(meta_copy)
-        hashes.append(h)
-
+    store = EmbeddingStore(cache_dir, max_bytes=cache_max_mb * 2**20 if cache_max_mb else None, dtype=cache_dtype)
+    space = cache_space(model_fingerprint(model_path, engine, onnx_variant), normalize=True)
+    # Cache cũ theo từng file (embeddings_<sha>.jsonl): nhập một lần vào store dùng chung
     source_key = sha256(str(file_path).encode("utf-8")).hexdigest()
-    cache_path = cache_dir / f"embeddings_{source_key}.jsonl"
-    cache = load_cache(cache_path)
-
-    missing_pairs = [(h, c) for h, c in zip(hashes, chunks) if h not in cache]
-    model = load_model(model_path, device=device)
-    if missing_pairs:
-        print(f"Encoding {len(missing_pairs)} / {len(chunks)} new chunks (batch_size={batch_size})...")
-        missing_embeddings = encode_texts(
+    legacy = cache_dir / f"embeddings_{source_key}.jsonl"
+    if file_path.is_file() and legacy.exists():
+        migrate_jsonl(legacy, store, space)
+        legacy.rename(legacy.with_name(legacy.name + ".migrated"))
+
+    model = load_model(model_path, device=device, engine=engine, onnx_variant=onnx_variant)
+    collection = get_collection(db_path, collection_name, vector_store, vector_dtype)
+    manifest = Manifest(store_root(db_path, vector_store) / "ingest_manifest.sqlite3")
+    # Store dùng chung với backend: bỏ các câu trả lời đã cache dựa trên chunk của file ingest lại
+    answers_path = store_root(db_path, vector_store) / ANSWER_CACHE_FILE
+    answers = AnswerCache(answers_path) if answers_path.exists() else None
+    if file_path.is_dir():
+        files = discover_files(file_path, recursive=recursive, pattern=pattern)
+        if not files:
+            raise ValueError(f"No PDF/DOCX/TXT files found under {file_path}")
+        stats = ingest_paths(
+            files,
             model,
-            [c for _, c in missing_pairs],
-            normalize=True,
+            collection,
+            store,
+            space,
+            manifest,
+            chunk_size,
+            chunk_overlap,
             batch_size=batch_size,
+            ingest_batch=ingest_batch,
+            workers=workers,
+            resume=resume,
+            force=force,
+            lexical=lexical,
+            answers=answers,
+            chunker=chunker,
         )
-        append_cache(cache_path, zip((h for h, _ in missing_pairs), missing_embeddings))
-        for h, emb in zip((h for h, _ in missing_pairs), missing_embeddings):
-            cache[h] = emb
     else:
+        stats = ingest_stream(
+            file_path,
+            model,
+            collection,
+            store,
+            space,
+            chunk_size,
+            chunk_overlap,
+            batch_size=batch_size,
+            ingest_batch=ingest_batch,
+            resume=resume,
+            manifest=manifest,
+            force=force,
+            lexical=lexical,
+            answers=answers,
+            chunker=chunker,
+        )
+    if stats.failed:
+        # Các file còn lại đã ingest xong; file lỗi không vào manifest nên lần sau được thử lại
+        for path, error in stats.failed:
+            print(f"Failed: {path}: {error}")
+        print(stats.report(prefix="Done with errors. "))
+        raise SystemExit(f"{len(stats.failed)} file(s) failed to ingest.")
+    if stats.files_skipped and not stats.files:
+        print("Unchanged since last ingest; nothing to do.")
+        return model, collection
+    if not stats.dedup.count:
+        raise ValueError("No text found to ingest.")
+    if not stats.encoded:
         print("All chunks reused from cache; skip encoding.")
-
-    embeddings = [cache[h] for h in hashes]
-
-    collection = get_collection(db_path, collection_name)
-    upsert_chunks(collection, ids, chunks, metas_dedup, embeddings)
-    print(f"Ingested {len(chunks)} deduped chunks into collection '{collection_name}'.")
+    print(stats.report(prefix="Done. "))
+    print(f"Ingested {stats.dedup.count} deduped chunks into collection '{collection_name}'.")
     return model, collection
 
 
-def interactive_query(model, collection, top_k: int, mode: str):
-    answerer = build_answerer(prefer_gemini=True)
+def interactive_query(
+    model,
+    collection,
+    top_k: int,
+    mode: str,
+    search_mode: str = "dense",
+    lexical: LexicalIndex | None = None,
+    reranker: Reranker | None = None,
+    rerank_candidates: int | None = None,
+    where: dict | None = None,
+    context_tokens: int = CONTEXT_TOKENS,
+    token_counter: TokenCounter | None = None,
+    llm_timeout: float = 30.0,
+):
+    answerer = AnswerService.from_env(prefer_gemini=True, timeout=llm_timeout)
+    cache = QueryCache()
+    fetch_k = (rerank_candidates or top_k * RERANK_FETCH) if reranker is not None else top_k
     while True:
         query = input("Query (blank to exit): ").strip()
         if not query:
             break
-        q_emb = encode_texts(model, [query], normalize=True)[0]
-        results = query_chunks(collection, q_emb, top_k)
+        t0 = time.perf_counter()
+        results = search(model, collection, query, fetch_k, cache, mode=search_mode, lexical=lexical, where=where)
+        timings = f"retrieve {1000 * (time.perf_counter() - t0):.1f} ms"
+        if reranker is not None:
+            results, info = reranker.rerank(query, results, top_k, started=t0)
+            timings += f" | rerank {1000 * info.seconds:.1f} ms ({info.scored}/{info.candidates} scored"
+            timings += ", budget hit)" if info.skipped or info.truncated else ")"
 
         for rank, (doc, meta, dist) in enumerate(results, start=1):
             source = meta.get("source", "") if isinstance(meta, dict) else ""
@@ -92,31 +157,78 @@ def interactive_query(model, collection, top_k: int, mode: str):
             print(f"#{rank} | dist={dist:.4f} | source={source} | page={page}\n  {preview}\n")
 
         if mode == "answer":
-            context_chunks = [doc for doc, _, _ in results if doc]
-            answer = answerer.answer(query, context_chunks)
-            print("ANSWER:\n" + answer + "\n")
+            context_chunks, packed = pack_context(results, context_tokens, token_counter)
+            timings += f" | context {packed.tokens_out}/{packed.tokens_in} tokens ({packed.tokens_in - packed.tokens_out} saved)"
+            t0 = time.perf_counter()
+            first = None
+            print("ANSWER:")
+            # In từng đoạn ngay khi model sinh ra
+            try:
+                for text in answerer.stream(query, context_chunks):
+                    if first is None:
+                        first = time.perf_counter()
+                    print(text, end="", flush=True)
+            except Exception as exc:
+                print(f"\n[answer interrupted: {exc}]", end="")
+            print("\n")
+            if first is not None:
+                timings += f" | first token {1000 * (first - t0):.1f} ms"
+            timings += f" | answer {1000 * (time.perf_counter() - t0):.1f} ms"
+        print(f"[{timings}]\n")
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Mini-RAG with ChromaDB (modular)")
-    parser.add_argument("--file", required=True, help="Path to PDF/DOCX/TXT file")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", help="Path to PDF/DOCX/TXT file")
+    source.add_argument("--path", help="Directory (or single file) to ingest; PDF/DOCX/TXT files are parsed in a process pool")
+    parser.add_argument("--recursive", action="store_true", help="With --path: descend into subdirectories")
+    parser.add_argument("--glob", default="*", help="With --path: file name pattern (e.g. '*.pdf')")
+    parser.add_argument("--workers", type=int, default=None, help="With --path: parser processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Re-ingest files even if content and chunking are unchanged")
     parser.add_argument("--model", default="all-MiniLM-L6-v2", help="Path or name of SentenceTransformer model")
     parser.add_argument("--db", default="./chroma_db", help="ChromaDB persist directory")
+    parser.add_argument("--store", choices=STORES, default="chroma", help="Vector store: chroma, numpy (exact, memory-mapped) or hnsw (approximate, needs hnswlib)")
+    parser.add_argument("--store-dtype", choices=VECTOR_DTYPES, default="float32", help="numpy store: scan float16/int8 codes, then re-rank candidates on float32")
     parser.add_argument("--collection", default="my_docs", help="Collection name")
     parser.add_argument("--chunk-size", type=int, default=800, help="Chunk size (chars)")
     parser.add_argument("--chunk-overlap", type=int, default=150, help="Chunk overlap (chars)")
+    parser.add_argument("--chunker", choices=CHUNKERS, default="fixed", help="fixed: character windows; sentence: whole sentences, split at DOCX headings, within the model's max_seq_length tokens")
     parser.add_argument("--top-k", type=int, default=3, help="Top-k results when querying")
     parser.add_argument("--device", default=None, help="Force device for SentenceTransformer (e.g., cpu or cuda)")
+    parser.add_argument("--engine", choices=["torch", "onnx"], default="torch", help="Embedding engine: torch (SentenceTransformer) or onnx (onnxruntime, CPU)")
+    parser.add_argument("--onnx-variant", default="auto", help="ONNX export to load: auto (best quantized for this CPU), fp32, or a file name in <model>/onnx")
+    parser.add_argument("--search", choices=SEARCH_MODES, default="dense", help="dense: embeddings; lexical: BM25 only (no query encoding); hybrid: both, fused by reciprocal rank")
+    parser.add_argument("--no-lexical", action="store_true", help="Do not maintain the BM25 index while ingesting (only --search dense)")
+    parser.add_argument("--rerank-model", default=None, help="Cross-encoder to re-rank retrieved chunks (path or name); off when omitted")
+    parser.add_argument("--rerank-engine", choices=["torch", "onnx"], default="torch", help="Cross-encoder engine (onnx needs <model>/onnx)")
+    parser.add_argument("--rerank-candidates", type=int, default=None, help="Chunks retrieved before re-ranking (default: top-k x 4)")
+    parser.add_argument("--rerank-batch", type=int, default=16, help="(query, chunk) pairs scored per cross-encoder call")
+    parser.add_argument("--rerank-budget-ms", type=float, default=None, help="Latency budget for retrieval + re-ranking; stop scoring once it would be exceeded")
+    parser.add_argument("--filter-source", action="append", default=None, help="Only search chunks of this file (repeatable)")
+    parser.add_argument("--page-from", type=int, default=None, help="Only search chunks from this page on")
+    parser.add_argument("--page-to", type=int, default=None, help="Only search chunks up to this page")
     parser.add_argument("--mode", choices=["retrieval", "answer"], default="retrieval", help="retrieval: show chunks; answer: synthesize answer from context")
+    parser.add_argument("--llm-timeout", type=float, default=30.0, help="--mode answer: seconds per answer before falling back to the offline answerer")
+    parser.add_argument("--context-tokens", type=int, default=CONTEXT_TOKENS, help="--mode answer: token budget of the context sent to the LLM")
     parser.add_argument("--batch-size", type=int, default=32, help="Batch size for encoding embeddings")
-    parser.add_argument("--cache-dir", default="./cache", help="Directory for embedding cache files")
+    parser.add_argument("--ingest-batch", type=int, default=256, help="Chunks held in memory per encode/upsert batch")
+    parser.add_argument("--no-resume", action="store_true", help="Re-encode and upsert chunks already present in the collection")
+    parser.add_argument("--cache-dir", default="./cache", help="Directory of the shared embedding cache")
+    parser.add_argument("--cache-max-mb", type=int, default=None, help="Evict least-recently-used cached embeddings above this size")
+    parser.add_argument("--cache-dtype", choices=["float32", "float16"], default="float32", help="Storage dtype of the embedding cache matrix")
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    file_path = Path(args.file).resolve()
+    file_path = Path(args.file or args.path).resolve()
     db_path = Path(args.db)
+    if args.no_lexical and args.search != "dense":
+        raise SystemExit("--search lexical/hybrid needs the BM25 index; drop --no-lexical")
+    if args.store_dtype != "float32" and args.store != "numpy":
+        raise SystemExit("--store-dtype float16/int8 needs --store numpy")
+    lexical = None if args.no_lexical else LexicalIndex(store_root(db_path, args.store) / LEXICAL_FILE)
 
     model, collection = ingest(
         file_path=file_path,
@@ -128,9 +240,34 @@ def main():
         device=args.device,
         batch_size=args.batch_size,
         cache_dir=Path(args.cache_dir),
+        engine=args.engine,
+        onnx_variant=args.onnx_variant,
+        cache_dtype=args.cache_dtype,
+        cache_max_mb=args.cache_max_mb,
+        ingest_batch=args.ingest_batch,
+        resume=not args.no_resume,
+        recursive=args.recursive,
+        pattern=args.glob,
+        workers=args.workers,
+        force=args.force,
+        vector_store=args.store,
+        vector_dtype=args.store_dtype,
+        lexical=lexical,
+        chunker=args.chunker,
     )
 
-    interactive_query(model, collection, args.top_k, args.mode)
+    reranker = None
+    if args.rerank_model:
+        rerank_model = load_reranker(args.rerank_model, device=args.device, engine=args.rerank_engine, onnx_variant=args.onnx_variant)
+        reranker = Reranker(rerank_model, batch_size=args.rerank_batch, budget_ms=args.rerank_budget_ms)
+
+    # Metadata "source" là đường dẫn tuyệt đối của file lúc ingest
+    sources = [str(Path(s).resolve()) for s in args.filter_source] if args.filter_source else None
+    where = where_filter(sources, args.page_from, args.page_to)
+    interactive_query(
+        model, collection, args.top_k, args.mode, args.search, lexical, reranker, args.rerank_candidates, where,
+        args.context_tokens, TokenCounter(args.model if Path(args.model).is_dir() else None), args.llm_timeout,
+    )
 
 
 if __name__ == "__main__":
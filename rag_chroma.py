@@ -7,7 +7,8 @@ from chromadb import PersistentClient
 from chromadb.config import Settings
 from docx import Document
 from pypdf import PdfReader
-from sentence_transformers import SentenceTransformer
+
+from src.embedding import load_model
 
 
 def load_text_with_pages(file_path: Path) -> List[Tuple[int, str]]:
@@ -102,9 +103,9 @@ def ingest(args):
     if not all_chunks:
         raise ValueError("No text found to ingest.")
 
-    model = SentenceTransformer(str(args.model), device=args.device)
+    model = load_model(args.model, device=args.device, engine=args.engine)
     documents = [chunk for _, chunk, _ in all_chunks]
-    embeddings = model.encode(documents, normalize_embeddings=True).tolist()
+    embeddings = model.encode(documents, normalize_embeddings=True)
 
     ids = [cid for cid, _, _ in all_chunks]
     metadatas = [
@@ -129,9 +130,9 @@ def interactive_query(model, collection, top_k: int):
         query = input("Query (blank to exit): ").strip()
         if not query:
             break
-        q_emb = model.encode([query], normalize_embeddings=True).tolist()[0]
+        q_emb = model.encode([query], normalize_embeddings=True)[0]
         result = collection.query(
-            query_embeddings=[q_emb],
+            query_embeddings=q_emb[None, :],
             n_results=top_k,
             include=["documents", "metadatas", "distances"],
         )
@@ -158,6 +159,7 @@ def main():
     parser.add_argument("--chunk-overlap", type=int, default=150, help="Chunk overlap (chars)")
     parser.add_argument("--top-k", type=int, default=3, help="Top-k results when querying")
     parser.add_argument("--device", default=None, help="Force device for SentenceTransformer (e.g., cpu or cuda)")
+    parser.add_argument("--engine", choices=["torch", "onnx"], default="torch", help="Embedding engine: torch or onnx (CPU)")
 
     args = parser.parse_args()
 
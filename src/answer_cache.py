@@ -0,0 +1,217 @@
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Iterable, List, Sequence
+
+import numpy as np
+
+from src.query_cache import normalize_question
+
+
+ANSWER_CACHE_FILE = "answer_cache.sqlite3"  # nằm trong store_root cạnh manifest
+BATCH = 500
+
+
+def text_hash(text: str) -> str:
+    """Content hash of a chunk, the same sha256 the ingest pipeline uses for chunk ids."""
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_set_key(hashes: Iterable[str]) -> str:
+    return sha256("\n".join(sorted(set(hashes))).encode("ascii")).hexdigest()
+
+
+class AnswerCache:
+    """Generated answers keyed by (question embedding, set of retrieved chunk hashes), persisted in SQLite.
+
+    A lookup hits when an entry was answered from exactly the same chunks (same collection and
+    ``variant``, i.e. answerer/model/context budget) and its question embedding has cosine
+    similarity >= ``threshold`` with the new one; questions without an embedding (lexical search)
+    must match after normalization. Ingest calls ``invalidate`` with the hashes of every chunk it
+    deleted or re-wrote, which drops the entries built on them. At most ``max_entries`` entries are
+    kept, least recently used evicted first; entries older than ``ttl`` seconds are misses.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 10000, threshold: float = 0.95, ttl: float | None = None) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.evicted = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, chunk_set TEXT NOT NULL,
+                variant TEXT NOT NULL, question TEXT NOT NULL, embedding BLOB, answer TEXT NOT NULL,
+                created REAL NOT NULL, used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS answers_by_set ON answers (collection, chunk_set, variant);
+            CREATE INDEX IF NOT EXISTS answers_by_used ON answers (used);
+            CREATE TABLE IF NOT EXISTS answer_chunks (
+                collection TEXT NOT NULL, hash TEXT NOT NULL, answer INTEGER NOT NULL,
+                PRIMARY KEY (collection, hash, answer)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS answer_chunks_by_answer ON answer_chunks (answer);
+            """
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, fn: Callable[[], object]):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return out
+
+    def _delete(self, ids: Sequence[int]) -> None:
+        for start in range(0, len(ids), BATCH):
+            part = ids[start : start + BATCH]
+            marks = ",".join("?" * len(part))
+            self._conn.execute(f"DELETE FROM answers WHERE id IN ({marks})", part)
+            self._conn.execute(f"DELETE FROM answer_chunks WHERE answer IN ({marks})", part)
+
+    def lookup(
+        self,
+        collection: str,
+        variant: str,
+        chunk_hashes: Iterable[str],
+        question: str,
+        embedding: np.ndarray | None = None,
+    ) -> str | None:
+        """The stored answer of the most similar matching question, or None (counted as a miss)."""
+        key = chunk_set_key(chunk_hashes)
+        question = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, question, embedding, answer, created FROM answers WHERE collection = ? AND chunk_set = ? AND variant = ?",
+                (collection, key, variant),
+            ).fetchall()
+        expired = [row[0] for row in rows if self.ttl is not None and now - row[4] > self.ttl]
+        best, best_sim = None, -1.0
+        query = None
+        if embedding is not None:
+            query = np.asarray(embedding, dtype=np.float32).ravel()
+            query = query / (np.linalg.norm(query) or 1.0)
+        for entry_id, stored_question, blob, answer, created in rows:
+            if entry_id in expired:
+                continue
+            if stored_question == question:
+                sim = 1.0
+            elif query is not None and blob is not None:
+                stored = np.frombuffer(blob, dtype=np.float32)
+                if stored.shape != query.shape:
+                    continue
+                sim = float(stored @ query) / (float(np.linalg.norm(stored)) or 1.0)
+            else:
+                continue
+            if sim >= self.threshold and sim > best_sim:
+                best, best_sim = (entry_id, answer), sim
+        if expired:
+            self._write(lambda: self._delete(expired))
+        with self._lock:
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE answers SET used = ? WHERE id = ?", (now, best[0]))
+        return best[1]
+
+    def put(
+        self,
+        collection: str,
+        variant: str,
+        chunk_hashes: Iterable[str],
+        question: str,
+        embedding: np.ndarray | None,
+        answer: str,
+    ) -> None:
+        if self.max_entries <= 0:
+            return
+        hashes = sorted(set(chunk_hashes))
+        blob = None if embedding is None else np.asarray(embedding, dtype=np.float32).ravel().tobytes()
+        now = time.time()
+
+        def write() -> None:
+            entry_id = self._conn.execute(
+                "INSERT INTO answers (collection, chunk_set, variant, question, embedding, answer, created, used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (collection, chunk_set_key(hashes), variant, normalize_question(question), blob, answer, now, now),
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO answer_chunks (collection, hash, answer) VALUES (?, ?, ?)",
+                [(collection, h, entry_id) for h in hashes],
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+            if count > self.max_entries:
+                old = [i for (i,) in self._conn.execute("SELECT id FROM answers ORDER BY used LIMIT ?", (count - self.max_entries,))]
+                self._delete(old)
+                self.evicted += len(old)
+
+        self._write(write)
+
+    def invalidate(self, collection: str, chunk_hashes: Iterable[str]) -> int:
+        """Drop the entries answered from any of these chunks; returns how many were dropped."""
+        hashes = list(set(chunk_hashes))
+        if not hashes:
+            return 0
+
+        def write() -> int:
+            ids: set = set()
+            for start in range(0, len(hashes), BATCH):
+                part = hashes[start : start + BATCH]
+                marks = ",".join("?" * len(part))
+                ids.update(
+                    i
+                    for (i,) in self._conn.execute(
+                        f"SELECT answer FROM answer_chunks WHERE collection = ? AND hash IN ({marks})", (collection, *part)
+                    )
+                )
+            self._delete(sorted(ids))
+            return len(ids)
+
+        dropped = self._write(write)
+        self.invalidated += dropped
+        return dropped
+
+    def drop(self, collection: str) -> int:
+        def write() -> int:
+            ids: List[int] = [i for (i,) in self._conn.execute("SELECT id FROM answers WHERE collection = ?", (collection,))]
+            self._delete(ids)
+            return len(ids)
+
+        dropped = self._write(write)
+        self.invalidated += dropped
+        return dropped
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "invalidated": self.invalidated,
+            "evicted": self.evicted,
+        }
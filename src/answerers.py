@@ -1,11 +1,40 @@
 import os
-from typing import List, Sequence
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Deque, Iterator, List, Sequence
+
+import numpy as np
+
+
+NO_CONTEXT = "Không đủ dữ liệu trong CONTEXT để trả lời."
+TIMING_SAMPLES = 1024
+# Lỗi tạm thời (quá tải, hết quota theo phút, lỗi gateway) thì thử lại; lỗi khác fallback ngay
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+STOP_POLL_S = 0.25  # stream đang chờ chunk kiểm tra ``stop`` mỗi khoảng này
+
+
+def build_prompt(query: str, context_chunks: Sequence[str]) -> str:
+    context = "\n\n".join(context_chunks)
+    return (
+        "Chỉ dùng thông tin trong CONTEXT; nếu thiếu thì nói không đủ dữ liệu.\n"
+        "CONTEXT:\n" + context + "\n\nCÂU HỎI: " + query
+    )
 
 
 class DummyAnswerer:
+    """Offline answerer. ``token_delay`` (seconds per streamed word) makes it behave like a slow model."""
+
+    def __init__(self, token_delay: float = 0.0) -> None:
+        self.token_delay = token_delay
+
     def answer(self, query: str, context_chunks: Sequence[str]) -> str:
         if not context_chunks:
-            return "Không đủ dữ liệu trong CONTEXT để trả lời."
+            return NO_CONTEXT
         # Simple offline heuristic: echo key chunks and remind constraints
         joined = " \n".join(context_chunks)
         return (
@@ -13,44 +42,328 @@ class DummyAnswerer:
             f"Câu hỏi: {query}\n\nTóm tắt: {joined[:1200]}"
         )
 
+    def stream(self, query: str, context_chunks: Sequence[str]) -> Iterator[str]:
+        for word in re.findall(r"\S+\s*|\s+", self.answer(query, context_chunks)):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield word
+
 
 class GeminiAnswerer:
-    def __init__(self) -> None:
+    """``endpoint`` (or ``GEMINI_ENDPOINT``) sends requests over REST to another host, e.g. a local
+    stub server standing in for the API."""
+
+    def __init__(self, endpoint: str | None = None) -> None:
         self._client = None
         self._model_name = "gemini-1.5-flash"
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             return
+        endpoint = endpoint or os.getenv("GEMINI_ENDPOINT")
         try:
             import google.generativeai as genai  # type: ignore
 
-            genai.configure(api_key=api_key)
+            if endpoint:
+                genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+            else:
+                genai.configure(api_key=api_key)
             self._client = genai.GenerativeModel(self._model_name)
         except Exception:
             self._client = None
 
+    def complete(self, prompt: str, timeout: float | None = None) -> str:
+        """One request; errors propagate (``AnswerService`` retries and falls back)."""
+        options = {"timeout": timeout} if timeout else None
+        resp = self._client.generate_content(prompt, request_options=options)
+        return getattr(resp, "text", None) or "".join(getattr(resp, "candidates", []) or [])
+
+    def complete_stream(self, prompt: str, timeout: float | None = None) -> Iterator[str]:
+        options = {"timeout": timeout} if timeout else None
+        for part in self._client.generate_content(prompt, stream=True, request_options=options):
+            text = getattr(part, "text", None)
+            if text:
+                yield text
+
     def answer(self, query: str, context_chunks: Sequence[str]) -> str:
         if not context_chunks:
-            return "Không đủ dữ liệu trong CONTEXT để trả lời."
+            return NO_CONTEXT
         if not self._client:
             return DummyAnswerer().answer(query, context_chunks)
 
-        context = "\n\n".join(context_chunks)
-        prompt = (
-            "Chỉ dùng thông tin trong CONTEXT; nếu thiếu thì nói không đủ dữ liệu.\n"
-            "CONTEXT:\n" + context + "\n\nCÂU HỎI: " + query
-        )
         try:
-            resp = self._client.generate_content(prompt)
-            text = getattr(resp, "text", None) or "".join(getattr(resp, "candidates", []) or [])
+            text = self.complete(build_prompt(query, context_chunks))
             return text or DummyAnswerer().answer(query, context_chunks)
         except Exception:
             return DummyAnswerer().answer(query, context_chunks)
 
+    def stream(self, query: str, context_chunks: Sequence[str]) -> Iterator[str]:
+        if not context_chunks:
+            yield NO_CONTEXT
+            return
+        if not self._client:
+            yield from DummyAnswerer().stream(query, context_chunks)
+            return
+        sent = False
+        try:
+            for text in self.complete_stream(build_prompt(query, context_chunks)):
+                sent = True
+                yield text
+        except Exception:
+            # Lỗi giữa chừng: phần đã gửi không rút lại được, chỉ fallback khi chưa gửi gì
+            if sent:
+                return
+        if not sent:
+            yield from DummyAnswerer().stream(query, context_chunks)
+
+
+class AnswerStats:
+    """Time to first token and total generation time of recent answers."""
+
+    def __init__(self) -> None:
+        self.answers = 0
+        self.streamed = 0
+        self.ttft: Deque[float] = deque(maxlen=TIMING_SAMPLES)
+        self.total: Deque[float] = deque(maxlen=TIMING_SAMPLES)
+        self._lock = threading.Lock()
+
+    def record(self, ttft_s: float | None, total_s: float, streamed: bool) -> None:
+        with self._lock:
+            self.answers += 1
+            self.streamed += streamed
+            if ttft_s is not None:
+                self.ttft.append(ttft_s)
+            self.total.append(total_s)
+
+    @staticmethod
+    def _summary(samples: List[float]) -> dict:
+        if not samples:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+        p50, p95, p99 = (float(v) for v in np.percentile(np.asarray(samples) * 1000, [50, 95, 99]))
+        return {"p50": p50, "p95": p95, "p99": p99}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            ttft, total = list(self.ttft), list(self.total)
+        return {
+            "answers": self.answers,
+            "streamed": self.streamed,
+            "ttft_ms": self._summary(ttft),
+            "total_ms": self._summary(total),
+        }
+
+
+def is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    # google.api_core.exceptions.* và urllib.error.HTTPError đều có ``code`` là HTTP status
+    code = getattr(exc, "code", None)
+    try:
+        return int(code) in TRANSIENT_STATUS
+    except (TypeError, ValueError):
+        return False
+
+
+class AnswerService:
+    """Long-lived answerer: one LLM client for the whole process, at most ``max_concurrency`` calls
+    in flight, each answer bounded by ``timeout`` seconds, transient errors retried with
+    exponential backoff (``backoff``, 2x, ...) within that deadline.
+
+    ``client`` is anything with ``complete(prompt, timeout)`` and ``complete_stream(prompt, timeout)``
+    (default: ``GeminiAnswerer`` when an API key is configured). Without a client, or once the
+    deadline passes or errors are not transient, the answer comes from ``fallback``
+    (``DummyAnswerer``); ``outcome`` (a dict passed by the caller) then gets ``fallback=True``. Calls run on the service's own threads, so a call still hanging after its
+    deadline keeps its slot until it returns.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        timeout: float = 30.0,
+        max_concurrency: int = 4,
+        retries: int = 2,
+        backoff: float = 0.5,
+        fallback=None,
+    ) -> None:
+        self.client = client
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.fallback = fallback or build_answerer(prefer_gemini=False)
+        self.name = getattr(client, "_model_name", None) or type(client or self.fallback).__name__
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.in_flight = 0
+
+    @classmethod
+    def from_env(cls, prefer_gemini: bool = True, **kwargs) -> "AnswerService":
+        client = GeminiAnswerer() if prefer_gemini else None
+        return cls(client if getattr(client, "_client", None) else None, **kwargs)
+
+    def _count(self, field: str, n: int = 1) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def _submit(self, fn, *args):
+        """Run ``fn`` on a free slot; the slot is released when the call returns, not at the deadline."""
+        self._count("in_flight")
+
+        def done(_) -> None:
+            self._count("in_flight", -1)
+            self._slots.release()
+
+        fut = self._executor.submit(fn, *args)
+        fut.add_done_callback(done)
+        return fut
+
+    def _attempts(self, deadline: float) -> Iterator[float]:
+        """Seconds left for each attempt; sleeps the backoff between attempts."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retried")
+                time.sleep(max(0.0, min(self.backoff * 2 ** (attempt - 1), deadline - time.monotonic())))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+                self._count("timeouts")
+                return
+            yield deadline - time.monotonic()
+
+    def answer(self, query: str, context_chunks: Sequence[str], outcome: dict | None = None) -> str:
+        if not context_chunks:
+            return NO_CONTEXT
+        if self.client is None:
+            return self.fallback.answer(query, context_chunks)
+        self._count("calls")
+        prompt = build_prompt(query, context_chunks)
+        deadline = time.monotonic() + self.timeout
+        for remaining in self._attempts(deadline):
+            fut = self._submit(self.client.complete, prompt, remaining)
+            try:
+                text = fut.result(timeout=max(remaining, 0.0))
+            except FutureTimeout:
+                self._count("timeouts")
+                break
+            except Exception as exc:
+                self._count("errors")
+                if not is_transient(exc):
+                    break
+                continue
+            if text:
+                return text
+            break
+        self._count("fallbacks")
+        if outcome is not None:
+            outcome["fallback"] = True
+        return self.fallback.answer(query, context_chunks)
+
+    def stream(
+        self,
+        query: str,
+        context_chunks: Sequence[str],
+        outcome: dict | None = None,
+        stop: threading.Event | None = None,
+    ) -> Iterator[str]:
+        """Like ``answer``, chunk by chunk, the whole stream within ``timeout``. Retries and fallback
+        only happen before the first chunk; after it, the deadline or an error is raised to the caller.
+
+        Setting ``stop`` (or closing the generator) ends the call early: the LLM response is dropped
+        at its next chunk, which frees the slot without waiting for the deadline."""
+        if not context_chunks:
+            yield NO_CONTEXT
+            return
+        if self.client is None:
+            yield from self.fallback.stream(query, context_chunks)
+            return
+        self._count("calls")
+        prompt = build_prompt(query, context_chunks)
+        deadline = time.monotonic() + self.timeout
+        stop = stop or threading.Event()
+        try:
+            yield from self._stream_attempts(query, context_chunks, prompt, deadline, outcome, stop)
+        finally:
+            stop.set()
+
+    def _stream_attempts(
+        self,
+        query: str,
+        context_chunks: Sequence[str],
+        prompt: str,
+        deadline: float,
+        outcome: dict | None,
+        stop: threading.Event,
+    ) -> Iterator[str]:
+        for remaining in self._attempts(deadline):
+            chunks: "queue.Queue" = queue.Queue()
+
+            def pump(timeout: float) -> None:
+                try:
+                    parts = self.client.complete_stream(prompt, timeout)
+                    for text in parts:
+                        if stop.is_set():
+                            # Không ai đọc nữa (client ngắt): bỏ phần còn lại của response
+                            getattr(parts, "close", lambda: None)()
+                            break
+                        chunks.put(("text", text))
+                    chunks.put(("end", None))
+                except BaseException as exc:
+                    chunks.put(("error", exc))
+
+            self._submit(pump, remaining)
+            sent = False
+            while True:
+                if stop.is_set():
+                    return
+                try:
+                    kind, value = chunks.get(timeout=min(max(deadline - time.monotonic(), 0.0), STOP_POLL_S))
+                except queue.Empty:
+                    if time.monotonic() < deadline:
+                        continue
+                    self._count("timeouts")
+                    if sent:
+                        raise TimeoutError(f"LLM stream exceeded {self.timeout:.0f} s")
+                    kind, value = "timeout", None
+                if kind == "text":
+                    sent = True
+                    yield value
+                    continue
+                if kind == "end" and sent:
+                    return
+                if kind == "error":
+                    self._count("errors")
+                    if sent:
+                        raise value
+                break
+            if kind == "error" and is_transient(value):
+                continue
+            break
+        self._count("fallbacks")
+        if outcome is not None:
+            outcome["fallback"] = True
+        yield from self.fallback.stream(query, context_chunks)
+
+    def stats(self) -> dict:
+        return {
+            "client": self.name,
+            "timeout_s": self.timeout,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "retried": self.retried,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+        }
+
 
 def build_answerer(prefer_gemini: bool = True):
     if prefer_gemini:
         ans = GeminiAnswerer()
         if getattr(ans, "_client", None):
             return ans
-    return DummyAnswerer()
+    return DummyAnswerer(token_delay=float(os.getenv("DUMMY_TOKEN_DELAY_MS", "0")) / 1000)
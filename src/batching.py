@@ -0,0 +1,130 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Deque, Dict, List, Sequence
+
+import numpy as np
+
+
+DELAY_SAMPLES = 4096  # số mẫu queue delay gần nhất giữ lại để tính percentile
+
+
+class BatchStats:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes: Dict[int, int] = {}
+        self.queue_delays: Deque[float] = deque(maxlen=DELAY_SAMPLES)
+        self.encode_seconds = 0.0
+
+    def record(self, size: int, delays: List[float], encode_s: float) -> None:
+        self.requests += size
+        self.batches += 1
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+        self.queue_delays.extend(delays)
+        self.encode_seconds += encode_s
+
+    def to_dict(self) -> dict:
+        delays_ms = np.asarray(self.queue_delays) * 1000
+        if len(delays_ms):
+            p50, p95, p99 = (float(v) for v in np.percentile(delays_ms, [50, 95, 99]))
+        else:
+            p50 = p95 = p99 = 0.0
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "errors": self.errors,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+            "queue_delay_ms": {"p50": p50, "p95": p95, "p99": p99},
+            "mean_encode_ms": 1000 * self.encode_seconds / self.batches if self.batches else 0.0,
+        }
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-text encode calls into one batched model call.
+
+    Requests arriving within ``window_ms`` of the first queued one (or until ``max_batch``)
+    are encoded together; while a batch is encoding, new requests queue up for the next one.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], np.ndarray],
+        window_ms: float = 3.0,
+        max_batch: int = 32,
+        executor: Executor | None = None,
+    ) -> None:
+        self.encode_fn = encode_fn
+        self.window = max(window_ms, 0.0) / 1000
+        self.max_batch = max(max_batch, 1)
+        self.executor = executor
+        self.stats = BatchStats()
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def encode(self, text: str) -> np.ndarray:
+        self._ensure_started()
+        future = self._loop.create_future()
+        self._queue.put_nowait((text, future, time.perf_counter()))
+        return await future
+
+    async def encode_many(self, texts: Sequence[str]) -> List[np.ndarray]:
+        return list(await asyncio.gather(*(self.encode(t) for t in texts)))
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.window
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            # Bỏ các request đã bị huỷ (client ngắt kết nối) trước khi encode
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            delays = [started - queued_at for _, _, queued_at in batch]
+            try:
+                emb = await self._loop.run_in_executor(self.executor, self.encode_fn, [t for t, _, _ in batch])
+            except Exception as exc:
+                self.stats.errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            self.stats.record(len(batch), delays, time.perf_counter() - started)
+            for i, (_, future, _) in enumerate(batch):
+                if not future.done():
+                    future.set_result(emb[i])
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
@@ -0,0 +1,915 @@
+# Hướng dẫn: python -m src.bench encode --model models/all-MiniLM-L6-v2 --file data/your_file.docx
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from src.cache import EmbeddingStore, append_cache, load_cache, migrate_jsonl
+from src.chunking import CHUNKERS, build_chunks, get_chunker, model_token_limits
+from src.embedding import load_model
+from src.loaders import load_document
+
+
+def _sample_texts(file_path: Path | None, limit: int) -> List[str]:
+    if file_path is not None:
+        chunks, _, _ = build_chunks(file_path, load_document(file_path), 800, 150)
+        if chunks:
+            return chunks[:limit]
+    base = [
+        "Chủ nghĩa xã hội khoa học nghiên cứu các quy luật chính trị - xã hội.",
+        "Thời kỳ quá độ lên chủ nghĩa xã hội là thời kỳ cải biến cách mạng sâu sắc.",
+        "The quick brown fox jumps over the lazy dog.",
+    ]
+    return [base[i % len(base)] + f" ({i})" for i in range(limit)]
+
+
+def _time_encode(model, texts: List[str], batch_size: int, repeat: int) -> tuple:
+    model.encode(texts[:batch_size], batch_size=batch_size, normalize_embeddings=True)  # warm-up
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+        best = min(best, time.perf_counter() - t0)
+    return np.asarray(out, dtype=np.float32), best
+
+
+def bench_encode(args) -> int:
+    texts = _sample_texts(Path(args.file) if args.file else None, args.limit)
+    torch_model = load_model(args.model, engine="torch")
+    ref, torch_s = _time_encode(torch_model, texts, args.batch_size, args.repeat)
+    print(f"torch: {len(texts)} chunks in {torch_s:.3f}s ({1000 * torch_s / len(texts):.2f} ms/chunk)")
+
+    ok = True
+    for variant in args.variants:
+        onnx_model = load_model(args.model, engine="onnx", onnx_variant=variant)
+        emb, onnx_s = _time_encode(onnx_model, texts, args.batch_size, args.repeat)
+        cos = np.sum(ref * emb, axis=1)
+        print(
+            f"onnx[{onnx_model.model_path.name}]: {onnx_s:.3f}s ({1000 * onnx_s / len(texts):.2f} ms/chunk, "
+            f"x{torch_s / onnx_s:.1f}) | cosine vs torch min={cos.min():.4f} mean={cos.mean():.4f}"
+        )
+        threshold = args.fp32_tol if variant == "fp32" else args.quant_tol
+        if cos.min() < threshold:
+            print(f"  PARITY FAIL: min cosine {cos.min():.4f} < {threshold}")
+            ok = False
+    return 0 if ok else 1
+
+
+def _fake_hashes(n: int, seed: int = 0) -> List[str]:
+    rng = np.random.default_rng(seed)
+    return [row.tobytes().hex() for row in rng.integers(0, 256, size=(n, 32), dtype=np.uint8)]
+
+
+def bench_cache(args) -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="cache_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        hashes = _fake_hashes(args.rows)
+        space = "bench-norm"
+        store = EmbeddingStore(tmp / "store", dtype=args.dtype)
+        t0 = time.perf_counter()
+        for start in range(0, args.rows, 65536):
+            block = rng.standard_normal((min(65536, args.rows - start), args.dim), dtype=np.float32)
+            store.put_many(space, hashes[start : start + len(block)], block)
+        write_s = time.perf_counter() - t0
+        store.close()
+
+        t0 = time.perf_counter()
+        store = EmbeddingStore(tmp / "store", dtype=args.dtype)
+        load_s = time.perf_counter() - t0
+        sample = [hashes[i] for i in rng.integers(0, args.rows, size=args.lookups)]
+        t0 = time.perf_counter()
+        store.get_many(space, sample)
+        lookup_s = time.perf_counter() - t0
+        disk = sum(f.stat().st_size for f in (tmp / "store").iterdir())
+        print(
+            f"store[{args.dtype}]: {args.rows} x {args.dim} | write {write_s:.2f}s | open {load_s:.3f}s | "
+            f"{args.lookups} lookups {1e6 * lookup_s / args.lookups:.2f} us/vec | disk {disk / 2**20:.1f} MiB"
+        )
+        store.close()
+
+        # JSONL cũ: đo trên tập nhỏ hơn rồi ngoại suy tuyến tính
+        n = min(args.rows, args.jsonl_rows)
+        jsonl = tmp / "legacy.jsonl"
+        append_cache(jsonl, zip(hashes[:n], rng.standard_normal((n, args.dim)).tolist()))
+        t0 = time.perf_counter()
+        load_cache(jsonl)
+        jsonl_s = time.perf_counter() - t0
+        print(
+            f"jsonl: {n} rows load {jsonl_s:.2f}s (~{jsonl_s * args.rows / n:.1f}s extrapolated to {args.rows}) | "
+            f"disk {jsonl.stat().st_size / 2**20:.1f} MiB"
+        )
+        t0 = time.perf_counter()
+        migrate_jsonl(jsonl, EmbeddingStore(tmp / "migrated", dtype=args.dtype), space)
+        print(f"migrate jsonl -> store: {time.perf_counter() - t0:.2f}s for {n} rows")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def _percentiles(samples: List[float]) -> str:
+    if not samples:
+        return "no samples"
+    ms = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return f"n={len(ms)} p50 {p50:.1f}ms p95 {p95:.1f}ms p99 {p99:.1f}ms"
+
+
+def _post_json(url: str, payload: dict, timeout: float = 120) -> dict:
+    req = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+
+def _post_file(url: str, path: Path, fields: dict) -> dict:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{path.name}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode()
+    )
+    body = b"".join(parts) + path.read_bytes() + f"\r\n--{boundary}--\r\n".encode()
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(req, timeout=600) as resp:
+        return json.loads(resp.read())
+
+
+def _query_load(url: str, payload: dict, concurrency: int, stop: threading.Event, count: int | None) -> List[float]:
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    issued = [0]
+
+    def worker() -> None:
+        while not stop.is_set():
+            with lock:
+                if count is not None and issued[0] >= count:
+                    return
+                issued[0] += 1
+            t0 = time.perf_counter()
+            try:
+                _post_json(url, payload)
+            except Exception as exc:
+                with lock:
+                    errors.append(str(exc))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        print(f"  {len(errors)} failed requests, first: {errors[0]}")
+    return latencies
+
+
+def bench_api_load(args) -> int:
+    base = args.url.rstrip("/")
+    payload = {"question": args.question, "collection": args.collection, "top_k": args.top_k, "use_llm": False}
+
+    baseline = _query_load(f"{base}/api/query", payload, args.concurrency, threading.Event(), args.requests)
+    print(f"query (idle):   {_percentiles(baseline)}")
+    if not args.file:
+        return 0
+
+    # Query liên tục trong lúc một job ingest chạy nền; job xong thì dừng
+    stop = threading.Event()
+    during: List[float] = []
+    loader = threading.Thread(
+        target=lambda: during.extend(_query_load(f"{base}/api/query", payload, args.concurrency, stop, None)),
+        daemon=True,
+    )
+    t0 = time.perf_counter()
+    job = _post_file(
+        f"{base}/api/ingest",
+        Path(args.file),
+        {"collection": args.collection, "chunk_size": args.chunk_size, "overlap": args.overlap},
+    )
+    accept_s = time.perf_counter() - t0
+    loader.start()
+    status = job
+    while status.get("status") not in ("done", "failed"):
+        time.sleep(args.poll)
+        with urllib.request.urlopen(f"{base}/api/jobs/{job['job_id']}", timeout=30) as resp:
+            status = json.loads(resp.read())
+    ingest_s = time.perf_counter() - t0
+    stop.set()
+    loader.join()
+    print(
+        f"ingest job {status['status']}: accepted in {accept_s * 1000:.0f}ms, finished in {ingest_s:.1f}s, "
+        f"{status['upserted_chunks']}/{status['total_chunks']} chunks upserted"
+    )
+    print(f"query (ingest): {_percentiles(during)}")
+    if status["status"] == "failed":
+        print(f"  error: {status['error']}")
+        return 1
+    return 0
+
+
+def bench_query_batch(args) -> int:
+    base = args.url.rstrip("/")
+    # Câu hỏi khác nhau mỗi lần chạy để không trúng query cache
+    tag = uuid.uuid4().hex[:8]
+    questions = [f"{args.question} #{tag}-{i}" for i in range(args.questions)]
+    common = {"collection": args.collection, "top_k": args.top_k, "use_llm": False}
+
+    t0 = time.perf_counter()
+    for q in questions[: args.single]:
+        _post_json(f"{base}/api/query", {**common, "question": q + "-single"})
+    single_s = (time.perf_counter() - t0) / max(args.single, 1)
+
+    t0 = time.perf_counter()
+    result = _post_json(f"{base}/api/query/batch", {**common, "questions": questions}, timeout=600)
+    batch_s = time.perf_counter() - t0
+    print(f"single: {1000 * single_s:.1f} ms/question ({args.single} sequential requests)")
+    print(
+        f"batch:  {1000 * batch_s / len(questions):.2f} ms/question ({len(result['results'])} questions in {batch_s:.2f}s) "
+        f"-> {single_s * len(questions) / batch_s:.1f}x"
+    )
+    return 0
+
+
+def bench_collections(args) -> int:
+    from chromadb import PersistentClient
+
+    from src.vectordb import CollectionRegistry
+
+    tmp = Path(tempfile.mkdtemp(prefix="coll_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        registry = CollectionRegistry(tmp)
+        coll = registry.get("bench")
+        emb = rng.standard_normal((args.rows, args.dim), dtype=np.float32)
+        emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+        for start in range(0, args.rows, 5000):
+            part = range(start, min(start + 5000, args.rows))
+            coll.upsert(
+                ids=[str(i) for i in part],
+                embeddings=emb[start : part.stop],
+                documents=[f"doc {i}" for i in part],
+            )
+        queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+        def fresh(q):
+            # Như backend cũ: client mới + get_or_create_collection mỗi request
+            c = PersistentClient(path=str(tmp)).get_or_create_collection(name="bench")
+            return c.query(query_embeddings=q[None, :], n_results=args.top_k)
+
+        def pooled(q):
+            return registry.call("bench", lambda c: c.query(query_embeddings=q[None, :], n_results=args.top_k))
+
+        for name, fn in (("per-request client", fresh), ("registry", pooled)):
+            latencies = []
+            for q in queries:
+                t0 = time.perf_counter()
+                fn(q)
+                latencies.append(time.perf_counter() - t0)
+            print(f"{name:>18}: {_percentiles(latencies)}")
+        registry.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def _clustered(rng, rows: int, dim: int, per_cluster: int = 50) -> np.ndarray:
+    # Vector ngẫu nhiên đều trong 384 chiều gần như cách đều nhau (ANN nào cũng tệ); embedding thật thì gom cụm
+    centers = rng.standard_normal((max(rows // per_cluster, 1), dim), dtype=np.float32)
+    emb = centers[rng.integers(0, len(centers), size=rows)] + 0.6 * rng.standard_normal((rows, dim), dtype=np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    return emb
+
+
+def bench_stores(args) -> int:
+    from src.vectordb import get_collection
+
+    tmp = Path(tempfile.mkdtemp(prefix="store_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        emb = _clustered(rng, args.rows, args.dim)
+        queries = emb[rng.integers(0, args.rows, size=args.queries)] + 0.02 * rng.standard_normal(
+            (args.queries, args.dim), dtype=np.float32
+        )
+        ids = [str(i) for i in range(args.rows)]
+        exact: List[List[str]] = []
+        for store in args.stores:
+            coll = get_collection(tmp / store, "bench", store)
+            t0 = time.perf_counter()
+            for start in range(0, args.rows, 5000):
+                end = min(start + 5000, args.rows)
+                coll.upsert(ids=ids[start:end], embeddings=emb[start:end], documents=[f"doc {i}" for i in range(start, end)])
+            build_s = time.perf_counter() - t0
+            latencies = []
+            found: List[List[str]] = []
+            for q in queries:
+                t0 = time.perf_counter()
+                res = coll.query(query_embeddings=q[None, :], n_results=args.top_k)
+                latencies.append(time.perf_counter() - t0)
+                found.append(res["ids"][0])
+            line = f"{store:>7}: build {build_s:.1f}s | {_percentiles(latencies)}"
+            if store == "numpy":
+                exact = found
+            elif exact:
+                recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(exact, found)])
+                line += f" | recall@{args.top_k} vs numpy {recall:.3f}"
+            print(line)
+            if hasattr(coll, "close"):
+                coll.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def bench_filter(args) -> int:
+    from src.vectordb import get_collection, where_filter
+
+    tmp = Path(tempfile.mkdtemp(prefix="filter_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        emb = _clustered(rng, args.rows, args.dim)
+        ids = [str(i) for i in range(args.rows)]
+        metas = [{"source": f"doc{i // args.doc_rows}.pdf", "page": (i % args.doc_rows) // 10} for i in range(args.rows)]
+        target = rng.integers(0, args.rows // args.doc_rows)
+        one = np.arange(target * args.doc_rows, min((target + 1) * args.doc_rows, args.rows))
+        where = where_filter([f"doc{target}.pdf"])
+        queries = emb[rng.choice(one, size=args.queries)] + 0.02 * rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        print(f"{args.rows} chunks, {args.doc_rows} per document; filtered to doc{target}.pdf ({len(one)} chunks)")
+        for store in args.stores:
+            big = get_collection(tmp / store, "bench-all", store)
+            small = get_collection(tmp / store, "bench-one", store)
+            for start in range(0, args.rows, 5000):
+                end = min(start + 5000, args.rows)
+                big.upsert(ids=ids[start:end], embeddings=emb[start:end], documents=[""] * (end - start), metadatas=metas[start:end])
+            small.upsert(
+                ids=[ids[i] for i in one], embeddings=emb[one], documents=[""] * len(one), metadatas=[metas[i] for i in one]
+            )
+            runs = [("unfiltered", big, None), ("filtered", big, where), ("one-doc", small, None)]
+            found: Dict[str, List[List[str]]] = {}
+            for label, coll, cond in runs:
+                extra = {"where": cond} if cond else {}
+                coll.query(query_embeddings=queries[:1], n_results=args.top_k, **extra)  # warm-up (index, cache bộ lọc)
+                latencies = []
+                found[label] = []
+                for q in queries:
+                    t0 = time.perf_counter()
+                    found[label].append(coll.query(query_embeddings=q[None, :], n_results=args.top_k, **extra)["ids"][0])
+                    latencies.append(time.perf_counter() - t0)
+                print(f"{store:>7} {label:>10}: {_percentiles(latencies)}")
+            same = np.mean([a == b for a, b in zip(found["filtered"], found["one-doc"])])
+            print(f"{store:>7}: filtered == one-doc results for {100 * same:.1f}% of queries")
+            for coll in (big, small):
+                if hasattr(coll, "close"):
+                    coll.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def bench_quant(args) -> int:
+    from src.vectordb import get_collection
+
+    tmp = Path(tempfile.mkdtemp(prefix="quant_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        emb = _clustered(rng, args.rows, args.dim)
+        queries = emb[rng.integers(0, args.rows, size=args.queries)] + 0.02 * rng.standard_normal(
+            (args.queries, args.dim), dtype=np.float32
+        )
+        ids = [str(i) for i in range(args.rows)]
+        coll = get_collection(tmp, "bench", "numpy")
+        for start in range(0, args.rows, 5000):
+            end = min(start + 5000, args.rows)
+            coll.upsert(ids=ids[start:end], embeddings=emb[start:end], documents=[""] * (end - start))
+        coll.close()
+
+        exact: List[List[str]] = []
+        for dtype in ["float32"] + [d for d in args.dtypes if d != "float32"]:
+            for rerank in [1] if dtype == "float32" else args.rerank:
+                coll = get_collection(tmp, "bench", "numpy", dtype)
+                coll.rerank = rerank
+                latencies = []
+                found: List[List[str]] = []
+                for q in queries:
+                    t0 = time.perf_counter()
+                    found.append(coll.query(query_embeddings=q[None, :], n_results=args.top_k)["ids"][0])
+                    latencies.append(time.perf_counter() - t0)
+                scanned = args.rows * args.dim * np.dtype(dtype).itemsize
+                if dtype == "float32":
+                    exact = found
+                    full = scanned
+                recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(exact, found)])
+                print(
+                    f"{dtype:>7} rerank x{rerank}: scanned {scanned / 2**20:.1f} MiB ({full / scanned:.1f}x less) | "
+                    f"{_percentiles(latencies)} | recall@{args.top_k} {recall:.4f}"
+                )
+                coll.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def _peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _memory_child(args) -> dict:
+    from src.vectordb import get_collection, query_chunks, upsert_chunks
+
+    tmp = Path(tempfile.mkdtemp(prefix="memory_bench_"))
+    rng = np.random.default_rng(0)
+    legacy = args.child == "legacy"
+    try:
+        coll = get_collection(tmp, "bench", args.store)
+        base_rss = _peak_rss_mb()
+        t0 = time.perf_counter()
+        # Giống pipeline: encode cả tài liệu rồi ghi theo lô; legacy = .tolist() rồi list(...) như trước
+        emb = _clustered(rng, args.rows, args.dim)
+        if legacy:
+            emb = emb.tolist()
+        for start in range(0, args.rows, args.batch):
+            end = min(start + args.batch, args.rows)
+            ids = [str(i) for i in range(start, end)]
+            docs = [""] * (end - start)
+            metas = [{"page": i} for i in range(start, end)]
+            if legacy:
+                coll.upsert(ids=ids, documents=docs, metadatas=metas, embeddings=list(emb[start:end]))
+            else:
+                upsert_chunks(coll, ids, docs, metas, emb[start:end])
+        ingest_s = time.perf_counter() - t0
+        queries = _clustered(rng, args.queries, args.dim)
+        t0 = time.perf_counter()
+        for q in queries:
+            if legacy:
+                coll.query(query_embeddings=[list(q.tolist())], n_results=args.top_k)
+            else:
+                query_chunks(coll, q, args.top_k)
+        query_s = time.perf_counter() - t0
+        peak = _peak_rss_mb()
+        if hasattr(coll, "close"):
+            coll.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        "mode": args.child,
+        "ingest_rows_per_s": args.rows / ingest_s,
+        "query_ms": 1000 * query_s / max(args.queries, 1),
+        "peak_rss_mb": peak,
+        "peak_rss_delta_mb": None if peak is None else peak - base_rss,
+    }
+
+
+def bench_memory(args) -> int:
+    if args.child:
+        print(json.dumps(_memory_child(args)))
+        return 0
+    # Mỗi chế độ chạy trong tiến trình riêng để peak RSS không lẫn nhau
+    results = []
+    for mode in ("legacy", "array"):
+        cmd = [sys.executable, "-m", "src.bench", "memory", "--child", mode, "--store", args.store]
+        cmd += ["--rows", str(args.rows), "--dim", str(args.dim), "--batch", str(args.batch)]
+        cmd += ["--queries", str(args.queries), "--top-k", str(args.top_k)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    for r in results:
+        rss = "n/a" if r["peak_rss_mb"] is None else f"peak {r['peak_rss_mb']:.0f} MiB (+{r['peak_rss_delta_mb']:.0f} MiB)"
+        print(
+            f"{r['mode']:>6} [{args.store}]: ingest {r['ingest_rows_per_s']:.0f} rows/s | "
+            f"query {r['query_ms']:.2f} ms | {rss}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    return 0
+
+
+def _term_corpus(rng, n_docs: int, words: int = 120) -> List[str]:
+    # Văn bản giả: từ theo phân bố Zipf + số hiệu riêng "điều <i>" như văn bản pháp luật
+    syllables = ["quy", "định", "luật", "điều", "khoản", "nghị", "thông", "tư", "bộ", "giáo", "dục", "học", "sinh", "nhà", "nước"]
+    vocab = [f"{syllables[i % len(syllables)]}{i}" for i in range(5000)]
+    ranks = np.minimum(rng.zipf(1.3, size=(n_docs, words)), len(vocab)) - 1
+    return [f"Điều {i}. " + " ".join(vocab[r] for r in row) for i, row in enumerate(ranks)]
+
+
+def bench_lexical(args) -> int:
+    from src.lexical import LexicalIndex, tokenize
+
+    tmp = Path(tempfile.mkdtemp(prefix="lexical_bench_"))
+    rng = np.random.default_rng(0)
+    try:
+        if args.file:
+            texts, _, _ = build_chunks(Path(args.file), load_document(Path(args.file)), 800, 150)
+        else:
+            texts = _term_corpus(rng, args.docs)
+        ids = [str(i) for i in range(len(texts))]
+        index = LexicalIndex(tmp / "lexical.sqlite3")
+        t0 = time.perf_counter()
+        for start in range(0, len(texts), 256):
+            index.add("bench", ids[start : start + 256], texts[start : start + 256])
+        build_s = time.perf_counter() - t0
+        disk = sum(f.stat().st_size for f in tmp.iterdir())
+        print(f"index: {len(texts)} docs in {build_s:.2f}s ({len(texts) / build_s:.0f} docs/s) | disk {disk / 2**20:.1f} MiB")
+
+        # Câu hỏi kiểu tra cứu: vài token lấy đúng từ một chunk, chunk đó là đáp án
+        targets = rng.integers(0, len(texts), size=args.queries)
+        queries = []
+        for t in targets:
+            tokens = tokenize(texts[t])
+            picks = rng.choice(len(tokens), size=min(args.terms, len(tokens)), replace=False)
+            queries.append(" ".join(tokens[:2] + [tokens[p] for p in picks]))
+        latencies = []
+        found = 0
+        for q, t in zip(queries, targets):
+            t0 = time.perf_counter()
+            hits = index.search("bench", q, args.top_k)
+            latencies.append(time.perf_counter() - t0)
+            found += ids[t] in {doc_id for doc_id, _ in hits}
+        print(f" bm25: {_percentiles(latencies)} | hit@{args.top_k} {found / len(queries):.3f}")
+
+        if args.model:
+            from src.vectordb import get_collection, query_records_batch
+
+            model = load_model(args.model)
+            coll = get_collection(tmp / "db", "bench", "numpy")
+            emb = np.asarray(model.encode(texts, batch_size=64, normalize_embeddings=True), dtype=np.float32)
+            coll.upsert(ids=ids, embeddings=emb, documents=texts)
+            latencies = []
+            found = 0
+            for q, t in zip(queries, targets):
+                t0 = time.perf_counter()
+                q_emb = np.asarray(model.encode([q], normalize_embeddings=True), dtype=np.float32)
+                records = query_records_batch(coll, q_emb, args.top_k)[0]
+                latencies.append(time.perf_counter() - t0)
+                found += ids[t] in {r[0] for r in records}
+            print(f"dense: {_percentiles(latencies)} | hit@{args.top_k} {found / len(queries):.3f} (encode + exact search)")
+            coll.close()
+        index.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 0
+
+
+def bench_rerank(args) -> int:
+    from src.rerank import Reranker, load_reranker
+
+    texts = _sample_texts(Path(args.file) if args.file else None, max(args.candidates))
+    hits = [(t, {}, float(i)) for i, t in enumerate(texts)]
+    for engine in args.engines:
+        model = load_reranker(args.model, engine=engine, onnx_variant=args.onnx_variant)
+        model.predict([("warm up", texts[0])])
+        for n in args.candidates:
+            for batch_size in args.batch_sizes:
+                reranker = Reranker(model, batch_size=batch_size)
+                latencies = []
+                for _ in range(args.repeat):
+                    _, info = reranker.rerank(args.question, hits[:n], args.top_k)
+                    latencies.append(info.seconds)
+                print(f"{engine:>5} | {n:>3} candidates | batch {batch_size:>3}: {_percentiles(latencies)}")
+    return 0
+
+
+def bench_chunker(args) -> int:
+    """Chunks/s and chunk sizes per chunker on the same parsed pages; ``over_limit`` counts chunks
+    the encoder would truncate at the model's max_seq_length."""
+    if args.file:
+        pages = load_document(Path(args.file))
+    else:
+        rng = np.random.default_rng(0)
+        pages = [(i + 1, text) for i, text in enumerate(_term_corpus(rng, args.pages, words=600))]
+    chars = sum(len(text) for _, text in pages)
+    limits = model_token_limits(load_model(args.model, engine=args.engine))
+    max_tokens, counter = limits
+    results = {}
+    for name in args.chunkers:
+        split = get_chunker(name, args.chunk_size, args.chunk_overlap, limits)
+        best = float("inf")
+        chunks: List[str] = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            chunks = [c for _, text in pages for c in split(text)]
+            best = min(best, time.perf_counter() - t0)
+        tokens = np.asarray([counter.count(c) for c in chunks] or [0])
+        lengths = np.asarray([len(c) for c in chunks] or [0])
+        results[name] = {
+            "chunks": len(chunks),
+            "seconds": best,
+            "chunks_per_s": len(chunks) / best if best else None,
+            "mb_per_s": chars / 2**20 / best if best else None,
+            "mean_chars": float(lengths.mean()),
+            "mean_tokens": float(tokens.mean()),
+            "max_tokens": int(tokens.max()),
+            "over_limit": int((tokens > max_tokens).sum()),
+        }
+        r = results[name]
+        print(
+            f"{name:>8}: {r['chunks']} chunks in {best:.3f}s ({r['chunks_per_s']:.0f} chunks/s, {r['mb_per_s']:.1f} MB/s) | "
+            f"mean {r['mean_chars']:.0f} chars / {r['mean_tokens']:.0f} tokens | max {r['max_tokens']} tokens | "
+            f"{r['over_limit']} over {max_tokens}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    return 0
+
+
+def _latency_summary(samples: List[float]) -> dict:
+    ms = np.asarray(samples) * 1000 if samples else np.zeros(1)
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"n": len(samples), "mean_ms": float(ms.mean()), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def bench_retrieval(args) -> int:
+    from src.cache import cache_space
+    from src.embedding import model_fingerprint
+    from src.evaluation import load_labelled_queries, recall_at_k, reciprocal_rank
+    from src.lexical import LEXICAL_FILE, LexicalIndex
+    from src.manifest import Manifest
+    from src.pipeline import discover_files, ingest_paths
+    from src.retrieval import search, search_batch
+    from src.vectordb import get_collection, store_root
+
+    corpus = Path(args.corpus)
+    files = discover_files(corpus, recursive=True) if corpus.is_dir() else [corpus]
+    if not files:
+        raise SystemExit(f"No PDF/DOCX/TXT files under {corpus}")
+    queries = load_labelled_queries(Path(args.queries))
+    if not queries:
+        raise SystemExit(f"No questions in {args.queries}")
+    ks = sorted(set(args.ks))
+    tmp = Path(tempfile.mkdtemp(prefix="retrieval_bench_"))
+    try:
+        t0 = time.perf_counter()
+        model = load_model(args.model, engine=args.engine)
+        model_s = time.perf_counter() - t0
+        # Cache embedding mới (trống) mặc định, để đo cả thời gian encode
+        store = EmbeddingStore(Path(args.cache_dir) if args.cache_dir else tmp / "cache")
+        space = cache_space(model_fingerprint(args.model, args.engine), normalize=True)
+        collection = get_collection(tmp / "db", "bench", args.store)
+        root = store_root(tmp / "db", args.store)
+        manifest = Manifest(root / "ingest_manifest.sqlite3")
+        lexical = LexicalIndex(root / LEXICAL_FILE) if args.search != "dense" else None
+        stats = ingest_paths(
+            files, model, collection, store, space, manifest, args.chunk_size, args.chunk_overlap,
+            batch_size=args.batch_size, workers=args.workers, verbose=False, lexical=lexical,
+            chunker=args.chunker,
+        )
+        wall = time.perf_counter() - stats.started
+        ingest = {
+            "files": stats.files,
+            "failed": len(stats.failed),
+            "pages": stats.parse.count,
+            "chunks": stats.dedup.count,
+            "encoded": stats.encoded,
+            "parse_s": stats.parse.seconds,
+            "encode_s": stats.encode.seconds,
+            "upsert_s": stats.upsert.seconds,
+            "wall_s": wall,
+            "pages_per_s": stats.parse.count / wall if wall else None,
+            "chunks_per_s": stats.dedup.count / wall if wall else None,
+        }
+        print(stats.report(prefix="ingest: "))
+
+        questions = [q.question for q in queries]
+        max_k = max(ks)
+        search(model, collection, questions[0], max_k, mode=args.search, lexical=lexical)  # warm-up
+        single: List[float] = []
+        ranked = []
+        for _ in range(args.repeat):
+            ranked = []
+            for q in questions:
+                t0 = time.perf_counter()
+                ranked.append(search(model, collection, q, max_k, mode=args.search, lexical=lexical))
+                single.append(time.perf_counter() - t0)
+        batched: List[float] = []
+        for _ in range(args.repeat):
+            for start in range(0, len(questions), args.query_batch):
+                part = questions[start : start + args.query_batch]
+                t0 = time.perf_counter()
+                search_batch(model, collection, part, max_k, batch_size=args.query_batch, mode=args.search, lexical=lexical)
+                batched.append(time.perf_counter() - t0)
+        batched_total = sum(batched)
+
+        matches = [q.matches(hits) for q, hits in zip(queries, ranked)]
+        labelled = [(m, q.n_relevant) for m, q in zip(matches, queries) if q.n_relevant]
+        quality = {
+            "labelled": len(labelled),
+            "recall": {str(k): float(np.mean([recall_at_k(m, n, k) for m, n in labelled])) if labelled else None for k in ks},
+            "mrr": float(np.mean([reciprocal_rank(m, max_k) for m, _ in labelled])) if labelled else None,
+        }
+        result = {
+            "label": args.label,
+            "revision": _git_revision(),
+            "config": {
+                "corpus": str(corpus),
+                "model": str(args.model),
+                "engine": args.engine,
+                "store": args.store,
+                "search": args.search,
+                "chunk_size": args.chunk_size,
+                "chunk_overlap": args.chunk_overlap,
+                "chunker": args.chunker,
+                "queries": len(queries),
+                "query_batch": args.query_batch,
+            },
+            "model_load_s": model_s,
+            "ingest": ingest,
+            "query": {
+                "single": _latency_summary(single),
+                "batched": {
+                    **_latency_summary(batched),
+                    "per_query_ms": 1000 * batched_total / (len(questions) * args.repeat),
+                },
+            },
+            "quality": quality,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+        if hasattr(collection, "close"):
+            collection.close()
+        if lexical is not None:
+            lexical.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mini-RAG benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    enc = sub.add_parser("encode", help="Encode latency and parity: PyTorch vs ONNX Runtime")
+    enc.add_argument("--model", default="models/all-MiniLM-L6-v2", help="Local SentenceTransformer directory")
+    enc.add_argument("--file", default=None, help="Optional PDF/DOCX/TXT to sample chunks from")
+    enc.add_argument("--limit", type=int, default=256, help="Number of chunks to encode")
+    enc.add_argument("--batch-size", type=int, default=32)
+    enc.add_argument("--repeat", type=int, default=3)
+    enc.add_argument("--variants", nargs="+", default=["fp32", "auto"], help="ONNX variants to compare")
+    enc.add_argument("--fp32-tol", type=float, default=0.9999, help="Min cosine vs torch for fp32 export")
+    enc.add_argument("--quant-tol", type=float, default=0.98, help="Min cosine vs torch for quantized exports")
+    enc.set_defaults(func=bench_encode)
+
+    cache = sub.add_parser("cache", help="Embedding cache open/lookup time: shared store vs legacy JSONL")
+    cache.add_argument("--rows", type=int, default=1_000_000)
+    cache.add_argument("--dim", type=int, default=384)
+    cache.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    cache.add_argument("--lookups", type=int, default=10_000)
+    cache.add_argument("--jsonl-rows", type=int, default=20_000, help="Rows written for the JSONL baseline")
+    cache.set_defaults(func=bench_cache)
+
+    load = sub.add_parser("api-load", help="/api/query latency under load, idle and while an ingest job runs")
+    load.add_argument("--url", default="http://127.0.0.1:8000")
+    load.add_argument("--collection", default="my_docs")
+    load.add_argument("--question", default="What is this document about?")
+    load.add_argument("--top-k", type=int, default=5)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--requests", type=int, default=200, help="Queries for the idle baseline")
+    load.add_argument("--file", default=None, help="File to ingest while measuring (skipped if omitted)")
+    load.add_argument("--chunk-size", type=int, default=800)
+    load.add_argument("--overlap", type=int, default=150)
+    load.add_argument("--poll", type=float, default=0.5, help="Job status poll interval (s)")
+    load.set_defaults(func=bench_api_load)
+
+    qb = sub.add_parser("query-batch", help="/api/query one question at a time vs /api/query/batch")
+    qb.add_argument("--url", default="http://127.0.0.1:8000")
+    qb.add_argument("--collection", default="my_docs")
+    qb.add_argument("--question", default="What is this document about?")
+    qb.add_argument("--questions", type=int, default=1000, help="Questions sent in the batch request")
+    qb.add_argument("--single", type=int, default=100, help="Sequential single requests to time (extrapolated)")
+    qb.add_argument("--top-k", type=int, default=5)
+    qb.set_defaults(func=bench_query_batch)
+
+    colls = sub.add_parser("collections", help="Query latency: new Chroma client per request vs pooled collection handles")
+    colls.add_argument("--rows", type=int, default=20_000)
+    colls.add_argument("--dim", type=int, default=384)
+    colls.add_argument("--queries", type=int, default=300)
+    colls.add_argument("--top-k", type=int, default=5)
+    colls.set_defaults(func=bench_collections)
+
+    stores = sub.add_parser("stores", help="Query latency and recall: chroma vs numpy (exact) vs hnsw")
+    stores.add_argument("--rows", type=int, default=100_000)
+    stores.add_argument("--dim", type=int, default=384)
+    stores.add_argument("--queries", type=int, default=200)
+    stores.add_argument("--top-k", type=int, default=5)
+    stores.add_argument("--stores", nargs="+", default=["numpy", "hnsw", "chroma"], help="numpy first: it is the recall reference")
+    stores.set_defaults(func=bench_stores)
+
+    filt = sub.add_parser("filter", help="Filtered query on one document of a large collection vs a collection of only that document")
+    filt.add_argument("--rows", type=int, default=200_000)
+    filt.add_argument("--doc-rows", type=int, default=500, help="Chunks per synthetic document")
+    filt.add_argument("--dim", type=int, default=384)
+    filt.add_argument("--queries", type=int, default=200)
+    filt.add_argument("--top-k", type=int, default=5)
+    filt.add_argument("--stores", nargs="+", default=["numpy", "hnsw", "chroma"])
+    filt.set_defaults(func=bench_filter)
+
+    quant = sub.add_parser("quant", help="numpy store: float32 vs float16/int8 scan + exact re-rank (memory, latency, recall)")
+    quant.add_argument("--rows", type=int, default=100_000)
+    quant.add_argument("--dim", type=int, default=384)
+    quant.add_argument("--queries", type=int, default=200)
+    quant.add_argument("--top-k", type=int, default=10)
+    quant.add_argument("--dtypes", nargs="+", default=["float16", "int8"])
+    quant.add_argument("--rerank", type=int, nargs="+", default=[1, 2, 4], help="Candidate multipliers to compare")
+    quant.set_defaults(func=bench_quant)
+
+    lex = sub.add_parser("lexical", help="BM25 index build rate, query latency and exact-term hit rate (vs dense with --model)")
+    lex.add_argument("--file", default=None, help="Chunk this document instead of generating a synthetic corpus")
+    lex.add_argument("--docs", type=int, default=50_000, help="Synthetic corpus size")
+    lex.add_argument("--queries", type=int, default=500)
+    lex.add_argument("--terms", type=int, default=2, help="Extra tokens sampled from the target chunk per query")
+    lex.add_argument("--top-k", type=int, default=5)
+    lex.add_argument("--model", default=None, help="Also time encode + dense search with this model")
+    lex.set_defaults(func=bench_lexical)
+
+    rr = sub.add_parser("rerank", help="Cross-encoder re-ranking latency by candidate count, batch size and engine")
+    rr.add_argument("--model", required=True, help="Cross-encoder directory or name")
+    rr.add_argument("--engines", nargs="+", choices=["torch", "onnx"], default=["torch"])
+    rr.add_argument("--onnx-variant", default="auto")
+    rr.add_argument("--file", default=None, help="Use chunks of this document as candidates")
+    rr.add_argument("--question", default="Thời kỳ quá độ lên chủ nghĩa xã hội là gì?")
+    rr.add_argument("--candidates", type=int, nargs="+", default=[10, 20, 50])
+    rr.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32])
+    rr.add_argument("--top-k", type=int, default=5)
+    rr.add_argument("--repeat", type=int, default=10)
+    rr.set_defaults(func=bench_rerank)
+
+    chunk = sub.add_parser("chunker", help="Chunking throughput and chunk token lengths: fixed windows vs sentence chunker")
+    chunk.add_argument("--file", default=None, help="PDF/DOCX/TXT to chunk (default: synthetic pages)")
+    chunk.add_argument("--pages", type=int, default=500, help="Synthetic pages without --file")
+    chunk.add_argument("--model", default="models/all-MiniLM-L6-v2", help="Encoder whose tokenizer and max_seq_length bound the chunks")
+    chunk.add_argument("--engine", choices=["torch", "onnx"], default="torch")
+    chunk.add_argument("--chunkers", nargs="+", choices=CHUNKERS, default=list(CHUNKERS))
+    chunk.add_argument("--chunk-size", type=int, default=800)
+    chunk.add_argument("--chunk-overlap", type=int, default=150)
+    chunk.add_argument("--repeat", type=int, default=3)
+    chunk.add_argument("--output", default=None, help="Write results as JSON")
+    chunk.set_defaults(func=bench_chunker)
+
+    ret = sub.add_parser("retrieval", help="End-to-end: ingest throughput, query latency (single/batched), recall@k/MRR, peak RSS as JSON")
+    ret.add_argument("--corpus", default="data", help="Directory (searched recursively) or single PDF/DOCX/TXT file")
+    ret.add_argument("--queries", required=True, help='JSONL: {"question": ..., "source": ..., "page": ...} (see src/evaluation.py)')
+    ret.add_argument("--model", required=True)
+    ret.add_argument("--engine", choices=["torch", "onnx"], default="torch")
+    ret.add_argument("--store", choices=["chroma", "numpy", "hnsw"], default="chroma")
+    ret.add_argument("--search", choices=["dense", "lexical", "hybrid"], default="dense")
+    ret.add_argument("--chunk-size", type=int, default=800)
+    ret.add_argument("--chunk-overlap", type=int, default=150)
+    ret.add_argument("--chunker", choices=CHUNKERS, default="fixed")
+    ret.add_argument("--batch-size", type=int, default=32, help="Encode batch size while ingesting")
+    ret.add_argument("--workers", type=int, default=None, help="Parser processes")
+    ret.add_argument("--cache-dir", default=None, help="Embedding cache to reuse (default: a fresh one, so encoding is measured)")
+    ret.add_argument("--ks", type=int, nargs="+", default=[1, 3, 5, 10], help="k values for recall@k (MRR uses the largest)")
+    ret.add_argument("--query-batch", type=int, default=32, help="Questions per search_batch call")
+    ret.add_argument("--repeat", type=int, default=3, help="Passes over the question set when timing queries")
+    ret.add_argument("--label", default=None, help="Free-form tag stored in the JSON (e.g. branch name)")
+    ret.add_argument("--output", default=None, help="Write the JSON result to this file")
+    ret.set_defaults(func=bench_retrieval)
+
+    mem = sub.add_parser("memory", help="Peak RSS and throughput: embeddings as Python lists vs float32 arrays")
+    mem.add_argument("--store", choices=["chroma", "numpy", "hnsw"], default="numpy")
+    mem.add_argument("--rows", type=int, default=100_000)
+    mem.add_argument("--dim", type=int, default=384)
+    mem.add_argument("--batch", type=int, default=128, help="Upsert batch size (backend INGEST_BATCH)")
+    mem.add_argument("--queries", type=int, default=200)
+    mem.add_argument("--top-k", type=int, default=5)
+    mem.add_argument("--output", type=Path, default=None, help="Write results as JSON")
+    mem.add_argument("--child", choices=["legacy", "array"], default=None, help=argparse.SUPPRESS)
+    mem.set_defaults(func=bench_memory)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
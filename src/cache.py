@@ -1,6 +1,18 @@
 import json
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Iterable, Tuple, Sequence
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from src.embedding import encode_texts
+
+
+DIGEST_BYTES = 32  # sha256
+LOOKUP_BATCH = 500  # giữ số tham số SQL dưới giới hạn của SQLite
+TOUCH_INTERVAL = 60.0  # chỉ cập nhật last_used (LRU) khi cũ hơn chừng này giây
 
 
 def load_cache(cache_path: Path) -> Dict[str, Sequence[float]]:
@@ -26,3 +38,331 @@ def append_cache(cache_path: Path, entries: Iterable[Tuple[str, Sequence[float]]
         for h, emb in entries:
             rec = {"hash": h, "embedding": emb}
             f.write(json.dumps(rec) + "\n")
+
+
+def cache_space(fingerprint: str, normalize: bool) -> str:
+    return f"{fingerprint}-{'norm' if normalize else 'raw'}"
+
+
+class _Space:
+    def __init__(self, root: Path, name: str, dim: int, dtype: str) -> None:
+        self.name = name
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+        self.vec_path = root / f"{safe}.vec"
+        self.keys_path = root / f"{safe}.keys"
+        self.row_bytes = dim * self.dtype.itemsize
+        self._vec: np.memmap | None = None
+        self._keys: np.memmap | None = None
+
+    def capacity(self) -> int:
+        if not self.keys_path.exists():
+            return 0
+        return min(self.keys_path.stat().st_size // DIGEST_BYTES, self.vec_path.stat().st_size // self.row_bytes)
+
+    def maps(self, need_rows: int, writable: bool = False) -> Tuple[np.memmap, np.memmap]:
+        mapped = 0 if self._vec is None else self._vec.shape[0]
+        if self._vec is None or mapped < need_rows or (writable and self._vec.mode != "r+"):
+            self.close()
+            cap = self.capacity()
+            mode = "r+" if writable else "r"
+            self._vec = np.memmap(self.vec_path, dtype=self.dtype, mode=mode, shape=(cap, self.dim))
+            self._keys = np.memmap(self.keys_path, dtype=f"V{DIGEST_BYTES}", mode=mode, shape=(cap,))
+        return self._vec, self._keys
+
+    def grow(self, rows: int) -> None:
+        cap = self.capacity()
+        if rows <= cap:
+            return
+        new_cap = max(rows, cap * 2, 4096)
+        self.close()
+        for path, width in ((self.vec_path, self.row_bytes), (self.keys_path, DIGEST_BYTES)):
+            with path.open("ab") as f:
+                f.truncate(new_cap * width)
+
+    def close(self) -> None:
+        for mm in (self._vec, self._keys):
+            if mm is not None and mm.mode == "r+":
+                mm.flush()
+        self._vec = None
+        self._keys = None
+
+
+class EmbeddingStore:
+    """Content-addressed embedding cache shared by every file, model and process.
+
+    Keys are (space, sha256 of chunk text) where the space is ``cache_space(model fingerprint,
+    normalize)``. The index lives in SQLite (WAL mode, so several ingest processes can read
+    and write at once); vectors live in one memory-mapped matrix per space with a parallel
+    digest column that readers re-check, so a row recycled by eviction is never misread.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        dtype: str = "float32",
+    ) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._spaces: Dict[str, _Space] = {}
+        self._conn = sqlite3.connect(str(self.root / "index.sqlite3"), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS spaces (
+                space TEXT PRIMARY KEY, dim INTEGER NOT NULL, dtype TEXT NOT NULL, next_row INTEGER NOT NULL DEFAULT 0,
+                n_entries INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                space TEXT NOT NULL, hash BLOB NOT NULL, row INTEGER NOT NULL, last_used REAL NOT NULL,
+                PRIMARY KEY (space, hash)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS free_rows (
+                space TEXT NOT NULL, row INTEGER NOT NULL, PRIMARY KEY (space, row)
+            ) WITHOUT ROWID;
+            """
+        )
+        self._migrate()
+
+    def _migrate(self) -> None:
+        # Store tạo trước khi có cột n_entries: thêm cột rồi đếm một lần
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(spaces)")}
+        if "n_entries" in columns:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(spaces)")}
+            if "n_entries" not in columns:
+                self._conn.execute("ALTER TABLE spaces ADD COLUMN n_entries INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute(
+                    "UPDATE spaces SET n_entries = (SELECT COUNT(*) FROM entries WHERE entries.space = spaces.space)"
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self) -> None:
+        with self._lock:
+            for sp in self._spaces.values():
+                sp.close()
+            self._conn.close()
+
+    def _space(self, space: str, dim: int | None = None) -> _Space | None:
+        sp = self._spaces.get(space)
+        if sp is not None:
+            return sp
+        row = self._conn.execute("SELECT dim, dtype FROM spaces WHERE space = ?", (space,)).fetchone()
+        if row is None:
+            if dim is None:
+                return None
+            self._conn.execute("INSERT OR IGNORE INTO spaces (space, dim, dtype) VALUES (?, ?, ?)", (space, dim, self.dtype))
+            row = self._conn.execute("SELECT dim, dtype FROM spaces WHERE space = ?", (space,)).fetchone()
+        sp = _Space(self.root, space, int(row[0]), row[1])
+        self._spaces[space] = sp
+        return sp
+
+    def _lookup(self, space: str, digests: Sequence[bytes]) -> Dict[bytes, Tuple[int, float]]:
+        found: Dict[bytes, Tuple[int, float]] = {}
+        for start in range(0, len(digests), LOOKUP_BATCH):
+            part = digests[start : start + LOOKUP_BATCH]
+            marks = ",".join("?" * len(part))
+            for h, row, used in self._conn.execute(
+                f"SELECT hash, row, last_used FROM entries WHERE space = ? AND hash IN ({marks})", (space, *part)
+            ):
+                found[bytes(h)] = (row, used)
+        return found
+
+    def get_many(self, space: str, hashes: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (embeddings float32 [n, dim], found mask [n]); rows for misses are zero."""
+        with self._lock:
+            sp = self._space(space)
+            if sp is None or not hashes:
+                return np.zeros((len(hashes), sp.dim if sp else 0), dtype=np.float32), np.zeros(len(hashes), dtype=bool)
+            digests = [bytes.fromhex(h) for h in hashes]
+            found = self._lookup(space, digests)
+            rows = np.asarray([found.get(d, (-1, 0.0))[0] for d in digests], dtype=np.int64)
+            mask = rows >= 0
+            out = np.zeros((len(hashes), sp.dim), dtype=np.float32)
+            if mask.any():
+                vec, keys = sp.maps(int(rows.max()) + 1)
+                hit_rows = rows[mask]
+                expected = np.frombuffer(b"".join(d for d, m in zip(digests, mask) if m), dtype=f"V{DIGEST_BYTES}")
+                before = keys[hit_rows] == expected
+                data = np.asarray(vec[hit_rows], dtype=np.float32)
+                valid = before & (keys[hit_rows] == expected)
+                out[np.flatnonzero(mask)[valid]] = data[valid]
+                mask[np.flatnonzero(mask)[~valid]] = False
+            now = time.time()
+            stale = [d for d in digests if d in found and found[d][1] < now - TOUCH_INTERVAL]
+            if stale:
+                self._touch(space, stale, now)
+            return out, mask
+
+    def _touch(self, space: str, digests: List[bytes], now: float) -> None:
+        for start in range(0, len(digests), LOOKUP_BATCH):
+            part = digests[start : start + LOOKUP_BATCH]
+            marks = ",".join("?" * len(part))
+            self._conn.execute(f"UPDATE entries SET last_used = ? WHERE space = ? AND hash IN ({marks})", (now, space, *part))
+
+    def put_many(self, space: str, hashes: Sequence[str], embeddings) -> int:
+        emb = np.asarray(embeddings, dtype=np.float32)
+        if emb.ndim != 2 or len(hashes) != emb.shape[0]:
+            raise ValueError("hashes and embeddings must have the same length")
+        if not hashes:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                sp = self._space(space, dim=int(emb.shape[1]))
+                if emb.shape[1] != sp.dim:
+                    raise ValueError(f"Embedding dim {emb.shape[1]} != cache dim {sp.dim} for space {space}")
+                digests = [bytes.fromhex(h) for h in hashes]
+                existing = self._lookup(space, digests)
+                keep: List[int] = []
+                new_digests: List[bytes] = []
+                seen = set(existing)
+                for i, d in enumerate(digests):
+                    if d in seen:
+                        continue
+                    seen.add(d)
+                    keep.append(i)
+                    new_digests.append(d)
+                if not keep:
+                    self._conn.execute("COMMIT")
+                    return 0
+
+                rows = [r for (r,) in self._conn.execute(
+                    "SELECT row FROM free_rows WHERE space = ? ORDER BY row LIMIT ?", (space, len(keep))
+                )]
+                if rows:
+                    self._conn.execute(
+                        f"DELETE FROM free_rows WHERE space = ? AND row IN ({','.join('?' * len(rows))})", (space, *rows)
+                    )
+                (next_row,) = self._conn.execute("SELECT next_row FROM spaces WHERE space = ?", (space,)).fetchone()
+                fresh = len(keep) - len(rows)
+                rows.extend(range(next_row, next_row + fresh))
+                self._conn.execute(
+                    "UPDATE spaces SET next_row = ?, n_entries = n_entries + ? WHERE space = ?",
+                    (next_row + fresh, len(keep), space),
+                )
+
+                row_arr = np.asarray(rows, dtype=np.int64)
+                sp.grow(int(row_arr.max()) + 1)
+                vec, keys = sp.maps(int(row_arr.max()) + 1, writable=True)
+                # Xoá digest trước, ghi vector, rồi mới ghi digest mới: reader luôn kiểm tra digest hai lần
+                keys[row_arr] = np.zeros(1, dtype=f"V{DIGEST_BYTES}")
+                keys.flush()
+                vec[row_arr] = emb[keep].astype(sp.dtype)
+                vec.flush()
+                keys[row_arr] = np.frombuffer(b"".join(new_digests), dtype=f"V{DIGEST_BYTES}")
+                keys.flush()
+
+                now = time.time()
+                self._conn.executemany(
+                    "INSERT INTO entries (space, hash, row, last_used) VALUES (?, ?, ?, ?)",
+                    [(space, d, int(r), now) for d, r in zip(new_digests, rows)],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                self._spaces.pop(space, None)
+                raise
+        self.evict()
+        return len(keep)
+
+    def _usage(self) -> Tuple[int, int]:
+        # Số entry mỗi space được cập nhật cùng transaction với put_many/evict: không phải đếm lại bảng entries
+        count = 0
+        size = 0
+        for space, n in self._conn.execute("SELECT space, n_entries FROM spaces").fetchall():
+            sp = self._space(space)
+            count += n
+            size += n * (sp.row_bytes + DIGEST_BYTES) if sp else 0
+        return count, size
+
+    def evict(self) -> int:
+        """Drop least-recently-used entries until under max_entries / max_bytes (down to 90%)."""
+        if self.max_entries is None and self.max_bytes is None:
+            return 0
+        evicted = 0
+        with self._lock:
+            count, size = self._usage()
+            over_count = self.max_entries is not None and count > self.max_entries
+            over_size = self.max_bytes is not None and size > self.max_bytes
+            if not (over_count or over_size):
+                return 0
+            target = count
+            if over_count:
+                target = min(target, int(self.max_entries * 0.9))
+            if over_size:
+                per_entry = max(1, size // max(1, count))
+                target = min(target, int(self.max_bytes * 0.9) // per_entry)
+            excess = count - max(0, target)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                victims = self._conn.execute(
+                    "SELECT space, hash, row FROM entries ORDER BY last_used LIMIT ?", (excess,)
+                ).fetchall()
+                by_space: Dict[str, List[int]] = {}
+                for space, h, row in victims:
+                    self._conn.execute("DELETE FROM entries WHERE space = ? AND hash = ?", (space, h))
+                    by_space.setdefault(space, []).append(row)
+                for space, rows in by_space.items():
+                    self._conn.executemany("INSERT OR IGNORE INTO free_rows (space, row) VALUES (?, ?)", [(space, r) for r in rows])
+                    self._conn.execute("UPDATE spaces SET n_entries = n_entries - ? WHERE space = ?", (len(rows), space))
+                    sp = self._space(space)
+                    _, keys = sp.maps(max(rows) + 1, writable=True)
+                    keys[np.asarray(rows, dtype=np.int64)] = np.zeros(1, dtype=f"V{DIGEST_BYTES}")
+                    keys.flush()
+                self._conn.execute("COMMIT")
+                evicted = len(victims)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._usage()
+            spaces = [s for (s,) in self._conn.execute("SELECT space FROM spaces")]
+        return {"entries": count, "bytes": size, "spaces": spaces}
+
+
+def cached_encode(
+    store: EmbeddingStore,
+    space: str,
+    model,
+    hashes: Sequence[str],
+    texts: Sequence[str],
+    normalize: bool = True,
+    batch_size: int = 32,
+) -> Tuple[np.ndarray, int]:
+    """Embeddings for ``texts`` (keyed by ``hashes``), encoding only cache misses. Returns (embeddings, n_encoded)."""
+    embeddings, found = store.get_many(space, hashes)
+    missing = np.flatnonzero(~found)
+    if len(missing):
+        fresh = encode_texts(model, [texts[i] for i in missing], normalize=normalize, batch_size=batch_size)
+        store.put_many(space, [hashes[i] for i in missing], fresh)
+        if not found.any():
+            return fresh, len(missing)
+        embeddings[missing] = fresh
+    return embeddings, len(missing)
+
+
+def migrate_jsonl(jsonl_path: Path, store: EmbeddingStore, space: str) -> int:
+    """One-time import of a legacy ``embeddings_<sha>.jsonl`` file into ``space`` of the shared store."""
+    legacy = load_cache(jsonl_path)
+    if not legacy:
+        return 0
+    hashes = list(legacy.keys())
+    return store.put_many(space, hashes, np.asarray([legacy[h] for h in hashes], dtype=np.float32))
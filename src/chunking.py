@@ -1,8 +1,22 @@
+import re
+from bisect import bisect_left
+from functools import partial
 from pathlib import Path
-from typing import List, Tuple
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Tuple
+
+if TYPE_CHECKING:
+    from src.context import TokenCounter
 
 PageText = List[Tuple[int, str]]
 
+CHUNKERS = ("fixed", "sentence")
+SECTION_BREAK = "\f"  # loaders đặt trước mỗi heading DOCX: chunk không bao giờ vượt qua
+SPECIAL_TOKENS = 2  # [CLS] ... [SEP] cũng nằm trong max_seq_length
+# Một lượt quét: ngắt section, ngắt đoạn (dòng trống), hoặc dấu kết câu (kèm ngoặc/nháy đóng) trước khoảng trắng.
+# "5.2", "01/2024" không có khoảng trắng sau dấu chấm nên không bị cắt.
+_BOUNDARY_RE = re.compile(r"(?P<section>\f)|(?P<para>\n[^\S\n]*\n)|(?P<end>[.!?…]+[\"'”’)\]]*)(?=\s|$)")
+_NONSPACE_RE = re.compile(r"\S")
+
 
 def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
     normalized = " ".join(text.split())
@@ -19,15 +33,153 @@ def chunk_text(text: str, chunk_size: int, overlap: int) -> List[str]:
     return chunks
 
 
-def build_chunks(doc_path: Path, pages: PageText, chunk_size: int, overlap: int) -> Tuple[List[str], List[str], List[dict]]:
+def iter_sentences(text: str) -> Iterator[Tuple[int, int, bool]]:
+    """(start, end, starts a new section) of each sentence of ``text``, in one pass."""
+    pos = 0
+    section = False
+    for m in _BOUNDARY_RE.finditer(text):
+        end = m.end() if m.lastgroup == "end" else m.start()
+        if _NONSPACE_RE.search(text, pos, end):
+            yield pos, end, section
+            section = False
+        if m.lastgroup == "section":
+            section = True
+        pos = m.end()
+    if _NONSPACE_RE.search(text, pos):
+        yield pos, len(text), section
+
+
+class SentenceChunker:
+    """Packs whole sentences into chunks of at most ``chunk_size`` characters and ``max_tokens``
+    tokens, so the encoder never truncates a chunk. Chunks end on sentence/paragraph boundaries
+    and always at a section break; the next chunk repeats the last sentences of the previous one
+    up to ``overlap`` characters. A sentence longer than a chunk is cut between words.
+
+    Each page is tokenized once; a sentence's token count is the number of token offsets inside it.
+    """
+
+    def __init__(self, chunk_size: int, overlap: int, max_tokens: int, counter) -> None:
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.max_tokens = max_tokens
+        self.counter = counter
+
+    def _pieces(self, text: str, spans: List[Tuple[int, int]], first: int, stop: int) -> Iterator[Tuple[str, int]]:
+        """Tokens ``first:stop`` of ``text`` as (normalized text, tokens) pieces that each fit in a chunk."""
+        cut = -1  # token cuối trước một dấu cách
+        for i in range(first, stop):
+            end = spans[i][1]
+            if i > first and (i - first + 1 > self.max_tokens or end - spans[first][0] > self.chunk_size):
+                last = cut if cut >= first else i - 1  # không có dấu cách (URL...): đành cắt giữa từ
+                yield " ".join(text[spans[first][0] : spans[last][1]].split()), last - first + 1
+                first = last + 1
+            if i + 1 == len(spans) or spans[i + 1][0] > end:
+                cut = i
+        if first < stop:
+            yield " ".join(text[spans[first][0] : spans[stop - 1][1]].split()), stop - first
+
+    def __call__(self, text: str) -> List[str]:
+        spans = self.counter.spans(text)
+        starts = [a for a, _ in spans]
+        chunks: List[str] = []
+        cur: List[Tuple[str, int]] = []
+        cur_chars = cur_tokens = 0  # cur_chars tính cả dấu cách sau mỗi câu
+        for start, end, section in iter_sentences(text):
+            if section and cur:
+                chunks.append(" ".join(s for s, _ in cur))
+                cur, cur_chars, cur_tokens = [], 0, 0
+            first, stop = bisect_left(starts, start), bisect_left(starts, end)
+            if stop == first:
+                continue
+            tokens = stop - first
+            if tokens <= self.max_tokens and end - start <= self.chunk_size:
+                pieces: Iterable[Tuple[str, int]] = [(" ".join(text[start:end].split()), tokens)]
+            else:
+                pieces = self._pieces(text, spans, first, stop)
+            for piece, n in pieces:
+                if cur and (cur_chars + len(piece) > self.chunk_size or cur_tokens + n > self.max_tokens):
+                    chunks.append(" ".join(s for s, _ in cur))
+                    # Overlap theo câu: giữ các câu cuối (không phải cả chunk) còn vừa với câu mới
+                    keep = 0
+                    kept_chars = kept_tokens = 0
+                    for s, t in reversed(cur[1:]):
+                        if kept_chars + len(s) + 1 > self.overlap:
+                            break
+                        keep += 1
+                        kept_chars += len(s) + 1
+                        kept_tokens += t
+                    cur = cur[len(cur) - keep :] if keep else []
+                    cur_chars, cur_tokens = kept_chars, kept_tokens
+                    if cur and (cur_chars + len(piece) > self.chunk_size or cur_tokens + n > self.max_tokens):
+                        cur, cur_chars, cur_tokens = [], 0, 0
+                cur.append((piece, n))
+                cur_chars += len(piece) + 1
+                cur_tokens += n
+        if cur:
+            chunks.append(" ".join(s for s, _ in cur))
+        return chunks
+
+
+def model_token_limits(model) -> Tuple[int, "TokenCounter"]:
+    """(max content tokens, TokenCounter) of a loaded encoder: its ``max_seq_length`` and its own
+    tokenizer (SentenceTransformer or OnnxEncoder), whether it came from a folder or the hub.
+
+    Raises ValueError when the model exposes neither: counting words instead would let the
+    encoder truncate chunks again."""
+    from src.context import TokenCounter
+
+    max_seq = getattr(model, "max_seq_length", None)
+    tokenizer = getattr(model, "tokenizer", None)
+    # transformers.PreTrainedTokenizerFast bọc một tokenizers.Tokenizer; OnnxEncoder dùng thẳng cái sau
+    tokenizer = getattr(tokenizer, "backend_tokenizer", tokenizer)
+    if not max_seq or not hasattr(tokenizer, "to_str"):
+        raise ValueError(f"{type(model).__name__} has no fast tokenizer / max_seq_length: cannot bound chunks by model tokens")
+    return int(max_seq) - SPECIAL_TOKENS, TokenCounter.from_tokenizer(tokenizer)
+
+
+def get_chunker(
+    name: str, chunk_size: int, overlap: int, tokens: Tuple[int, "TokenCounter"] | None = None
+) -> Callable[[str], List[str]]:
+    """``fixed``: character windows (``chunk_text``); ``sentence``: ``SentenceChunker`` limited by
+    ``tokens`` = ``model_token_limits(model)``."""
+    if name == "fixed":
+        return partial(chunk_text, chunk_size=chunk_size, overlap=overlap)
+    if name == "sentence":
+        if tokens is None:
+            raise ValueError("The sentence chunker needs the model's token limit (model_token_limits(model))")
+        return SentenceChunker(chunk_size, overlap, *tokens)
+    raise ValueError(f"Unknown chunker: {name} (expected one of {', '.join(CHUNKERS)})")
+
+
+def build_chunks(
+    doc_path: Path,
+    pages: PageText,
+    chunk_size: int,
+    overlap: int,
+    chunker: str = "fixed",
+    tokens: Tuple[int, "TokenCounter"] | None = None,
+) -> Tuple[List[str], List[str], List[dict]]:
     chunks: List[str] = []
     ids: List[str] = []
     metas: List[dict] = []
+    for chunk, chunk_id, meta in iter_chunks(doc_path, pages, chunk_size, overlap, chunker, tokens):
+        chunks.append(chunk)
+        ids.append(chunk_id)
+        metas.append(meta)
+    return chunks, ids, metas
+
+
+def iter_chunks(
+    doc_path: Path,
+    pages: Iterable[Tuple[int, str]],
+    chunk_size: int,
+    overlap: int,
+    chunker: str = "fixed",
+    tokens: Tuple[int, "TokenCounter"] | None = None,
+) -> Iterator[Tuple[str, str, dict]]:
+    """Streaming form of build_chunks: yields (chunk, id, metadata) page by page."""
+    split = get_chunker(chunker, chunk_size, overlap, tokens)
     base = doc_path.stem.replace(" ", "_")
     for page_num, text in pages:
-        page_chunks = chunk_text(text, chunk_size, overlap)
-        for idx, chunk in enumerate(page_chunks):
-            chunks.append(chunk)
-            ids.append(f"{base}_p{page_num}_c{idx:04d}")
-            metas.append({"source": str(doc_path), "page": page_num})
-    return chunks, ids, metas
+        for idx, chunk in enumerate(split(text)):
+            yield chunk, f"{base}_p{page_num}_c{idx:04d}", {"source": str(doc_path), "page": page_num}
@@ -0,0 +1,181 @@
+import re
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+from src.retrieval import Hit
+
+
+CONTEXT_TOKENS = 2000  # ngân sách mặc định cho phần CONTEXT của prompt
+MIN_OVERLAP = 20  # số ký tự trùng tối thiểu để coi đuôi chunk này là đầu chunk kia
+DUPLICATE_SHARE = 0.9  # >= 90% bộ 3-từ của đoạn đã có trong một đoạn đã chọn thì coi là bản lặp
+MIN_PIECE_TOKENS = 32  # phần ngân sách còn lại ít hơn thế thì không cắt thêm đoạn nữa
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+class TokenCounter:
+    """Counts and truncates by tokens with a local ``tokenizer.json`` (``tokenizers``), or by
+    words and punctuation when no tokenizer file is available."""
+
+    def __init__(self, tokenizer_path: Union[str, Path, None] = None) -> None:
+        self.tokenizer = None
+        path = Path(tokenizer_path) if tokenizer_path else None
+        if path is not None and path.is_dir():
+            path = path / "tokenizer.json"
+        if path is not None and path.exists():
+            from tokenizers import Tokenizer  # type: ignore
+
+            self.tokenizer = Tokenizer.from_file(str(path))
+            self.tokenizer.no_truncation()
+            self.tokenizer.no_padding()
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> "TokenCounter":
+        """Counter over a copy of a loaded ``tokenizers.Tokenizer`` (the original keeps its truncation/padding)."""
+        from tokenizers import Tokenizer  # type: ignore
+
+        counter = cls()
+        counter.tokenizer = Tokenizer.from_str(tokenizer.to_str())
+        counter.tokenizer.no_truncation()
+        counter.tokenizer.no_padding()
+        return counter
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        if self.tokenizer is None:
+            return [m.span() for m in _TOKEN_RE.finditer(text)]
+        return self.tokenizer.encode(text, add_special_tokens=False).offsets
+
+    def count(self, text: str) -> int:
+        return len(self.spans(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        spans = self.spans(text)
+        if len(spans) <= max_tokens:
+            return text
+        return text[: spans[max_tokens - 1][1]] if max_tokens > 0 else ""
+
+
+class ContextStats:
+    def __init__(self) -> None:
+        self.chunks_in = 0
+        self.chunks_out = 0
+        self.merged = 0  # chunk gộp vào chunk liền kề / chồng lấn cùng trang
+        self.duplicates = 0  # chunk bỏ vì gần trùng một đoạn đã chọn
+        self.dropped = 0  # đoạn không còn chỗ trong ngân sách
+        self.truncated = 0
+        self.tokens_in = 0  # nếu nối thẳng mọi chunk như trước
+        self.tokens_out = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "chunks_in": self.chunks_in,
+            "chunks_out": self.chunks_out,
+            "merged": self.merged,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "tokens_saved": self.tokens_in - self.tokens_out,
+        }
+
+
+class _Segment:
+    def __init__(self, rank: int, text: str, meta: dict) -> None:
+        self.rank = rank  # thứ hạng retrieval tốt nhất trong các chunk đã gộp
+        self.text = text
+        self.key = (meta.get("source"), meta.get("page"))
+        self.first = self.last = meta.get("chunk_in_page")
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of ``left`` that is a prefix of ``right`` (at least MIN_OVERLAP)."""
+    for size in range(min(len(left), len(right)), MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _join(a: _Segment, b: _Segment) -> bool:
+    """Append ``b`` to ``a`` when ``b`` continues it (text overlap or next chunk_in_page)."""
+    if b.text in a.text:
+        pass
+    elif a.text in b.text:
+        a.text = b.text
+    else:
+        size = _overlap(a.text, b.text)
+        adjacent = a.last is not None and b.first is not None and b.first == a.last + 1
+        if not size and not adjacent:
+            return False
+        a.text = a.text + b.text[size:] if size else a.text + " " + b.text
+    a.rank = min(a.rank, b.rank)
+    if b.last is not None and (a.last is None or b.last > a.last):
+        a.last = b.last
+    return True
+
+
+def _shingles(text: str) -> set:
+    words = text.lower().split()
+    return {" ".join(words[i : i + 3]) for i in range(max(len(words) - 2, 1))}
+
+
+def pack_context(
+    hits: Sequence[Hit],
+    max_tokens: int = CONTEXT_TOKENS,
+    counter: TokenCounter | None = None,
+) -> Tuple[List[str], ContextStats]:
+    """Context passages for the answer prompt from ranked hits, within ``max_tokens``.
+
+    Overlapping or adjacent chunks of the same source/page are merged into one passage,
+    near-duplicates are dropped, and passages are added best-ranked first until the budget is
+    spent (the last one cut to fit).
+    """
+    counter = counter or TokenCounter()
+    stats = ContextStats()
+    segments: List[_Segment] = []
+    for rank, (doc, meta, _) in enumerate(hits):
+        if not doc:
+            continue
+        stats.chunks_in += 1
+        stats.tokens_in += counter.count(doc)
+        segments.append(_Segment(rank, doc, meta or {}))
+
+    # Gộp theo (source, page); ghép được một cặp thì quét lại vì đoạn mới có thể nối tiếp đoạn khác
+    merged = list(segments)
+    changed = True
+    while changed:
+        changed = False
+        for a in merged:
+            b = next((b for b in merged if b is not a and b.key == a.key and a.key[0] is not None and _join(a, b)), None)
+            if b is not None:
+                merged.remove(b)
+                stats.merged += 1
+                changed = True
+                break
+
+    kept: List[Tuple[_Segment, set]] = []
+    for seg in sorted(merged, key=lambda s: s.rank):
+        shingles = _shingles(seg.text)
+        if any(len(shingles & other) >= DUPLICATE_SHARE * len(shingles) for _, other in kept):
+            stats.duplicates += 1
+            continue
+        kept.append((seg, shingles))
+
+    out: List[str] = []
+    remaining = max_tokens
+    for seg, _ in kept:
+        tokens = counter.count(seg.text)
+        if tokens <= remaining:
+            out.append(seg.text)
+            remaining -= tokens
+            continue
+        piece = counter.truncate(seg.text, remaining) if remaining >= MIN_PIECE_TOKENS or not out else ""
+        if piece:
+            out.append(piece)
+            stats.truncated += 1
+            remaining = 0
+        else:
+            stats.dropped += 1
+    stats.chunks_out = len(out)
+    stats.tokens_out = sum(counter.count(t) for t in out)
+    return out, stats
+
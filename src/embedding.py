@@ -1,25 +1,365 @@
+import hashlib
+import json
+import os
+import platform
+import threading
+import time
 from pathlib import Path
-from typing import List, Sequence, Union
+from typing import Dict, Iterable, List, Sequence, Union
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
 
-def load_model(model_path: Union[str, Path], device: str | None = None) -> SentenceTransformer:
+ENGINES = ("torch", "onnx")
+
+# Thứ tự ưu tiên các bản ONNX lượng tử hoá đi kèm model (models/<name>/onnx)
+ONNX_VARIANTS = {
+    "arm64": ["model_qint8_arm64.onnx"],
+    "avx512_vnni": ["model_qint8_avx512_vnni.onnx", "model_qint8_avx512.onnx", "model_quint8_avx2.onnx"],
+    "avx512": ["model_qint8_avx512.onnx", "model_quint8_avx2.onnx"],
+    "avx2": ["model_quint8_avx2.onnx"],
+}
+ONNX_FALLBACK = ["model_O2.onnx", "model_O1.onnx", "model.onnx"]
+
+
+def _cpu_flags() -> set:
+    try:
+        try:
+            from numpy._core._multiarray_umath import __cpu_features__  # type: ignore
+        except ImportError:
+            from numpy.core._multiarray_umath import __cpu_features__  # type: ignore
+        return {name.lower() for name, present in __cpu_features__.items() if present}
+    except Exception:
+        pass
+    flags: set = set()
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags.update(line.split(":", 1)[1].replace("_", "").split())
+                    break
+    except OSError:
+        pass
+    return flags
+
+
+def detect_cpu_isa() -> str:
+    machine = platform.machine().lower()
+    if machine in {"arm64", "aarch64"}:
+        return "arm64"
+    flags = _cpu_flags()
+    if "avx512f" in flags and "avx512vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags and "avx512bw" in flags:
+        return "avx512"
+    if "avx2" in flags:
+        return "avx2"
+    return "generic"
+
+
+def select_onnx_variant(onnx_dir: Path, variant: str = "auto") -> Path:
+    """Return the ONNX file to load: an explicit file name, 'fp32', or 'auto' (best quantized export for this CPU)."""
+    if variant not in {"auto", "fp32"}:
+        path = onnx_dir / variant
+        if not path.exists():
+            raise FileNotFoundError(path)
+        return path
+    candidates = [] if variant == "fp32" else list(ONNX_VARIANTS.get(detect_cpu_isa(), []))
+    for name in candidates + ONNX_FALLBACK:
+        path = onnx_dir / name
+        if path.exists():
+            return path
+    raise FileNotFoundError(f"No ONNX export found in {onnx_dir}")
+
+
+def _read_json(model_dir: Path, rel: str):
+    """A JSON file of a local model directory, or {} if the model does not ship it."""
+    path = model_dir / rel
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def _load_tokenizer(model_dir: Path, max_length: int, pad_token: str = "[PAD]"):
+    """``tokenizer.json`` truncating to ``max_length`` and padding each batch to its longest input."""
+    from tokenizers import Tokenizer  # type: ignore
+
+    tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+    tokenizer.enable_truncation(max_length=max_length)
+    pad_id = tokenizer.token_to_id(pad_token) or 0
+    tokenizer.enable_padding(pad_id=pad_id, pad_token=pad_token)
+    return tokenizer
+
+
+def _ort_session(model_path: Path, num_threads: int | None = None):
+    import onnxruntime as ort  # type: ignore
+
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        opts.intra_op_num_threads = num_threads
+    return ort.InferenceSession(str(model_path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+class OnnxEncoder:
+    """Drop-in replacement for SentenceTransformer.encode backed by onnxruntime."""
+
+    def __init__(
+        self,
+        model_dir: Union[str, Path],
+        variant: str = "auto",
+        num_threads: int | None = None,
+    ) -> None:
+        self.model_dir = Path(model_dir)
+        self.model_path = select_onnx_variant(self.model_dir / "onnx", variant)
+
+        st_config = _read_json(self.model_dir, "sentence_bert_config.json")
+        pooling = _read_json(self.model_dir, "1_Pooling/config.json")
+        modules = _read_json(self.model_dir, "modules.json") or []
+        self.max_seq_length = int(st_config.get("max_seq_length", 256))
+        self.do_lower_case = bool(st_config.get("do_lower_case", False))
+        self.pooling_mode = "cls" if pooling.get("pooling_mode_cls_token") else "mean"
+        self.normalize_output = any(m.get("type", "").endswith("Normalize") for m in modules)
+        self.dimension = pooling.get("word_embedding_dimension")
+
+        self.tokenizer = _load_tokenizer(self.model_dir, self.max_seq_length)
+        self.session = _ort_session(self.model_path, num_threads)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def get_sentence_embedding_dimension(self) -> int | None:
+        return self.dimension
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encoded], dtype=np.int64)
+        attention = np.asarray([e.attention_mask for e in encoded], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.asarray([e.type_ids for e in encoded], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]
+        if self.pooling_mode == "cls":
+            return hidden[:, 0].astype(np.float32)
+        mask = attention[:, :, None].astype(np.float32)
+        summed = (hidden * mask).sum(axis=1)
+        return (summed / np.clip(mask.sum(axis=1), 1e-9, None)).astype(np.float32)
+
+    def encode(
+        self,
+        sentences: Union[str, Sequence[str]],
+        batch_size: int = 32,
+        normalize_embeddings: bool = False,
+        **_: object,
+    ) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if self.do_lower_case:
+            texts = [t.lower() for t in texts]
+        out = np.zeros((len(texts), self.dimension or 0), dtype=np.float32)
+        if not texts:
+            return out[0] if single else out
+        # Sắp theo độ dài để mỗi batch pad ít nhất (giống SentenceTransformer)
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            idx = order[start : start + batch_size]
+            emb = self._forward([texts[i] for i in idx])
+            if out.shape[1] != emb.shape[1]:
+                out = np.zeros((len(texts), emb.shape[1]), dtype=np.float32)
+                self.dimension = emb.shape[1]
+            out[idx] = emb
+        if normalize_embeddings or self.normalize_output:
+            norms = np.linalg.norm(out, axis=1, keepdims=True)
+            out /= np.clip(norms, 1e-12, None)
+        return out[0] if single else out
+
+
+FINGERPRINT_FILES = (
+    "config.json",
+    "modules.json",
+    "sentence_bert_config.json",
+    "1_Pooling/config.json",
+    "tokenizer.json",
+)
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")
+
+
+def model_fingerprint(model_path: Union[str, Path], engine: str = "torch", onnx_variant: str = "auto") -> str:
+    """Stable id of the vectors a model produces: config + weights (+ chosen ONNX export)."""
+    path = Path(model_path)
+    if not path.is_dir():
+        digest = hashlib.sha256(str(model_path).encode("utf-8")).hexdigest()
+        return f"{path.name}-{engine}-{digest[:16]}"
+    h = hashlib.sha256()
+    for rel in FINGERPRINT_FILES:
+        f = path / rel
+        if f.exists():
+            h.update(rel.encode("utf-8"))
+            h.update(f.read_bytes())
+    if engine == "onnx":
+        weights = [select_onnx_variant(path / "onnx", onnx_variant)]
+    else:
+        weights = [path / name for name in WEIGHT_FILES if (path / name).exists()][:1]
+    for f in weights:
+        # Kích thước + 1 MiB đầu đủ phân biệt các bản weights mà không phải đọc cả file
+        h.update(f.name.encode("utf-8"))
+        h.update(str(f.stat().st_size).encode("utf-8"))
+        with f.open("rb") as fh:
+            h.update(fh.read(1 << 20))
+    return f"{path.name}-{engine}-{h.hexdigest()[:16]}"
+
+
+def load_model(
+    model_path: Union[str, Path],
+    device: str | None = None,
+    engine: str = "torch",
+    onnx_variant: str = "auto",
+):
+    if engine == "onnx":
+        if device not in (None, "cpu"):
+            raise ValueError("ONNX engine only supports CPU")
+        return OnnxEncoder(model_path, variant=onnx_variant, num_threads=int(os.getenv("ONNX_THREADS", "0")) or None)
+    if engine != "torch":
+        raise ValueError(f"Unknown embedding engine: {engine}")
+    from sentence_transformers import SentenceTransformer
+
     return SentenceTransformer(str(model_path), device=device)
 
 
+def model_memory(model) -> int:
+    """Approximate resident size of a loaded model in bytes (torch parameters + buffers, or the ONNX file)."""
+    params = getattr(model, "parameters", None)
+    if callable(params):
+        total = sum(p.numel() * p.element_size() for p in params())
+        buffers = getattr(model, "buffers", None)
+        if callable(buffers):
+            total += sum(b.numel() * b.element_size() for b in buffers())
+        return int(total)
+    path = getattr(model, "model_path", None)
+    if path is not None and Path(path).exists():
+        return Path(path).stat().st_size
+    return 0
+
+
+WARMUP_TEXTS = ["warm up", "Khởi động model với một câu dài hơn một chút để cấp phát bộ đệm cho batch."]
+
+
+class _LoadedModel:
+    def __init__(self, model, load_seconds: float) -> None:
+        self.model = model
+        self.load_seconds = load_seconds
+        self.bytes = model_memory(model)
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.warm = False
+
+
+class ModelRegistry:
+    """Embedding models keyed by (engine, path): each is loaded once, warmed up, and evicted when idle over budget."""
+
+    def __init__(
+        self,
+        engine: str = "torch",
+        onnx_variant: str = "auto",
+        device: str | None = None,
+        max_bytes: int | None = None,
+        min_idle: float = 300.0,
+    ) -> None:
+        self.engine = engine
+        self.onnx_variant = onnx_variant
+        self.device = device
+        self.max_bytes = max_bytes
+        self.min_idle = min_idle
+        self._models: Dict[str, _LoadedModel] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def key(self, model_path: Union[str, Path]) -> str:
+        return f"{self.engine}:{model_path}"
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, model_path: Union[str, Path], warm_up: bool = False):
+        key = self.key(model_path)
+        entry = self._models.get(key)
+        if entry is None or (warm_up and not entry.warm):
+            # Khoá theo từng model: request đồng thời đầu tiên chỉ load một lần, model khác không phải chờ
+            with self._key_lock(key):
+                entry = self._models.get(key)
+                if entry is None:
+                    t0 = time.perf_counter()
+                    model = load_model(model_path, device=self.device, engine=self.engine, onnx_variant=self.onnx_variant)
+                    entry = _LoadedModel(model, time.perf_counter() - t0)
+                    with self._lock:
+                        self._models[key] = entry
+                if warm_up and not entry.warm:
+                    self.warm_up(entry.model)
+                    entry.warm = True
+            self.evict()
+        entry.last_used = time.time()
+        return entry.model
+
+    def warm_up(self, model) -> None:
+        for batch in (WARMUP_TEXTS[:1], WARMUP_TEXTS):
+            model.encode(batch, normalize_embeddings=True, batch_size=len(batch))
+
+    def preload(self, model_paths: Iterable[Union[str, Path]]) -> None:
+        for path in model_paths:
+            self.get(path, warm_up=True)
+
+    def evict(self) -> List[str]:
+        """Drop least-recently-used models idle for at least ``min_idle`` seconds until under ``max_bytes``."""
+        if self.max_bytes is None:
+            return []
+        evicted: List[str] = []
+        now = time.time()
+        with self._lock:
+            total = sum(e.bytes for e in self._models.values())
+            for key, entry in sorted(self._models.items(), key=lambda kv: kv[1].last_used):
+                if total <= self.max_bytes:
+                    break
+                if now - entry.last_used < self.min_idle:
+                    continue
+                del self._models[key]
+                total -= entry.bytes
+                evicted.append(key)
+        return evicted
+
+    def loaded(self) -> List[str]:
+        return list(self._models)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            items = list(self._models.items())
+        return [
+            {
+                "key": key,
+                "bytes": e.bytes,
+                "load_seconds": round(e.load_seconds, 3),
+                "warm": e.warm,
+                "loaded_at": e.loaded_at,
+                "last_used": e.last_used,
+            }
+            for key, e in items
+        ]
+
+
+def as_float32(embeddings) -> np.ndarray:
+    """Contiguous float32 [n, dim] view of encoder output (no copy when it already is one)."""
+    if hasattr(embeddings, "detach"):  # torch.Tensor (convert_to_tensor=True)
+        embeddings = embeddings.detach().cpu().numpy()
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
 def encode_texts(
-    model: SentenceTransformer,
+    model,
     texts: Sequence[str],
     normalize: bool = True,
     batch_size: int = 32,
-) -> List[List[float]]:
+) -> np.ndarray:
     if not texts:
-        return []
+        return np.zeros((0, 0), dtype=np.float32)
     embeddings = model.encode(
         list(texts), normalize_embeddings=normalize, batch_size=batch_size
     )
-    try:
-        return embeddings.tolist()
-    except AttributeError:
-        return [list(e) for e in embeddings]
+    return as_float32(embeddings)
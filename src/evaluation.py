@@ -0,0 +1,87 @@
+import json
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+from src.query_cache import normalize_question
+
+
+def _norm(text: str) -> str:
+    return normalize_question(text).lower()
+
+
+class LabelledQuery:
+    """A question and what a correct retrieval must return.
+
+    Labels are text snippets the right chunk contains and/or (source, page) locations, never
+    chunk ids, so the same labels work for any chunk_size/overlap. One JSONL line per query:
+    ``{"question": "...", "relevant": ["snippet", ...], "source": "a.pdf", "page": 3}``
+    (``"pages": [3, 4]`` for several pages; each page counts as one relevant item).
+    """
+
+    def __init__(
+        self,
+        question: str,
+        relevant: Sequence[str] = (),
+        locations: Sequence[Tuple[str, int | None]] = (),
+    ) -> None:
+        self.question = question
+        self.relevant = list(relevant)
+        self.locations = list(locations)
+
+    @classmethod
+    def from_dict(cls, row: dict) -> "LabelledQuery":
+        relevant = row.get("relevant") or []
+        if isinstance(relevant, str):
+            relevant = [relevant]
+        locations: List[Tuple[str, int | None]] = []
+        if row.get("source"):
+            pages = row.get("pages") or ([row["page"]] if row.get("page") is not None else [None])
+            locations = [(row["source"], page) for page in pages]
+        return cls(row["question"], relevant, locations)
+
+    @property
+    def n_relevant(self) -> int:
+        return len(self.relevant) + len(self.locations)
+
+    def matches(self, hits: Sequence[Tuple[str, dict, float]]) -> List[List[int]]:
+        """For each ranked (document, metadata, distance) hit, the indices of the labels it satisfies."""
+        snippets = [_norm(s) for s in self.relevant]
+        out: List[List[int]] = []
+        for doc, meta, _ in hits:
+            text = _norm(doc or "")
+            found = [i for i, s in enumerate(snippets) if s and s in text]
+            meta = meta or {}
+            # Metadata "source" là đường dẫn (CLI) hoặc tên file (backend): so theo tên file
+            name = Path(str(meta.get("source", ""))).name
+            for j, (source, page) in enumerate(self.locations):
+                if name == Path(source).name and (page is None or meta.get("page") == page):
+                    found.append(len(snippets) + j)
+            out.append(found)
+        return out
+
+
+def load_labelled_queries(path: Path) -> List[LabelledQuery]:
+    queries: List[LabelledQuery] = []
+    for line_no, line in enumerate(Path(path).read_text(encoding="utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if not row.get("question"):
+            raise ValueError(f"{path}:{line_no}: missing 'question'")
+        queries.append(LabelledQuery.from_dict(row))
+    return queries
+
+
+def recall_at_k(matches: List[List[int]], n_relevant: int, k: int) -> float:
+    """Share of the relevant items found in the top ``k`` hits."""
+    if not n_relevant:
+        return 0.0
+    return len({i for found in matches[:k] for i in found}) / n_relevant
+
+
+def reciprocal_rank(matches: List[List[int]], k: int) -> float:
+    """1 / rank of the first top-``k`` hit satisfying any label (0 when none does)."""
+    for rank, found in enumerate(matches[:k], start=1):
+        if found:
+            return 1.0 / rank
+    return 0.0
@@ -0,0 +1,296 @@
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+
+BATCH = 500
+POSTING = np.dtype([("doc", "<i8"), ("tf", "<i4"), ("length", "<i4")])
+MAX_SEGMENTS = 16  # gộp các đoạn posting của một term khi vượt quá số này
+DEAD_RATIO = 0.2  # viết lại toàn bộ chỉ mục khi tài liệu đã xoá chiếm quá 20%
+LEXICAL_FILE = "lexical.sqlite3"  # nằm trong store_root cạnh manifest
+# dense: chỉ embedding; lexical: chỉ BM25 (không encode câu hỏi); hybrid: gộp hai bảng xếp hạng bằng RRF
+SEARCH_MODES = ("dense", "lexical", "hybrid")
+RRF_K = 60
+# Giữ nguyên số hiệu như "5.2", "01/2024/nđ-cp", "covid-19" thành một token
+TOKEN_RE = re.compile(r"\w+(?:[./-]\w+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    # Tiếng Việt: mỗi âm tiết là một token; giữ dấu (bỏ dấu sẽ gộp nhầm nhiều từ khác nghĩa)
+    return TOKEN_RE.findall(unicodedata.normalize("NFC", text).lower())
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Fuse ranked id lists: score(id) = sum over lists of 1 / (k + rank), best first."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """BM25 over a SQLite inverted index; one file per store root, shared by all its collections.
+
+    Each ``add`` call writes one packed segment (doc key, tf, doc length) per term, so a query
+    reads a handful of blobs per term instead of one row per posting. Deleted documents are
+    tombstones until a merge rewrites the segments. Chunk ids are content hashes, so ``add``
+    skips ids already indexed and can be fed every batch an ingest touches.
+    """
+
+    def __init__(self, path: Path, k1: float = 1.5, b: float = 0.75) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._checked: Set[str] = set()
+        self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS collections (
+                cid INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL,
+                docs INTEGER NOT NULL DEFAULT 0, total_len INTEGER NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0, writes INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                key INTEGER PRIMARY KEY AUTOINCREMENT, cid INTEGER NOT NULL, id TEXT NOT NULL, length INTEGER NOT NULL,
+                UNIQUE (cid, id)
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                cid INTEGER NOT NULL, term TEXT NOT NULL, seg INTEGER NOT NULL, postings BLOB NOT NULL,
+                PRIMARY KEY (cid, term, seg)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS dead (
+                cid INTEGER NOT NULL, key INTEGER NOT NULL, PRIMARY KEY (cid, key)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, fn: Callable[[], object]):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return out
+
+    def _cid(self, collection: str, create: bool = False) -> int | None:
+        row = self._conn.execute("SELECT cid FROM collections WHERE name = ?", (collection,)).fetchone()
+        if row is not None or not create:
+            return None if row is None else row[0]
+        return self._conn.execute("INSERT INTO collections (name) VALUES (?)", (collection,)).lastrowid
+
+    def _keys(self, cid: int, ids: Sequence[str]) -> Dict[str, Tuple[int, int]]:
+        """id -> (doc key, length) for the ids of ``cid`` already indexed."""
+        found: Dict[str, Tuple[int, int]] = {}
+        for start in range(0, len(ids), BATCH):
+            part = ids[start : start + BATCH]
+            marks = ",".join("?" * len(part))
+            for doc_id, key, length in self._conn.execute(
+                f"SELECT id, key, length FROM docs WHERE cid = ? AND id IN ({marks})", (cid, *part)
+            ):
+                found[doc_id] = (key, length)
+        return found
+
+    def _dead(self, cid: int) -> np.ndarray:
+        return np.fromiter((k for (k,) in self._conn.execute("SELECT key FROM dead WHERE cid = ?", (cid,))), np.int64)
+
+    def _postings(self, cid: int, term: str) -> np.ndarray:
+        blobs = [blob for (blob,) in self._conn.execute("SELECT postings FROM segments WHERE cid = ? AND term = ?", (cid, term))]
+        if not blobs:
+            return np.zeros(0, POSTING)
+        return np.frombuffer(b"".join(blobs), dtype=POSTING)
+
+    def count(self, collection: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT docs FROM collections WHERE name = ?", (collection,)).fetchone()
+        return row[0] if row else 0
+
+    def add(self, collection: str, ids: Sequence[str], texts: Sequence[str]) -> int:
+        """Index the documents whose id is not indexed yet; returns how many were added."""
+        ids = list(ids)
+        if not ids:
+            return 0
+        with self._lock:
+            cid = self._cid(collection)
+            present = self._keys(cid, ids) if cid is not None else {}
+        todo = {i: t for i, t in zip(ids, texts) if i not in present}
+        if not todo:
+            return 0
+        # Tách token ngoài lock; trong transaction chỉ còn ghi
+        counted = [(doc_id, Counter(tokenize(text or ""))) for doc_id, text in todo.items()]
+
+        def write() -> int:
+            cid = self._cid(collection, create=True)
+            present = self._keys(cid, [doc_id for doc_id, _ in counted])
+            by_term: Dict[str, List[Tuple[int, int, int]]] = {}
+            first = None
+            total = 0
+            for doc_id, terms in counted:
+                if doc_id in present:
+                    continue
+                length = sum(terms.values())
+                key = self._conn.execute(
+                    "INSERT INTO docs (cid, id, length) VALUES (?, ?, ?)", (cid, doc_id, length)
+                ).lastrowid
+                first = key if first is None else first
+                total += length
+                for term, tf in terms.items():
+                    by_term.setdefault(term, []).append((key, tf, length))
+            if first is None:
+                return 0
+            # Khoá tài liệu đầu tiên của lần ghi làm số hiệu đoạn: duy nhất và tăng dần
+            self._conn.executemany(
+                "INSERT INTO segments (cid, term, seg, postings) VALUES (?, ?, ?, ?)",
+                [(cid, term, first, np.array(rows, dtype=POSTING).tobytes()) for term, rows in by_term.items()],
+            )
+            added = len(counted) - len(present)
+            self._conn.execute(
+                "UPDATE collections SET docs = docs + ?, total_len = total_len + ?, writes = writes + 1 WHERE cid = ?",
+                (added, total, cid),
+            )
+            self._maybe_merge(cid)
+            return added
+
+        return self._write(write)
+
+    def remove(self, collection: str, ids: Sequence[str]) -> int:
+        ids = list(ids)
+
+        def write() -> int:
+            cid = self._cid(collection)
+            if cid is None or not ids:
+                return 0
+            found = self._keys(cid, ids)
+            keys = [key for key, _ in found.values()]
+            self._conn.executemany("DELETE FROM docs WHERE key = ?", [(k,) for k in keys])
+            self._conn.executemany("INSERT OR IGNORE INTO dead (cid, key) VALUES (?, ?)", [(cid, k) for k in keys])
+            self._conn.execute(
+                "UPDATE collections SET docs = docs - ?, total_len = total_len - ?, dead = dead + ? WHERE cid = ?",
+                (len(found), sum(length for _, length in found.values()), len(found), cid),
+            )
+            self._maybe_merge(cid)
+            return len(found)
+
+        return self._write(write)
+
+    def _maybe_merge(self, cid: int) -> None:
+        docs, dead, writes = self._conn.execute("SELECT docs, dead, writes FROM collections WHERE cid = ?", (cid,)).fetchone()
+        if dead and dead > DEAD_RATIO * max(docs, 1):
+            self._merge(cid, purge=True)
+        elif writes and writes % MAX_SEGMENTS == 0:
+            self._merge(cid, purge=False)
+
+    def _merge(self, cid: int, purge: bool) -> None:
+        """Rewrite the segments of each term into one; ``purge`` rewrites every term and drops tombstones."""
+        if purge:
+            terms = [t for (t,) in self._conn.execute("SELECT DISTINCT term FROM segments WHERE cid = ?", (cid,))]
+        else:
+            terms = [
+                t
+                for (t,) in self._conn.execute(
+                    "SELECT term FROM segments WHERE cid = ? GROUP BY term HAVING COUNT(*) > ?", (cid, MAX_SEGMENTS)
+                )
+            ]
+        dead = self._dead(cid) if purge else None
+        for term in terms:
+            postings = self._postings(cid, term)
+            if dead is not None and len(dead):
+                postings = postings[~np.isin(postings["doc"], dead)]
+            self._conn.execute("DELETE FROM segments WHERE cid = ? AND term = ?", (cid, term))
+            if len(postings):
+                self._conn.execute(
+                    "INSERT INTO segments (cid, term, seg, postings) VALUES (?, ?, ?, ?)",
+                    (cid, term, int(postings["doc"][0]), postings.tobytes()),
+                )
+        if purge:
+            self._conn.execute("DELETE FROM dead WHERE cid = ?", (cid,))
+            self._conn.execute("UPDATE collections SET dead = 0 WHERE cid = ?", (cid,))
+
+    def drop(self, collection: str) -> None:
+        self._checked.discard(collection)
+
+        def write() -> None:
+            cid = self._cid(collection)
+            if cid is None:
+                return
+            for table in ("segments", "docs", "dead", "collections"):
+                self._conn.execute(f"DELETE FROM {table} WHERE cid = ?", (cid,))
+
+        self._write(write)
+
+    def ensure(self, collection) -> None:
+        """Backfill from the collection's stored documents if it was ingested before the index existed."""
+        name = collection.name
+        if name in self._checked:
+            return
+        if self.count(name) == 0 and collection.count() > 0:
+            result = collection.get(include=["documents"])
+            self.add(name, result.get("ids", []), result.get("documents", []))
+        self._checked.add(name)
+
+    def search(self, collection: str, query: str, top_k: int, ids: Sequence[str] | None = None) -> List[Tuple[str, float]]:
+        """Top-k (id, BM25 score), best first; empty when no query term occurs in the collection.
+
+        ``ids`` restricts scoring to those documents; IDF and length statistics stay collection-wide.
+        """
+        terms = set(tokenize(query))
+        if not terms or top_k <= 0 or (ids is not None and not len(ids)):
+            return []
+        keys: List[np.ndarray] = []
+        scores: List[np.ndarray] = []
+        with self._lock:
+            row = self._conn.execute("SELECT cid, docs, total_len, dead FROM collections WHERE name = ?", (collection,)).fetchone()
+            if row is None or row[1] == 0:
+                return []
+            cid, n_docs, total_len, n_dead = row
+            avgdl = total_len / n_docs or 1.0
+            dead = self._dead(cid) if n_dead else None
+            allowed = None
+            if ids is not None:
+                allowed = np.fromiter((key for key, _ in self._keys(cid, list(ids)).values()), np.int64)
+                if not len(allowed):
+                    return []
+            for term in terms:
+                postings = self._postings(cid, term)
+                if dead is not None and len(postings):
+                    postings = postings[~np.isin(postings["doc"], dead)]
+                if not len(postings):
+                    continue
+                df = len(postings)
+                if allowed is not None:
+                    postings = postings[np.isin(postings["doc"], allowed)]
+                    if not len(postings):
+                        continue
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                tf = postings["tf"].astype(np.float64)
+                norm = self.k1 * (1.0 - self.b + self.b * postings["length"] / avgdl)
+                keys.append(postings["doc"])
+                scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+            if not keys:
+                return []
+            # Cộng điểm theo tài liệu bằng numpy (từ phổ biến có thể có hàng chục nghìn posting)
+            doc_keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+            totals = np.bincount(inverse, weights=np.concatenate(scores))
+            k = min(top_k, len(totals))
+            best = np.argpartition(-totals, k - 1)[:k]
+            best = best[np.argsort(-totals[best], kind="stable")]
+            best_keys = doc_keys[best].tolist()
+            marks = ",".join("?" * len(best_keys))
+            ids = dict(self._conn.execute(f"SELECT key, id FROM docs WHERE key IN ({marks})", best_keys))
+        return [(ids[key], float(totals[i])) for key, i in zip(best_keys, best) if key in ids]
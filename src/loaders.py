@@ -1,9 +1,11 @@
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 from docx import Document
 from pypdf import PdfReader
 
+from src.chunking import SECTION_BREAK
+
 
 PageText = List[Tuple[int, str]]
 
@@ -13,10 +15,20 @@ def load_pdf(path: Path) -> PageText:
     return [(i + 1, page.extract_text() or "") for i, page in enumerate(reader.pages)]
 
 
-def load_docx(path: Path) -> PageText:
+def docx_text(path: Path) -> str:
+    """Paragraphs separated by blank lines; headings (Title / Heading n styles) start with SECTION_BREAK."""
     doc = Document(str(path))
-    paragraphs = [p.text for p in doc.paragraphs if p.text.strip()]
-    return [(1, "\n".join(paragraphs))]
+    parts: List[str] = []
+    for p in doc.paragraphs:
+        if not p.text.strip():
+            continue
+        style = p.style.name if p.style is not None else ""
+        parts.append(SECTION_BREAK + p.text if style.startswith(("Heading", "Title")) else p.text)
+    return "\n\n".join(parts)
+
+
+def load_docx(path: Path) -> PageText:
+    return [(1, docx_text(path))]
 
 
 def load_txt(path: Path) -> PageText:
@@ -33,3 +45,17 @@ def load_document(path: Path) -> PageText:
     if suffix == ".txt":
         return load_txt(path)
     raise ValueError(f"Unsupported file type: {suffix}")
+
+
+def iter_pdf(path: Path) -> Iterator[Tuple[int, str]]:
+    reader = PdfReader(str(path))
+    for i, page in enumerate(reader.pages):
+        yield i + 1, page.extract_text() or ""
+
+
+def iter_document(path: Path) -> Iterator[Tuple[int, str]]:
+    """Like load_document, but yields one page at a time so large PDFs are never fully in memory."""
+    if path.suffix.lower() == ".pdf":
+        yield from iter_pdf(path)
+        return
+    yield from load_document(path)
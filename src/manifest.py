@@ -0,0 +1,125 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Set
+
+
+BATCH = 500
+
+
+def chunk_params(chunk_size: int, overlap: int, chunker: str = "fixed") -> str:
+    params = {"chunk_size": chunk_size, "overlap": overlap}
+    if chunker != "fixed":
+        # "fixed" không ghi vào để manifest cũ vẫn khớp
+        params["chunker"] = chunker
+    return json.dumps(params, sort_keys=True)
+
+
+class Manifest:
+    """What was last ingested from each source, per collection: content hash, chunking params and chunk hashes."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sources (
+                collection TEXT NOT NULL, source TEXT NOT NULL, content_hash TEXT NOT NULL,
+                params TEXT NOT NULL, chunk_count INTEGER NOT NULL, updated_at REAL NOT NULL,
+                PRIMARY KEY (collection, source)
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                collection TEXT NOT NULL, source TEXT NOT NULL, hash TEXT NOT NULL,
+                PRIMARY KEY (collection, source, hash)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS chunks_by_hash ON chunks (collection, hash);
+            """
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def get(self, collection: str, source: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash, params, chunk_count, updated_at FROM sources WHERE collection = ? AND source = ?",
+                (collection, source),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"content_hash": row[0], "params": row[1], "chunk_count": row[2], "updated_at": row[3]}
+
+    def unchanged(self, collection: str, source: str, content_hash: str, params: str) -> bool:
+        entry = self.get(collection, source)
+        return entry is not None and entry["content_hash"] == content_hash and entry["params"] == params
+
+    def chunk_hashes(self, collection: str, source: str) -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hash FROM chunks WHERE collection = ? AND source = ?", (collection, source)
+            ).fetchall()
+        return {h for (h,) in rows}
+
+    def referenced_elsewhere(self, collection: str, source: str, hashes: Iterable[str]) -> Set[str]:
+        """Subset of ``hashes`` still used by another source of the collection (ids are shared by content)."""
+        hashes = list(hashes)
+        found: Set[str] = set()
+        with self._lock:
+            for start in range(0, len(hashes), BATCH):
+                part = hashes[start : start + BATCH]
+                marks = ",".join("?" * len(part))
+                found.update(
+                    h
+                    for (h,) in self._conn.execute(
+                        f"SELECT DISTINCT hash FROM chunks WHERE collection = ? AND source != ? AND hash IN ({marks})",
+                        (collection, source, *part),
+                    )
+                )
+        return found
+
+    def record(self, collection: str, source: str, content_hash: str, params: str, hashes: Iterable[str]) -> None:
+        hashes = list(hashes)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sources (collection, source, content_hash, params, chunk_count, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (collection, source, content_hash, params, len(hashes), time.time()),
+                )
+                self._conn.execute("DELETE FROM chunks WHERE collection = ? AND source = ?", (collection, source))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO chunks (collection, source, hash) VALUES (?, ?, ?)",
+                    [(collection, source, h) for h in hashes],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def sources(self, collection: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT source FROM sources WHERE collection = ?", (collection,)).fetchall()
+        return [s for (s,) in rows]
+
+    def forget(self, collection: str, source: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sources WHERE collection = ? AND source = ?", (collection, source))
+            self._conn.execute("DELETE FROM chunks WHERE collection = ? AND source = ?", (collection, source))
+
+    def drop(self, collection: str) -> None:
+        """Forget every source of ``collection`` in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM sources WHERE collection = ?", (collection,))
+                self._conn.execute("DELETE FROM chunks WHERE collection = ?", (collection,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
@@ -0,0 +1,412 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Sequence, Set, Tuple
+
+from src.answer_cache import AnswerCache
+from src.cache import EmbeddingStore, cached_encode
+from src.chunking import iter_chunks, model_token_limits
+from src.lexical import LexicalIndex
+from src.loaders import iter_document, load_document
+from src.manifest import Manifest, chunk_params
+from src.vectordb import delete_chunks, existing_ids, update_metadatas, upsert_chunks
+
+
+SUPPORTED_SUFFIXES = {".pdf", ".docx", ".doc", ".txt"}
+
+
+# (hashes, chunks, metadatas) cho một batch
+Batch = Tuple[List[str], List[str], List[dict]]
+
+
+class StageStats:
+    def __init__(self, name: str, unit: str) -> None:
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, n: int, seconds: float) -> None:
+        self.count += n
+        self.seconds += seconds
+
+    def __str__(self) -> str:
+        if self.seconds <= 0:
+            return f"{self.name}: {self.count} {self.unit}"
+        rate = self.count / self.seconds
+        return f"{self.name}: {self.count} {self.unit} in {self.seconds:.2f}s ({rate:.1f} {self.unit}/s)"
+
+
+class IngestStats:
+    def __init__(self) -> None:
+        self.parse = StageStats("parse", "pages")
+        self.chunk = StageStats("chunk", "chunks")
+        self.dedup = StageStats("dedup", "chunks")
+        self.skipped = 0  # chunk đã có trong collection (resume / manifest)
+        self.removed = 0  # chunk cũ không còn trong tài liệu, đã xoá khỏi collection
+        self.encode = StageStats("encode", "chunks")
+        self.encoded = 0  # chunk thực sự phải encode (không có trong cache)
+        self.upsert = StageStats("upsert", "chunks")
+        self.files = 0
+        self.files_skipped = 0  # nội dung + tham số chunk không đổi từ lần trước
+        self.failed: List[Tuple[str, str]] = []  # (file, lỗi): không ghi manifest nên lần chạy sau thử lại
+        self.started = time.perf_counter()
+
+    def stages(self) -> List[StageStats]:
+        return [self.parse, self.chunk, self.dedup, self.encode, self.upsert]
+
+    def report(self, prefix: str = "") -> str:
+        elapsed = time.perf_counter() - self.started
+        extra = f" | kept {self.skipped} | encoded {self.encoded} new" if self.skipped or self.encode.count else ""
+        if self.removed:
+            extra += f" | removed {self.removed} stale"
+        if self.files_skipped or self.files > 1:
+            extra += f" | files {self.files} ingested, {self.files_skipped} unchanged"
+        if self.failed:
+            extra += f" | {len(self.failed)} failed"
+        return prefix + " | ".join(str(s) for s in self.stages()) + extra + f" | wall {elapsed:.1f}s"
+
+
+def iter_pages(path: Path, stats: IngestStats) -> Iterator[Tuple[int, str]]:
+    pages = iter_document(path)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            return
+        stats.parse.add(1, time.perf_counter() - t0)
+        yield page
+
+
+def iter_dedup(
+    chunks: Iterable[Tuple[str, str, dict]], stats: IngestStats, seen: Set[str] | None = None
+) -> Iterator[Tuple[str, str, dict]]:
+    # Chỉ giữ hash (64 ký tự) của chunk đã gặp, không giữ nội dung chunk
+    seen = set() if seen is None else seen
+    it = iter(chunks)
+    while True:
+        t0 = time.perf_counter()
+        parse_before = stats.parse.seconds
+        try:
+            chunk, _, meta = next(it)
+        except StopIteration:
+            return
+        t1 = time.perf_counter()
+        stats.chunk.add(1, (t1 - t0) - (stats.parse.seconds - parse_before))
+        h = sha256(chunk.encode("utf-8")).hexdigest()
+        if h in seen:
+            stats.dedup.add(0, time.perf_counter() - t1)
+            continue
+        seen.add(h)
+        meta = dict(meta)
+        meta["hash"] = h
+        stats.dedup.add(1, time.perf_counter() - t1)
+        yield h, chunk, meta
+
+
+def iter_batches(items: Iterable[Tuple[str, str, dict]], size: int) -> Iterator[Batch]:
+    hashes: List[str] = []
+    chunks: List[str] = []
+    metas: List[dict] = []
+    for h, chunk, meta in items:
+        hashes.append(h)
+        chunks.append(chunk)
+        metas.append(meta)
+        if len(hashes) >= size:
+            yield hashes, chunks, metas
+            hashes, chunks, metas = [], [], []
+    if hashes:
+        yield hashes, chunks, metas
+
+
+def chunk_id(h: str) -> str:
+    return f"sha256_{h}"
+
+
+def file_digest(path: Path) -> str:
+    h = sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def discover_files(root: Path, recursive: bool = False, pattern: str = "*") -> List[Path]:
+    if root.is_file():
+        return [root]
+    matches = root.rglob(pattern) if recursive else root.glob(pattern)
+    return sorted(p for p in matches if p.is_file() and p.suffix.lower() in SUPPORTED_SUFFIXES)
+
+
+def write_batch(
+    batch: Batch,
+    model,
+    collection,
+    store: EmbeddingStore,
+    space: str,
+    stats: IngestStats,
+    batch_size: int,
+    resume: bool,
+    known: Set[str] | None = None,
+    lexical: LexicalIndex | None = None,
+) -> None:
+    """Encode (through the cache) and upsert one batch, skipping chunks already in the collection.
+
+    ``known`` holds hashes the manifest says are stored for this source; they are not
+    re-encoded, only their metadata (page numbers may shift) is refreshed.
+    """
+    hashes, texts, metas = batch
+    ids = [chunk_id(h) for h in hashes]
+    if lexical is not None:
+        # Cả chunk đã có trong collection (resume / manifest): id đã có trong chỉ mục BM25 thì bỏ qua
+        lexical.add(collection.name, ids, texts)
+    if known or resume:
+        done = {chunk_id(h) for h in hashes if h in known} if known else set()
+        if done:
+            update_metadatas(collection, [cid for cid in ids if cid in done], [m for cid, m in zip(ids, metas) if cid in done])
+        if resume:
+            done |= existing_ids(collection, [cid for cid in ids if cid not in done])
+        if done:
+            keep = [i for i, cid in enumerate(ids) if cid not in done]
+            stats.skipped += len(ids) - len(keep)
+            hashes = [hashes[i] for i in keep]
+            texts = [texts[i] for i in keep]
+            metas = [metas[i] for i in keep]
+            ids = [ids[i] for i in keep]
+    if not ids:
+        return
+
+    t0 = time.perf_counter()
+    embeddings, n_encoded = cached_encode(store, space, model, hashes, texts, normalize=True, batch_size=batch_size)
+    stats.encode.add(len(ids), time.perf_counter() - t0)
+    stats.encoded += n_encoded
+
+    t0 = time.perf_counter()
+    upsert_chunks(collection, ids, texts, metas, embeddings)
+    stats.upsert.add(len(ids), time.perf_counter() - t0)
+
+
+def remove_stale(
+    collection,
+    manifest: Manifest,
+    source: str,
+    old: Set[str],
+    new: Set[str],
+    id_fn: Callable[[str], str] = chunk_id,
+    protect: Set[str] | None = None,
+    lexical: LexicalIndex | None = None,
+) -> int:
+    """Delete ids of chunks that disappeared from ``source`` and are not used by another source.
+
+    ``protect`` holds hashes written during the current run by sources not yet in the manifest.
+    """
+    removed = old - new
+    if protect:
+        removed -= protect
+    if not removed:
+        return 0
+    removed -= manifest.referenced_elsewhere(collection.name, source, removed)
+    ids = [id_fn(h) for h in sorted(removed)]
+    if lexical is not None:
+        lexical.remove(collection.name, ids)
+    return delete_chunks(collection, ids)
+
+
+def ingest_stream(
+    file_path: Path,
+    model,
+    collection,
+    store: EmbeddingStore,
+    space: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    batch_size: int = 32,
+    ingest_batch: int = 256,
+    resume: bool = True,
+    verbose: bool = True,
+    manifest: Manifest | None = None,
+    force: bool = False,
+    lexical: LexicalIndex | None = None,
+    answers: AnswerCache | None = None,
+    chunker: str = "fixed",
+) -> IngestStats:
+    """page iterator -> chunker -> dedup -> batched encoder -> batched upsert.
+
+    At most ``ingest_batch`` chunks (and their embeddings) are held at once. Chunk ids are
+    content hashes, so with ``resume`` a re-run after a crash skips the batches already stored.
+    With a ``manifest``, only chunks new to this source are encoded and chunks that vanished
+    from it are deleted afterwards. A ``lexical`` index follows the same adds and deletes, and
+    cached ``answers`` built on any chunk of the re-ingested source are dropped. The ``sentence``
+    ``chunker`` is bounded by ``model``'s own tokenizer and ``max_seq_length``.
+    """
+    stats = IngestStats()
+    source = str(file_path)
+    params = chunk_params(chunk_size, chunk_overlap, chunker)
+    digest = file_digest(file_path) if manifest is not None else ""
+    if manifest is not None and not force and manifest.unchanged(collection.name, source, digest, params):
+        stats.files_skipped += 1
+        return stats
+    old = manifest.chunk_hashes(collection.name, source) if manifest is not None else set()
+    tokens = model_token_limits(model) if chunker != "fixed" else None
+
+    new: Set[str] = set()
+    chunks = iter_chunks(file_path, iter_pages(file_path, stats), chunk_size, chunk_overlap, chunker, tokens)
+    for batch in iter_batches(iter_dedup(chunks, stats, seen=new), ingest_batch):
+        write_batch(
+            batch, model, collection, store, space, stats, batch_size, resume, known=None if force else old, lexical=lexical
+        )
+        if verbose:
+            print(stats.report(prefix="  "), flush=True)
+    stats.files += 1
+    if manifest is not None:
+        stats.removed += remove_stale(collection, manifest, source, old, new, lexical=lexical)
+        manifest.record(collection.name, source, digest, params, new)
+    if answers is not None:
+        answers.invalidate(collection.name, old | new)
+    return stats
+
+
+_WORKER_TOKENS = None  # (max tokens, TokenCounter) của model, gửi một lần cho mỗi tiến trình parse
+
+
+def _init_parser(tokens) -> None:
+    global _WORKER_TOKENS
+    _WORKER_TOKENS = tokens
+
+
+def parse_file(
+    path: str, chunk_size: int, chunk_overlap: int, chunker: str = "fixed", tokens=None
+) -> Tuple[str, List[Tuple[str, str, dict]], int, float]:
+    """Process-pool worker: load + chunk + hash one file. Returns (path, items, pages, seconds).
+
+    ``tokens`` defaults to the ones the pool was initialised with (``_init_parser``)."""
+    t0 = time.perf_counter()
+    tokens = tokens if tokens is not None else _WORKER_TOKENS
+    file_path = Path(path)
+    pages = load_document(file_path)
+    items: List[Tuple[str, str, dict]] = []
+    seen = set()
+    for chunk, _, meta in iter_chunks(file_path, pages, chunk_size, chunk_overlap, chunker, tokens):
+        h = sha256(chunk.encode("utf-8")).hexdigest()
+        if h in seen:
+            continue
+        seen.add(h)
+        meta["hash"] = h
+        items.append((h, chunk, meta))
+    return path, items, len(pages), time.perf_counter() - t0
+
+
+def ingest_paths(
+    paths: Sequence[Path],
+    model,
+    collection,
+    store: EmbeddingStore,
+    space: str,
+    manifest: Manifest,
+    chunk_size: int,
+    chunk_overlap: int,
+    batch_size: int = 32,
+    ingest_batch: int = 256,
+    workers: int | None = None,
+    resume: bool = True,
+    force: bool = False,
+    verbose: bool = True,
+    lexical: LexicalIndex | None = None,
+    answers: AnswerCache | None = None,
+    chunker: str = "fixed",
+) -> IngestStats:
+    """Many files: parse in a process pool, encode with the one shared model, upsert from this process only.
+
+    Files whose content hash and chunking params match the manifest are skipped. Batches span
+    file boundaries; a file is recorded in the manifest once all of its chunks are written.
+    A file that fails to parse goes to ``stats.failed`` and the others carry on.
+    """
+    stats = IngestStats()
+    params = chunk_params(chunk_size, chunk_overlap, chunker)
+    todo: List[Tuple[Path, str]] = []
+    for path in paths:
+        digest = file_digest(path)
+        if not force and manifest.unchanged(collection.name, str(path), digest, params):
+            stats.files_skipped += 1
+            continue
+        todo.append((path, digest))
+    if verbose:
+        print(f"{len(todo)} file(s) to ingest, {stats.files_skipped} unchanged.", flush=True)
+    if not todo:
+        return stats
+    tokens = model_token_limits(model) if chunker != "fixed" else None
+
+    digests = {str(p): d for p, d in todo}
+    seen = set()  # chunk trùng giữa các file: chỉ ghi một lần (id theo nội dung)
+    buffer: List[Tuple[str, str, dict]] = []
+    pending: List[Tuple[str, int, Set[str]]] = []  # (path, vị trí kết thúc trong luồng chunk, hash của file)
+    enqueued = 0
+    flushed = 0
+
+    def flush(n: int) -> None:
+        nonlocal buffer, flushed
+        part, buffer = buffer[:n], buffer[n:]
+        write_batch(
+            ([h for h, _, _ in part], [c for _, c, _ in part], [m for _, _, m in part]),
+            model, collection, store, space, stats, batch_size, resume, lexical=lexical,
+        )
+        flushed += len(part)
+        while pending and pending[0][1] <= flushed:
+            path, _, hashes = pending.pop(0)
+            old = manifest.chunk_hashes(collection.name, path)
+            stats.removed += remove_stale(collection, manifest, path, old, hashes, protect=seen, lexical=lexical)
+            manifest.record(collection.name, path, digests[path], params, hashes)
+            if answers is not None:
+                answers.invalidate(collection.name, old | hashes)
+            stats.files += 1
+        if verbose:
+            print(stats.report(prefix="  "), flush=True)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_parser, initargs=(tokens,)) as pool:
+        queue = iter(todo)
+        limit = 2 * (workers or os.cpu_count() or 1)
+        running = {}  # future -> path
+        while True:
+            # Giới hạn số file đang parse để bộ nhớ không phụ thuộc số lượng file
+            for path, _ in queue:
+                running[pool.submit(parse_file, str(path), chunk_size, chunk_overlap, chunker)] = str(path)
+                if len(running) >= limit:
+                    break
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = running.pop(fut)
+                try:
+                    _, items, n_pages, seconds = fut.result()
+                except Exception as exc:  # PDF hỏng, file đọc không được...: bỏ qua file này, chạy tiếp
+                    stats.failed.append((path, f"{type(exc).__name__}: {exc}"))
+                    if verbose:
+                        print(f"  failed: {path}: {stats.failed[-1][1]}", flush=True)
+                    continue
+                stats.parse.add(n_pages, seconds)
+                stats.chunk.add(len(items), 0.0)
+                hashes = {h for h, _, _ in items}
+                fresh = [it for it in items if it[0] not in seen]
+                seen.update(h for h, _, _ in fresh)
+                stats.dedup.add(len(fresh), 0.0)
+                if not force:
+                    # Chunk đã có từ lần ingest trước của chính file này: không encode/upsert lại
+                    known = manifest.chunk_hashes(collection.name, path)
+                    kept = [it for it in fresh if it[0] in known]
+                    if kept:
+                        update_metadatas(collection, [chunk_id(h) for h, _, _ in kept], [m for _, _, m in kept])
+                        if lexical is not None:
+                            lexical.add(collection.name, [chunk_id(h) for h, _, _ in kept], [c for _, c, _ in kept])
+                    stats.skipped += len(kept)
+                    fresh = [it for it in fresh if it[0] not in known]
+                buffer.extend(fresh)
+                enqueued += len(fresh)
+                pending.append((path, enqueued, hashes))
+                while len(buffer) >= ingest_batch:
+                    flush(ingest_batch)
+    flush(len(buffer))
+    return stats
@@ -0,0 +1,106 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+import numpy as np
+
+
+_MISSING = object()
+
+
+def normalize_question(text: str) -> str:
+    # NFC để cùng một câu tiếng Việt gõ bằng bộ gõ khác nhau (dựng sẵn / tổ hợp) trùng khoá
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class TTLCache:
+    """Thread-safe LRU bounded by entry count; entries older than ``ttl`` seconds are misses."""
+
+    def __init__(self, max_entries: int = 4096, ttl: float | None = 300.0) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or (self.ttl is not None and now - entry[0] > self.ttl):
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class QueryCache:
+    """Question -> embedding and (collection, version, embedding, top_k) -> hits.
+
+    Every write to a collection must call ``bump(collection)``: cached hits are keyed by the
+    collection version, so they stop matching as soon as the collection changes.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: float | None = 300.0) -> None:
+        self.embeddings = TTLCache(max_entries, ttl)
+        self.results = TTLCache(max_entries, ttl)
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def version(self, collection: str) -> int:
+        return self._versions.get(collection, 0)
+
+    def bump(self, collection: str) -> None:
+        with self._lock:
+            self._versions[collection] = self._versions.get(collection, 0) + 1
+
+    def get_embedding(self, model_key: str, question: str) -> np.ndarray | None:
+        return self.embeddings.get((model_key, normalize_question(question)))
+
+    def put_embedding(self, model_key: str, question: str, embedding: np.ndarray) -> None:
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+        self.embeddings.put((model_key, normalize_question(question)), embedding)
+
+    def result_key(self, collection: str, embedding: np.ndarray, top_k: int, extra: Hashable = None) -> tuple:
+        """Take the key before searching, so hits computed across a concurrent write land under the old version."""
+        emb = np.ascontiguousarray(embedding, dtype=np.float32).tobytes()
+        return (collection, self.version(collection), emb, top_k, extra)
+
+    def text_key(self, collection: str, question: str, top_k: int, extra: Hashable = None) -> tuple:
+        """Like ``result_key`` for searches that never encode the question (lexical)."""
+        return (collection, self.version(collection), normalize_question(question), top_k, extra)
+
+    def stats(self) -> dict:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
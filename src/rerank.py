@@ -0,0 +1,144 @@
+import os
+import time
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.embedding import _load_tokenizer, _ort_session, _read_json, select_onnx_variant
+from src.retrieval import Hit
+
+
+RERANK_FETCH = 4  # mặc định lấy top_k x 4 ứng viên rồi re-rank xuống top_k
+
+
+class OnnxCrossEncoder:
+    """Drop-in replacement for sentence_transformers.CrossEncoder.predict backed by onnxruntime."""
+
+    def __init__(
+        self,
+        model_dir: Union[str, Path],
+        variant: str = "auto",
+        num_threads: int | None = None,
+        max_length: int | None = None,
+    ) -> None:
+        self.model_dir = Path(model_dir)
+        self.model_path = select_onnx_variant(self.model_dir / "onnx", variant)
+        config = _read_json(self.model_dir, "config.json")
+        tok_config = _read_json(self.model_dir, "tokenizer_config.json")
+        limit = min(int(tok_config.get("model_max_length", 512) or 512), int(config.get("max_position_embeddings", 512)))
+        self.max_length = max_length or limit
+
+        self.tokenizer = _load_tokenizer(self.model_dir, self.max_length, tok_config.get("pad_token", "[PAD]"))
+        self.session = _ort_session(self.model_path, num_threads)
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, pairs: Sequence[Tuple[str, str]], batch_size: int = 32, **_: object) -> np.ndarray:
+        scores = np.zeros(len(pairs), dtype=np.float32)
+        for start in range(0, len(pairs), batch_size):
+            encoded = self.tokenizer.encode_batch([tuple(p) for p in pairs[start : start + batch_size]])
+            feeds = {
+                "input_ids": np.asarray([e.ids for e in encoded], dtype=np.int64),
+                "attention_mask": np.asarray([e.attention_mask for e in encoded], dtype=np.int64),
+            }
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.asarray([e.type_ids for e in encoded], dtype=np.int64)
+            logits = self.session.run(None, feeds)[0]
+            if logits.ndim != 2:
+                raise ValueError(f"{self.model_path} is not a sequence-classification (cross-encoder) export")
+            # Như CrossEncoder: một nhãn -> sigmoid; nhiều nhãn -> xác suất nhãn cuối ("relevant")
+            if logits.shape[1] == 1:
+                batch = 1.0 / (1.0 + np.exp(-logits[:, 0]))
+            else:
+                exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+                batch = exp[:, -1] / exp.sum(axis=1)
+            scores[start : start + len(encoded)] = batch
+        return scores
+
+
+def load_reranker(
+    model_path: Union[str, Path],
+    device: str | None = None,
+    engine: str = "torch",
+    onnx_variant: str = "auto",
+):
+    if engine == "onnx":
+        if device not in (None, "cpu"):
+            raise ValueError("ONNX engine only supports CPU")
+        return OnnxCrossEncoder(model_path, variant=onnx_variant, num_threads=int(os.getenv("ONNX_THREADS", "0")) or None)
+    if engine != "torch":
+        raise ValueError(f"Unknown re-ranking engine: {engine}")
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(str(model_path), device=device)
+
+
+class RerankStats:
+    def __init__(self, candidates: int) -> None:
+        self.candidates = candidates
+        self.scored = 0
+        self.batches = 0
+        self.skipped = False  # hết budget trước khi kịp chấm batch đầu tiên
+        self.truncated = False  # chấm được một phần, phần còn lại giữ thứ tự retrieval
+        self.seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "candidates": self.candidates,
+            "scored": self.scored,
+            "batches": self.batches,
+            "skipped": self.skipped,
+            "truncated": self.truncated,
+            "ms": 1000 * self.seconds,
+        }
+
+
+class Reranker:
+    """Re-orders retrieved hits with a cross-encoder, batch by batch, within an optional latency budget.
+
+    Candidates are scored in retrieval order, so when the budget runs out the best-ranked
+    ones have been scored; unscored candidates keep their retrieval order after them.
+    """
+
+    def __init__(self, model, batch_size: int = 16, budget_ms: float | None = None) -> None:
+        self.model = model
+        self.batch_size = max(batch_size, 1)
+        self.budget_ms = budget_ms
+
+    def rerank(
+        self,
+        question: str,
+        hits: Sequence[Hit],
+        top_k: int,
+        budget_ms: float | None = None,
+        started: float | None = None,
+    ) -> Tuple[List[Hit], RerankStats]:
+        """Best ``top_k`` of ``hits``; ``started`` (perf_counter) lets the budget include earlier stages."""
+        t0 = time.perf_counter()
+        budget = self.budget_ms if budget_ms is None else budget_ms
+        deadline = (started if started is not None else t0) + budget / 1000 if budget else None
+        stats = RerankStats(len(hits))
+        scores: List[float] = []
+        batch_s = 0.0
+        for start in range(0, len(hits), self.batch_size):
+            now = time.perf_counter()
+            # Dừng nếu batch tiếp theo (ước lượng bằng batch trước) sẽ vượt budget
+            if deadline is not None and now + batch_s > deadline:
+                stats.skipped = not scores
+                stats.truncated = bool(scores)
+                break
+            part = hits[start : start + self.batch_size]
+            batch = self.model.predict([(question, doc or "") for doc, _, _ in part], batch_size=len(part))
+            scores.extend(float(s) for s in np.asarray(batch, dtype=np.float32).reshape(-1))
+            batch_s = time.perf_counter() - now
+            stats.batches += 1
+        stats.scored = len(scores)
+        order = sorted(range(len(scores)), key=lambda i: -scores[i]) + list(range(len(scores), len(hits)))
+        out: List[Hit] = []
+        for i in order[:top_k]:
+            doc, meta, dist = hits[i]
+            if i < len(scores):
+                meta = {**(meta or {}), "rerank_score": scores[i]}
+            out.append((doc, meta, dist))
+        stats.seconds = time.perf_counter() - t0
+        return out, stats
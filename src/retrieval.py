@@ -0,0 +1,179 @@
+import json
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from src.embedding import encode_texts
+from src.lexical import SEARCH_MODES, LexicalIndex, reciprocal_rank_fusion
+from src.query_cache import QueryCache, normalize_question
+from src.vectordb import Record, filter_ids, get_chunks, query_chunks, query_chunks_batch, query_records_batch
+
+
+Hit = Tuple[str, dict, float]
+HYBRID_FETCH = 4  # hybrid: mỗi bảng xếp hạng lấy top_k x 4 ứng viên trước khi gộp
+
+
+def _check_mode(mode: str, lexical: LexicalIndex | None) -> None:
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    if mode != "dense" and lexical is None:
+        raise ValueError(f"{mode} search needs a lexical index")
+
+
+def where_key(where: dict | None) -> str | None:
+    return json.dumps(where, sort_keys=True, ensure_ascii=False) if where else None
+
+
+def _cached(cache: QueryCache | None, key, compute) -> List[Hit]:
+    if cache is None:
+        return compute()
+    hits = cache.results.get(key)
+    if hits is None:
+        hits = compute()
+        cache.results.put(key, hits)
+    return list(hits)
+
+
+def lexical_hits(collection, lexical: LexicalIndex, question: str, top_k: int, where: dict | None = None) -> List[Hit]:
+    """BM25 only, no query encoding. The distance is the negated BM25 score, so lower is still better."""
+    lexical.ensure(collection)
+    allowed = filter_ids(collection, where) if where else None
+    scored = dict(lexical.search(collection.name, question, top_k, allowed))
+    return [(doc, meta, -scored[doc_id]) for doc_id, doc, meta, _ in get_chunks(collection, list(scored))]
+
+
+def fuse_hits(
+    collection,
+    lexical: LexicalIndex,
+    question: str,
+    query_emb: np.ndarray,
+    dense: List[Record],
+    top_k: int,
+    allowed: Sequence[str] | None = None,
+) -> List[Hit]:
+    """RRF of the dense candidates and the BM25 ranking; every hit keeps its dense (squared L2) distance.
+
+    ``allowed`` (ids matching the query filter) restricts the BM25 side like ``where`` did the dense one.
+    """
+    lexical.ensure(collection)
+    ranked = lexical.search(collection.name, question, max(len(dense), top_k), allowed)
+    fused = reciprocal_rank_fusion([[r[0] for r in dense], [doc_id for doc_id, _ in ranked]])[:top_k]
+    records = {r[0]: r for r in dense}
+    extra = get_chunks(collection, [doc_id for doc_id, _ in fused if doc_id not in records], query_emb)
+    records.update((r[0], r) for r in extra)
+    return [records[doc_id][1:] for doc_id, _ in fused if doc_id in records]
+
+
+def hybrid_hits(
+    collection, lexical: LexicalIndex, question: str, query_emb: np.ndarray, top_k: int, where: dict | None = None
+) -> List[Hit]:
+    query = np.asarray(query_emb, dtype=np.float32)[None, :]
+    dense = query_records_batch(collection, query, top_k * HYBRID_FETCH, where=where)[0]
+    allowed = filter_ids(collection, where) if where else None
+    return fuse_hits(collection, lexical, question, query_emb, dense, top_k, allowed)
+
+
+def encode_query(model, question: str, cache: QueryCache | None = None, model_key: str = "") -> np.ndarray:
+    if cache is not None:
+        cached = cache.get_embedding(model_key, question)
+        if cached is not None:
+            return cached
+    emb = encode_texts(model, [question], normalize=True)[0]
+    if cache is not None:
+        cache.put_embedding(model_key, question, emb)
+    return emb
+
+
+def search(
+    model,
+    collection,
+    question: str,
+    top_k: int,
+    cache: QueryCache | None = None,
+    model_key: str = "",
+    mode: str = "dense",
+    lexical: LexicalIndex | None = None,
+    where: dict | None = None,
+) -> List[Hit]:
+    """Top-k (document, metadata, distance) for ``question``; encoding and hits are cached when ``cache`` is given.
+
+    ``mode`` is dense (embedding only), lexical (BM25 only, ``model`` unused) or hybrid (both, fused by RRF).
+    ``where`` (see ``vectordb.where_filter``) limits every mode to the matching chunks.
+    """
+    _check_mode(mode, lexical)
+    wkey = where_key(where)
+    if mode == "lexical":
+        key = cache.text_key(collection.name, question, top_k, (mode, wkey)) if cache is not None else None
+        return _cached(cache, key, lambda: lexical_hits(collection, lexical, question, top_k, where))
+    emb = encode_query(model, question, cache, model_key)
+    if mode == "hybrid":
+        extra = (mode, normalize_question(question), wkey)
+        key = cache.result_key(collection.name, emb, top_k, extra) if cache is not None else None
+        return _cached(cache, key, lambda: hybrid_hits(collection, lexical, question, emb, top_k, where))
+    key = cache.result_key(collection.name, emb, top_k, wkey) if cache is not None else None
+    return _cached(cache, key, lambda: query_chunks(collection, emb, top_k, where))
+
+
+def encode_queries(
+    model,
+    questions: Sequence[str],
+    cache: QueryCache | None = None,
+    model_key: str = "",
+    batch_size: int = 64,
+) -> np.ndarray:
+    """Embeddings for ``questions`` [n, dim]; the cache misses are encoded together in one call."""
+    found: List[np.ndarray | None] = [
+        cache.get_embedding(model_key, q) if cache is not None else None for q in questions
+    ]
+    missing = [i for i, emb in enumerate(found) if emb is None]
+    if missing:
+        fresh = encode_texts(model, [questions[i] for i in missing], normalize=True, batch_size=batch_size)
+        for i, emb in zip(missing, fresh):
+            found[i] = emb
+            if cache is not None:
+                cache.put_embedding(model_key, questions[i], emb)
+    if not questions:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(found)
+
+
+def search_batch(
+    model,
+    collection,
+    questions: Sequence[str],
+    top_k: int,
+    cache: QueryCache | None = None,
+    model_key: str = "",
+    batch_size: int = 64,
+    mode: str = "dense",
+    lexical: LexicalIndex | None = None,
+    where: dict | None = None,
+) -> List[List[Hit]]:
+    """``search`` for many questions: one encode call for the uncached ones, one vectorized query for the rest."""
+    _check_mode(mode, lexical)
+    if mode == "lexical":
+        return [search(model, collection, q, top_k, cache, model_key, mode, lexical, where) for q in questions]
+    embs = encode_queries(model, questions, cache, model_key, batch_size)
+    wkey = where_key(where)
+    if mode == "dense":
+        extras = [wkey] * len(questions)
+    else:
+        extras = [(mode, normalize_question(q), wkey) for q in questions]
+    keys = [cache.result_key(collection.name, emb, top_k, extra) for emb, extra in zip(embs, extras)] if cache is not None else []
+    hits: List[List[Hit] | None] = [cache.results.get(key) for key in keys] if cache is not None else [None] * len(questions)
+    missing = [i for i, h in enumerate(hits) if h is None]
+    if missing:
+        if mode == "dense":
+            fresh = query_chunks_batch(collection, embs[missing], top_k, where=where)
+        else:
+            candidates = query_records_batch(collection, embs[missing], top_k * HYBRID_FETCH, where=where)
+            allowed = filter_ids(collection, where) if where else None
+            fresh = [
+                fuse_hits(collection, lexical, questions[i], embs[i], dense, top_k, allowed)
+                for i, dense in zip(missing, candidates)
+            ]
+        for i, found in zip(missing, fresh):
+            hits[i] = found
+            if cache is not None:
+                cache.results.put(keys[i], found)
+    return [list(h) for h in hits]
@@ -1,38 +1,1155 @@
+import atexit
+import json
+import re
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Sequence, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
 
+import numpy as np
 from chromadb import PersistentClient
 from chromadb.config import Settings
 
 
-def get_collection(db_path: Path, name: str):
+# chroma: ChromaDB; numpy: ma trận float32 memory-mapped + tìm chính xác; hnsw: cùng dữ liệu + đồ thị HNSW (hnswlib)
+STORES = ("chroma", "numpy", "hnsw")
+MATRIX_DIR = "matrix"  # <db_path>/matrix/<collection>/ cho engine numpy và hnsw
+QUERY_BLOCK = 32  # số câu hỏi mỗi lần nhân ma trận, giữ bộ nhớ tạm ở mức n_rows x 32
+SCAN_ROWS = 1024  # số dòng mã nén giải nén sang float32 mỗi lần khi quét (vừa cache CPU)
+# Kiểu lưu bản nén để quét; bản float32 đầy đủ luôn nằm trên đĩa để re-rank
+VECTOR_DTYPES = ("float32", "float16", "int8")
+CODE_FILES = {"float16": ("codes.f16", np.float16), "int8": ("codes.i8", np.int8)}
+SUBSET_ROWS = 65536  # tìm có bộ lọc: số dòng của tập con đọc vào mỗi lần
+SUBSET_CACHE = 64  # số tập dòng (theo bộ lọc) giữ lại cho tới lần ghi kế tiếp
+CHROMA_INDEX_FILE = "chroma_index.sqlite3"  # cạnh chroma.sqlite3: id -> source/page của từng collection Chroma
+LOCAL_FILTER_ROWS = 20000  # bộ lọc Chroma khớp nhiều chunk hơn thế thì để Chroma tự lọc (where gốc)
+CACHED_FILTER_ROWS = 100_000  # tổng số vector của các tập con Chroma giữ trong bộ nhớ
+# Metadata được tách thành cột có index trong items.sqlite3; các khoá khác lọc bằng json_extract
+INDEXED_FIELDS = ("source", "page")
+_FIELD_RE = re.compile(r"^\w+$")
+_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def where_filter(sources: Sequence[str] | None = None, page_min: int | None = None, page_max: int | None = None) -> dict | None:
+    """Chroma-style ``where`` for the common scopes: chunks of some sources and/or a page range."""
+    clauses: List[dict] = []
+    if sources:
+        clauses.append({"source": {"$in": list(sources)}})
+    if page_min is not None:
+        clauses.append({"page": {"$gte": page_min}})
+    if page_max is not None:
+        clauses.append({"page": {"$lte": page_max}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def where_sql(where: dict) -> Tuple[str, List]:
+    """Compile the ``where`` subset used here ($and/$or, $eq/$ne/$gt/$gte/$lt/$lte/$in/$nin) to SQL over ``items``."""
+    parts: List[str] = []
+    params: List = []
+    for field, cond in where.items():
+        if field in ("$and", "$or"):
+            subs = [where_sql(c) for c in cond]
+            if not subs:
+                continue
+            parts.append("(" + f" {field[1:].upper()} ".join(sql for sql, _ in subs) + ")")
+            params.extend(p for _, sub in subs for p in sub)
+            continue
+        if not _FIELD_RE.match(field):
+            raise ValueError(f"Invalid metadata field in where: {field!r}")
+        column = field if field in INDEXED_FIELDS else f"json_extract(metadata, '$.{field}')"
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            if op in ("$in", "$nin"):
+                values = list(value)
+                if not values:
+                    parts.append("0" if op == "$in" else "1")
+                    continue
+                marks = ",".join("?" * len(values))
+                parts.append(f"{column} {'IN' if op == '$in' else 'NOT IN'} ({marks})")
+                params.extend(values)
+            elif op in _OPERATORS:
+                parts.append(f"{column} {_OPERATORS[op]} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported where operator: {op}")
+    return (" AND ".join(parts) or "1"), params
+
+
+def _indexed(meta: dict | None) -> Tuple[str | None, int | None]:
+    if not meta:
+        return None, None
+    page = meta.get("page")
+    return meta.get("source"), page if isinstance(page, int) else None
+
+
+class MatrixCollection:
+    """Collection with the Chroma API subset used here, backed by a memory-mapped float32 matrix.
+
+    Vectors live in ``vectors.f32`` (rows of deleted ids are reused); ids, documents and metadata
+    in SQLite. Search is exact: one matmul per block of queries plus argpartition. Distances are
+    squared L2 like Chroma's default space, so the engines are interchangeable.
+
+    With ``dtype`` float16 or int8 (symmetric, per-dimension scale) the scan runs over a
+    compressed copy of the matrix and the top ``k * rerank`` candidates are re-ranked exactly
+    against the float32 rows on disk.
+    """
+
+    def __init__(self, root: Path, name: str, dtype: str = "float32", rerank: int = 4) -> None:
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unknown vector dtype: {dtype}")
+        self.dtype = dtype
+        self.rerank = max(rerank, 1)
+        self._codes: np.memmap | None = None
+        self._scale: np.ndarray | None = None
+        self.name = name
+        self.path = Path(root) / name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.vec_path = self.path / "vectors.f32"
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.path / "items.sqlite3"), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                row INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, document TEXT, metadata TEXT,
+                source TEXT, page INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """
+        )
+        self._migrate()
+        self._subsets: Dict[str, Tuple[int, np.ndarray]] = {}
+        self._closed = False
+        self._load()
+
+    def _migrate(self) -> None:
+        # Collection tạo trước khi có cột source/page: thêm cột rồi điền từ metadata JSON
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(items)")}
+        if "source" not in columns:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(items)")}
+                if "source" not in columns:
+                    self._conn.execute("ALTER TABLE items ADD COLUMN source TEXT")
+                    self._conn.execute("ALTER TABLE items ADD COLUMN page INTEGER")
+                    self._conn.execute(
+                        "UPDATE items SET source = json_extract(metadata, '$.source'), "
+                        "page = CASE json_type(metadata, '$.page') WHEN 'integer' THEN json_extract(metadata, '$.page') END"
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_by_source ON items (source, page)")
+
+    # --- trạng thái trong bộ nhớ -------------------------------------------------------------
+    def _info(self, key: str) -> int | None:
+        row = self._conn.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _load(self) -> None:
+        with self._lock:
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            self.dim = self._info("dim")
+            self.generation = self._info("generation") or 0
+            self._next_row = self._info("next_row") or 0
+            self._row_of: Dict[str, int] = {}
+            self._id_at: Dict[int, str] = {}
+            for row, item_id in self._conn.execute("SELECT row, id FROM items"):
+                self._row_of[item_id] = row
+                self._id_at[row] = item_id
+            self._vec = None
+            cap = self._capacity()
+            self._alive = np.zeros(cap, dtype=bool)
+            self._norms = np.zeros(cap, dtype=np.float32)
+            if self.dim and cap:
+                self._vec = np.memmap(self.vec_path, dtype=np.float32, mode="r+", shape=(cap, self.dim))
+                rows = np.fromiter(self._id_at, dtype=np.int64, count=len(self._id_at))
+                self._alive[rows] = True
+                self._norms[rows] = np.einsum("ij,ij->i", self._vec[rows], self._vec[rows])
+            self._free = sorted((set(range(self._next_row)) - set(self._id_at)), reverse=True)
+            self._load_codes()
+
+    # --- bản nén (float16/int8) ------------------------------------------------------------------
+    def _load_codes(self) -> None:
+        self._codes = None
+        if self.dtype == "float32" or not self.dim or self._vec is None:
+            return
+        name, code_dtype = CODE_FILES[self.dtype]
+        path = self.path / name
+        cap = len(self._vec)
+        fresh = path.exists() and path.stat().st_size == cap * self.dim * np.dtype(code_dtype).itemsize
+        if self.dtype == "int8":
+            scale_path = self.path / "codes.i8.scale"
+            fresh = fresh and scale_path.exists()
+            self._scale = np.fromfile(scale_path, dtype=np.float32) if fresh else None
+        # Tiến trình khác ghi mà không cập nhật bản nén (dtype khác) -> dựng lại từ float32
+        if fresh and self._info(f"codes_{self.dtype}") == self.generation:
+            self._codes = np.memmap(path, dtype=code_dtype, mode="r+", shape=(cap, self.dim))
+            return
+        self._rebuild_codes()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", (f"codes_{self.dtype}", self.generation)
+        )
+
+    def _rebuild_codes(self) -> None:
+        name, code_dtype = CODE_FILES[self.dtype]
+        if self.dtype == "int8":
+            rows = np.flatnonzero(self._alive)
+            scale = np.full(self.dim, 1e-6, dtype=np.float32)
+            for start in range(0, len(rows), SCAN_ROWS):
+                scale = np.maximum(scale, np.abs(self._vec[rows[start : start + SCAN_ROWS]]).max(axis=0))
+            self._set_scale(scale)
+        with (self.path / name).open("wb") as f:
+            f.truncate(len(self._vec) * self.dim * np.dtype(code_dtype).itemsize)
+        self._codes = np.memmap(self.path / name, dtype=code_dtype, mode="r+", shape=(len(self._vec), self.dim))
+        self._requantize()
+
+    def _requantize(self) -> None:
+        rows = np.flatnonzero(self._alive)
+        for start in range(0, len(rows), SCAN_ROWS):
+            part = rows[start : start + SCAN_ROWS]
+            self._codes[part] = self._quantize(np.asarray(self._vec[part]))
+        self._codes.flush()
+
+    def _set_scale(self, scale: np.ndarray) -> None:
+        self._scale = scale.astype(np.float32)
+        self._scale.tofile(self.path / "codes.i8.scale")
+
+    def _quantize(self, emb: np.ndarray) -> np.ndarray:
+        if self.dtype == "float16":
+            return emb.astype(np.float16)
+        return np.clip(np.rint(emb / self._scale * 127.0), -127, 127).astype(np.int8)
+
+    def _write_codes(self, rows: np.ndarray, emb: np.ndarray) -> None:
+        """Keep the compressed copy in step with rows just written to the float32 matrix."""
+        if self.dtype == "float32":
+            return
+        if self._codes is None or (self.dtype == "int8" and self._scale is None):
+            self._rebuild_codes()
+            return
+        if len(self._codes) < len(self._vec):
+            name, code_dtype = CODE_FILES[self.dtype]
+            self._codes.flush()
+            with (self.path / name).open("ab") as f:
+                f.truncate(len(self._vec) * self.dim * np.dtype(code_dtype).itemsize)
+            self._codes = np.memmap(self.path / name, dtype=code_dtype, mode="r+", shape=(len(self._vec), self.dim))
+        if self.dtype == "int8":
+            peak = np.abs(emb).max(axis=0)
+            if np.any(peak > self._scale):
+                # Vượt thang đo hiện tại: nới thang (dư 5%) rồi lượng tử hoá lại mọi dòng
+                self._set_scale(np.maximum(self._scale, peak * 1.05))
+                self._requantize()
+                return
+        self._codes[rows] = self._quantize(emb)
+        self._codes.flush()
+
+    def _refresh(self) -> None:
+        # data_version chỉ đổi khi connection khác (tiến trình khác) commit
+        if self._conn.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self._load()
+
+    def _capacity(self) -> int:
+        if not self.dim or not self.vec_path.exists():
+            return 0
+        return self.vec_path.stat().st_size // (4 * self.dim)
+
+    def _grow(self, rows: int) -> None:
+        cap = self._capacity()
+        if rows <= cap:
+            return
+        new_cap = max(rows, cap * 2, 1024)
+        if self._vec is not None:
+            self._vec.flush()
+        with self.vec_path.open("ab") as f:
+            f.truncate(new_cap * 4 * self.dim)
+        self._vec = np.memmap(self.vec_path, dtype=np.float32, mode="r+", shape=(new_cap, self.dim))
+        self._alive = np.concatenate([self._alive, np.zeros(new_cap - len(self._alive), dtype=bool)])
+        self._norms = np.concatenate([self._norms, np.zeros(new_cap - len(self._norms), dtype=np.float32)])
+
+    @contextmanager
+    def _write(self) -> Iterator[None]:
+        """SQLite's write lock (BEGIN IMMEDIATE) from ``_refresh`` through ``_commit``: row allocation
+        and the memmap write of two processes cannot interleave, so no row is claimed twice."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()
+                yield
+                if self._conn.in_transaction:  # thân hàm không ghi gì (return sớm)
+                    self._conn.execute("COMMIT")
+            except BaseException:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                self._load()
+                raise
+
+    def _commit(self, statements: Iterable[Tuple[str, Sequence]]) -> None:
+        """Run ``statements``, bump the generation and commit the transaction opened by ``_write``."""
+        for sql, params in statements:
+            if params and isinstance(params[0], (list, tuple)):
+                self._conn.executemany(sql, params)
+            else:
+                self._conn.execute(sql, params)
+        self.generation += 1
+        info = [("dim", self.dim), ("next_row", self._next_row), ("generation", self.generation)]
+        if self._codes is not None:
+            info.append((f"codes_{self.dtype}", self.generation))
+        self._conn.executemany("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", info)
+        self._conn.execute("COMMIT")
+
+    # --- API giống Chroma ----------------------------------------------------------------------
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._row_of)
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        embeddings,
+        documents: Sequence[str] | None = None,
+        metadatas: Sequence[dict] | None = None,
+    ) -> None:
+        ids = list(ids)
+        if not ids:
+            return
+        emb = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        documents = list(documents) if documents is not None else [None] * len(ids)
+        metadatas = list(metadatas) if metadatas is not None else [None] * len(ids)
+        with self._write():
+            if self.dim is None:
+                self.dim = emb.shape[1]
+            if emb.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {emb.shape[1]} does not match collection dimension {self.dim}")
+            rows: List[int] = []
+            for item_id in ids:
+                row = self._row_of.get(item_id)
+                if row is None:
+                    row = self._free.pop() if self._free else self._next_row
+                    self._next_row = max(self._next_row, row + 1)
+                    self._row_of[item_id] = row
+                    self._id_at[row] = item_id
+                rows.append(row)
+            self._grow(self._next_row)
+            # Ghi vector trước rồi mới commit SQLite: crash giữa chừng chỉ để lại dòng không ai trỏ tới
+            self._vec[rows] = emb
+            self._vec.flush()
+            self._alive[rows] = True
+            self._norms[rows] = np.einsum("ij,ij->i", emb, emb)
+            self._write_codes(np.asarray(rows, dtype=np.int64), emb)
+            self._commit(
+                [
+                    (
+                        "INSERT OR REPLACE INTO items (row, id, document, metadata, source, page) VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (row, item_id, doc, None if meta is None else json.dumps(meta, ensure_ascii=False), *_indexed(meta))
+                            for row, item_id, doc, meta in zip(rows, ids, documents, metadatas)
+                        ],
+                    )
+                ]
+            )
+            self._on_upsert(np.asarray(rows, dtype=np.int64), emb)
+
+    def add(self, ids, embeddings, documents=None, metadatas=None) -> None:
+        self.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def update(self, ids: Sequence[str], embeddings=None, documents=None, metadatas=None) -> None:
+        ids = list(ids)
+        with self._write():
+            known = [i for i, item_id in enumerate(ids) if item_id in self._row_of]
+            if not known:
+                return
+            if embeddings is not None:
+                emb = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)[known]
+                rows = np.asarray([self._row_of[ids[i]] for i in known], dtype=np.int64)
+                self._vec[rows] = emb
+                self._vec.flush()
+                self._norms[rows] = np.einsum("ij,ij->i", emb, emb)
+                self._write_codes(rows, emb)
+                self._on_upsert(rows, emb)
+            statements = []
+            if documents is not None:
+                statements.append(
+                    ("UPDATE items SET document = ? WHERE id = ?", [(documents[i], ids[i]) for i in known])
+                )
+            if metadatas is not None:
+                statements.append(
+                    (
+                        "UPDATE items SET metadata = ?, source = ?, page = ? WHERE id = ?",
+                        [(json.dumps(metadatas[i], ensure_ascii=False), *_indexed(metadatas[i]), ids[i]) for i in known],
+                    )
+                )
+            self._commit(statements)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self._write():
+            gone = [(item_id, self._row_of.pop(item_id)) for item_id in ids if item_id in self._row_of]
+            if not gone:
+                return
+            rows = [row for _, row in gone]
+            for row in rows:
+                del self._id_at[row]
+            self._alive[rows] = False
+            self._free.extend(rows)
+            self._free.sort(reverse=True)
+            self._commit([("DELETE FROM items WHERE id = ?", [(item_id,) for item_id, _ in gone])])
+            self._on_delete(np.asarray(rows, dtype=np.int64))
+
+    def get(
+        self,
+        ids: Sequence[str] | None = None,
+        include: Sequence[str] = ("documents", "metadatas"),
+        where: dict | None = None,
+    ) -> dict:
+        with self._lock:
+            self._refresh()
+            if ids is None:
+                rows = sorted(self._id_at) if where is None else self._filter_rows(where).tolist()
+            else:
+                rows = [self._row_of[i] for i in dict.fromkeys(ids) if i in self._row_of]
+                if where is not None:
+                    allowed = set(self._filter_rows(where).tolist())
+                    rows = [r for r in rows if r in allowed]
+            records = self._fetch(rows)
+            out: dict = {"ids": [records[r][0] for r in rows if r in records]}
+            kept = [r for r in rows if r in records]
+            if "documents" in include:
+                out["documents"] = [records[r][1] for r in kept]
+            if "metadatas" in include:
+                out["metadatas"] = [records[r][2] for r in kept]
+            if "embeddings" in include:
+                out["embeddings"] = np.asarray(self._vec[kept]) if kept else np.zeros((0, self.dim or 0), np.float32)
+            return out
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 10,
+        include: Sequence[str] = ("documents", "metadatas", "distances"),
+        where: dict | None = None,
+    ) -> dict:
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        with self._lock:
+            self._refresh()
+            subset = self._filter_rows(where) if where is not None and self._row_of else None
+            if not self._row_of or n_results <= 0 or (subset is not None and not len(subset)):
+                empty = [[] for _ in range(len(queries))]
+                return {"ids": empty, **{key: [[] for _ in queries] for key in include}}
+            if queries.shape[1] != self.dim:
+                raise ValueError(f"Query dimension {queries.shape[1]} does not match collection dimension {self.dim}")
+            if subset is not None:
+                # Chỉ chấm các dòng khớp bộ lọc, không lọc sau trên top-k toàn cục
+                rows, dists = self._search_rows(queries, subset, min(n_results, len(subset)))
+            else:
+                rows, dists = self._search(queries, min(n_results, len(self._row_of)))
+            records = self._fetch(sorted({int(r) for r in rows.ravel() if r >= 0}))
+        out: dict = {"ids": []}
+        for key in include:
+            out[key] = []
+        for q_rows, q_dists in zip(rows, dists):
+            hits = [(int(r), float(d)) for r, d in zip(q_rows, q_dists) if int(r) in records]
+            out["ids"].append([records[r][0] for r, _ in hits])
+            if "documents" in include:
+                out["documents"].append([records[r][1] for r, _ in hits])
+            if "metadatas" in include:
+                out["metadatas"].append([records[r][2] for r, _ in hits])
+            if "distances" in include:
+                out["distances"].append([d for _, d in hits])
+        return out
+
+    # --- tìm kiếm: lớp con (HNSW) thay _search / _on_upsert / _on_delete ------------------------
+    def _search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        n = self._next_row
+        norms = self._norms[:n]
+        dead = ~self._alive[:n]
+        # Quét trên bản nén lấy k * rerank ứng viên, rồi tính lại khoảng cách chính xác từ float32
+        cand_k = k if self._codes is None else min(k * self.rerank, n - int(dead.sum()))
+        out_rows = np.empty((len(queries), k), dtype=np.int64)
+        out_dists = np.empty((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), QUERY_BLOCK):
+            block = queries[start : start + QUERY_BLOCK]
+            q_norms = np.einsum("ij,ij->i", block, block)
+            # ||x - q||^2 = ||x||^2 + ||q||^2 - 2 x.q
+            dists = norms[:, None] - 2.0 * self._dots(block, n)
+            dists += q_norms[None, :]
+            dists[dead] = np.inf
+            if cand_k < n:
+                top = np.argpartition(dists, cand_k - 1, axis=0)[:cand_k]
+            else:
+                top = np.arange(n)[:, None].repeat(len(block), 1)
+            if self._codes is None:
+                top_d = np.take_along_axis(dists, top, axis=0)
+            else:
+                top_d = np.empty(top.shape, dtype=np.float32)
+                for j in range(len(block)):
+                    rows = np.sort(top[:, j])
+                    top[:, j] = rows
+                    top_d[:, j] = norms[rows] - 2.0 * (np.asarray(self._vec[rows]) @ block[j]) + q_norms[j]
+                    top_d[dead[rows], j] = np.inf
+            order = np.argsort(top_d, axis=0, kind="stable")[:k]
+            out_rows[start : start + len(block)] = np.take_along_axis(top, order, axis=0).T
+            out_dists[start : start + len(block)] = np.maximum(np.take_along_axis(top_d, order, axis=0).T, 0.0)
+        return out_rows, out_dists
+
+    def _filter_rows(self, where: dict) -> np.ndarray:
+        """Sorted matrix rows matching ``where``, from the indexed source/page columns; cached per generation."""
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        cached = self._subsets.get(key)
+        if cached is not None and cached[0] == self.generation:
+            return cached[1]
+        sql, params = where_sql(where)
+        rows = np.fromiter((r for (r,) in self._conn.execute(f"SELECT row FROM items WHERE {sql}", params)), np.int64)
+        rows.sort()
+        if len(self._subsets) >= SUBSET_CACHE:
+            self._subsets.pop(next(iter(self._subsets)))
+        self._subsets[key] = (self.generation, rows)
+        return rows
+
+    def _search_rows(self, queries: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k over the given rows only, reading ``SUBSET_ROWS`` float32 rows at a time."""
+        out_rows = np.empty((len(queries), k), dtype=np.int64)
+        out_dists = np.empty((len(queries), k), dtype=np.float32)
+        for qs in range(0, len(queries), QUERY_BLOCK):
+            block = queries[qs : qs + QUERY_BLOCK]
+            q_norms = np.einsum("ij,ij->i", block, block)
+            best_rows = np.empty((0, len(block)), dtype=np.int64)
+            best_d = np.empty((0, len(block)), dtype=np.float32)
+            for start in range(0, len(rows), SUBSET_ROWS):
+                part = rows[start : start + SUBSET_ROWS]
+                d = self._norms[part][:, None] - 2.0 * (np.asarray(self._vec[part]) @ block.T) + q_norms[None, :]
+                cand_d = np.concatenate([best_d, d])
+                cand_rows = np.concatenate([best_rows, np.repeat(part[:, None], len(block), axis=1)])
+                if len(cand_d) > k:
+                    top = np.argpartition(cand_d, k - 1, axis=0)[:k]
+                    cand_d = np.take_along_axis(cand_d, top, axis=0)
+                    cand_rows = np.take_along_axis(cand_rows, top, axis=0)
+                best_d, best_rows = cand_d, cand_rows
+            order = np.argsort(best_d, axis=0, kind="stable")[:k]
+            out_rows[qs : qs + len(block)] = np.take_along_axis(best_rows, order, axis=0).T
+            out_dists[qs : qs + len(block)] = np.maximum(np.take_along_axis(best_d, order, axis=0).T, 0.0)
+        return out_rows, out_dists
+
+    def _dots(self, block: np.ndarray, n: int) -> np.ndarray:
+        if self._codes is None:
+            return self._vec[:n] @ block.T
+        # int8: x ~ code * scale / 127 nên x.q ~ code . (q * scale / 127)
+        q = block * (self._scale / 127.0) if self.dtype == "int8" else block
+        q = np.ascontiguousarray(q.T, dtype=np.float32)
+        dots = np.empty((n, len(block)), dtype=np.float32)
+        buf = np.empty((SCAN_ROWS, self.dim), dtype=np.float32)
+        for start in range(0, n, SCAN_ROWS):
+            end = min(start + SCAN_ROWS, n)
+            rows = buf[: end - start]
+            np.copyto(rows, self._codes[start:end], casting="unsafe")
+            np.matmul(rows, q, out=dots[start:end])
+        return dots
+
+    def _on_upsert(self, rows: np.ndarray, emb: np.ndarray) -> None:
+        pass
+
+    def _on_delete(self, rows: np.ndarray) -> None:
+        pass
+
+    def _fetch(self, rows: Sequence[int]) -> Dict[int, Tuple[str, str | None, dict | None]]:
+        records: Dict[int, Tuple[str, str | None, dict | None]] = {}
+        rows = list(rows)
+        for start in range(0, len(rows), 500):
+            part = rows[start : start + 500]
+            marks = ",".join("?" * len(part))
+            for row, item_id, doc, meta in self._conn.execute(
+                f"SELECT row, id, document, metadata FROM items WHERE row IN ({marks})", part
+            ):
+                records[row] = (item_id, doc, None if meta is None else json.loads(meta))
+        return records
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._vec is not None:
+                self._vec.flush()
+            self._conn.close()
+
+
+class HnswCollection(MatrixCollection):
+    """MatrixCollection searched through an HNSW graph (hnswlib) instead of a full scan.
+
+    The matrix stays the source of truth: the graph is saved on close with the collection
+    generation and rebuilt from the matrix when it is missing or out of date.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        name: str,
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+    ) -> None:
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._index = None
+        self._index_generation = -1
+        super().__init__(root, name)
+        atexit.register(self.close)
+
+    def _load(self) -> None:
+        with self._lock:
+            super()._load()
+            self._load_index()
+
+    def _load_index(self) -> None:
+        import hnswlib  # type: ignore
+
+        self._index = None
+        if not self.dim:
+            return
+        index_path = self.path / "hnsw.bin"
+        meta_path = self.path / "hnsw.json"
+        cap = max(self._capacity(), 1)
+        index = hnswlib.Index(space="l2", dim=self.dim)
+        saved = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+        if index_path.exists() and saved.get("generation") == self.generation:
+            index.load_index(str(index_path), max_elements=cap)
+            self._index_generation = self.generation
+        else:
+            self._index_generation = -1
+            index.init_index(max_elements=cap, ef_construction=self.ef_construction, M=self.m)
+            rows = np.flatnonzero(self._alive)
+            for start in range(0, len(rows), 10000):
+                part = rows[start : start + 10000]
+                index.add_items(np.asarray(self._vec[part]), part)
+        self._index = index
+
+    def _ensure_index(self, dim: int) -> None:
+        import hnswlib  # type: ignore
+
+        if self._index is None:
+            self._index = hnswlib.Index(space="l2", dim=dim)
+            self._index.init_index(max_elements=max(self._capacity(), 1), ef_construction=self.ef_construction, M=self.m)
+        elif self._index.get_max_elements() < self._capacity():
+            self._index.resize_index(self._capacity())
+
+    def _on_upsert(self, rows: np.ndarray, emb: np.ndarray) -> None:
+        self._ensure_index(emb.shape[1])
+        # Nhãn trong đồ thị = số dòng của ma trận; thêm lại nhãn đã xoá sẽ cập nhật và bỏ đánh dấu xoá
+        self._index.add_items(emb, rows)
+
+    def _on_delete(self, rows: np.ndarray) -> None:
+        if self._index is None:
+            return
+        for row in rows:
+            self._index.mark_deleted(int(row))
+
+    def _search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self._index.set_ef(max(self.ef_search, k))
+        labels, dists = self._index.knn_query(queries, k=k)
+        return labels.astype(np.int64), dists
+
+    def persist(self) -> None:
+        with self._lock:
+            if self._index is None or self._index_generation == self.generation:
+                return
+            self._index.save_index(str(self.path / "hnsw.bin"))
+            (self.path / "hnsw.json").write_text(json.dumps({"generation": self.generation}), encoding="utf-8")
+            self._index_generation = self.generation
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self.persist()
+            super().close()
+        atexit.unregister(self.close)
+
+
+def _where_fields(where: dict) -> set:
+    fields: set = set()
+    for field, cond in where.items():
+        if field in ("$and", "$or"):
+            for sub in cond:
+                fields |= _where_fields(sub)
+        else:
+            fields.add(field)
+    return fields
+
+
+class ChromaIndex:
+    """Local (collection, id) -> (source, page) table for Chroma collections, in one SQLite file per
+    database; ``generation`` counts writes per collection so other handles and processes notice them."""
+
+    def __init__(self, path: Path) -> None:
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                collection TEXT NOT NULL, id TEXT NOT NULL, source TEXT, page INTEGER,
+                PRIMARY KEY (collection, id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS items_by_source ON items (collection, source, page);
+            CREATE TABLE IF NOT EXISTS generations (collection TEXT PRIMARY KEY, generation INTEGER NOT NULL);
+            """
+        )
+
+    def _write(self, collection: str, statements: Iterable[Tuple[str, Sequence]]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    if params and isinstance(params[0], (list, tuple)):
+                        self._conn.executemany(sql, params)
+                    else:
+                        self._conn.execute(sql, params)
+                self._conn.execute(
+                    "INSERT INTO generations (collection, generation) VALUES (?, 1) "
+                    "ON CONFLICT (collection) DO UPDATE SET generation = generation + 1",
+                    (collection,),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def put(self, collection: str, ids: Sequence[str], metadatas: Sequence[dict | None], replace: bool = False) -> None:
+        rows = [(collection, i, *_indexed(m)) for i, m in zip(ids, metadatas)]
+        statements: List[Tuple[str, Sequence]] = [("DELETE FROM items WHERE collection = ?", (collection,))] if replace else []
+        if rows:
+            statements.append(("INSERT OR REPLACE INTO items (collection, id, source, page) VALUES (?, ?, ?, ?)", rows))
+        self._write(collection, statements)
+
+    def remove(self, collection: str, ids: Sequence[str]) -> None:
+        self._write(collection, [("DELETE FROM items WHERE collection = ? AND id = ?", [(collection, i) for i in ids])] if ids else [])
+
+    def drop(self, collection: str) -> None:
+        self._write(collection, [("DELETE FROM items WHERE collection = ?", (collection,))])
+
+    def count(self, collection: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM items WHERE collection = ?", (collection,)).fetchone()[0]
+
+    def generation(self, collection: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT generation FROM generations WHERE collection = ?", (collection,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def ids(self, collection: str, where: dict) -> List[str]:
+        """Ids matching ``where`` (source/page fields only), sorted."""
+        sql, params = where_sql(where)
+        query = f"SELECT id FROM items WHERE collection = ? AND {sql} ORDER BY id"
+        with self._lock:
+            return [i for (i,) in self._conn.execute(query, [collection, *params])]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ChromaCollection:
+    """Chroma collection whose source/page filters are served locally.
+
+    Writes made through this handle also update a ``ChromaIndex``. A ``where`` on source/page is
+    resolved there to the matching ids. Only those vectors are fetched from Chroma (and cached until
+    the next write), then scored exactly like ``MatrixCollection._search_rows``. Other filters, and
+    filters matching more than ``LOCAL_FILTER_ROWS`` chunks, use Chroma's own ``where``. A
+    collection written without this handle (index count differs) is re-indexed when opened.
+    """
+
+    def __init__(self, collection, index: ChromaIndex, owns_index: bool = False) -> None:
+        self._coll = collection
+        self._index = index
+        self._owns_index = owns_index
+        self.name = collection.name
+        self._space = (getattr(collection, "metadata", None) or {}).get("hnsw:space", "l2")
+        self._lock = threading.RLock()
+        self._subsets: Dict[str, Tuple[int, List[str] | None, np.ndarray | None]] = {}
+        if index.count(self.name) != collection.count():
+            self.reindex()
+
+    def __getattr__(self, attr: str):
+        # Phần API còn lại của Chroma (count, modify, ...) đi thẳng tới collection gốc
+        return getattr(self._coll, attr)
+
+    def reindex(self, batch_size: int = 5000) -> None:
+        ids: List[str] = []
+        metas: List[dict | None] = []
+        for offset in range(0, self._coll.count(), batch_size):
+            part = self._coll.get(include=["metadatas"], limit=batch_size, offset=offset)
+            ids.extend(part.get("ids", []))
+            metas.extend(part.get("metadatas") or [None] * len(part.get("ids", [])))
+        self._index.put(self.name, ids, metas, replace=True)
+
+    def upsert(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        self._coll.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        self._index.put(self.name, list(ids), list(metadatas) if metadatas is not None else [None] * len(ids))
+
+    def add(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        self._coll.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        self._index.put(self.name, list(ids), list(metadatas) if metadatas is not None else [None] * len(ids))
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None) -> None:
+        self._coll.update(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        if metadatas is not None:
+            self._index.put(self.name, list(ids), list(metadatas))
+        elif embeddings is not None:
+            self._index.put(self.name, [], [])  # chỉ tăng generation: vector trong cache đã cũ
+
+    def delete(self, ids=None, where: dict | None = None) -> None:
+        if ids is None:
+            ids = self.get(where=where, include=[]).get("ids", []) if where else []
+        ids = list(ids)
+        if ids:
+            self._coll.delete(ids=ids)
+            self._index.remove(self.name, ids)
+
+    def _vectors(self, ids: List[str]) -> Tuple[List[str], np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(ids), 5000):
+            part = self._coll.get(ids=ids[start : start + 5000], include=["embeddings"])
+            found.update(zip(part.get("ids", []), np.asarray(part["embeddings"], dtype=np.float32)))
+        # Id có trong index nhưng không còn trong Chroma (xoá từ nơi khác) thì bỏ
+        ids = [i for i in ids if i in found]
+        return ids, np.stack([found[i] for i in ids]) if ids else np.zeros((0, 0), np.float32)
+
+    def _subset(self, where: dict, vectors: bool = True) -> Tuple[List[str] | None, np.ndarray | None]:
+        """(ids, vectors) of the chunks matching ``where``; (None, None) when Chroma has to filter."""
+        if not where or not _where_fields(where) <= set(INDEXED_FIELDS):
+            return None, None
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            generation = self._index.generation(self.name)
+            cached = self._subsets.get(key)
+            if cached is not None and cached[0] == generation and (cached[1] is None or cached[2] is not None or not vectors):
+                return cached[1], cached[2]
+            try:
+                ids: List[str] | None = self._index.ids(self.name, where)
+            except ValueError:
+                return None, None
+            vecs = None
+            if len(ids) > LOCAL_FILTER_ROWS:
+                ids = None
+            elif not vectors:
+                return ids, None
+            else:
+                ids, vecs = self._vectors(ids)
+            self._subsets[key] = (generation, ids, vecs)
+            # Giới hạn bộ nhớ: bỏ tập con cũ nhất khi quá nhiều bộ lọc hoặc quá nhiều vector
+            while len(self._subsets) > 1 and (
+                len(self._subsets) > SUBSET_CACHE
+                or sum(len(v) for _, _, v in self._subsets.values() if v is not None) > CACHED_FILTER_ROWS
+            ):
+                self._subsets.pop(next(iter(self._subsets)))
+            return ids, vecs
+
+    def get(self, ids=None, where: dict | None = None, include=("documents", "metadatas"), **kwargs) -> dict:
+        if where is not None and not kwargs:
+            matched, _ = self._subset(where, vectors=False)
+            if matched is not None:
+                if ids is not None:
+                    allowed = set(matched)
+                    matched = [i for i in dict.fromkeys(ids) if i in allowed]
+                if not matched:
+                    return {"ids": [], **{key: [] for key in include}}
+                if not include:
+                    return {"ids": matched}
+                return self._coll.get(ids=matched, include=list(include))
+        if ids is not None and not list(ids):
+            return {"ids": [], **{key: [] for key in include}}
+        extra = {"where": where} if where is not None else {}
+        return self._coll.get(ids=ids, include=list(include), **extra, **kwargs)
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 10,
+        include: Sequence[str] = ("documents", "metadatas", "distances"),
+        where: dict | None = None,
+    ) -> dict:
+        ids, vecs = self._subset(where) if where else (None, None)
+        if ids is None:
+            extra = {"where": where} if where else {}
+            return self._coll.query(query_embeddings=query_embeddings, n_results=n_results, include=list(include), **extra)
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        out: dict = {"ids": [], **{key: [] for key in include}}
+        if not ids or n_results <= 0:
+            for _ in queries:
+                for key in out:
+                    out[key].append([])
+            return out
+        if queries.shape[1] != vecs.shape[1]:
+            raise ValueError(f"Query dimension {queries.shape[1]} does not match collection dimension {vecs.shape[1]}")
+        dots = vecs @ queries.T
+        if self._space == "l2":
+            d = np.einsum("ij,ij->i", vecs, vecs)[:, None] - 2.0 * dots + np.einsum("ij,ij->i", queries, queries)[None, :]
+            d = np.maximum(d, 0.0)
+        elif self._space == "cosine":
+            norms = np.linalg.norm(vecs, axis=1)[:, None] * np.linalg.norm(queries, axis=1)[None, :]
+            d = 1.0 - dots / np.maximum(norms, 1e-12)
+        else:
+            d = 1.0 - dots
+        k = min(n_results, len(ids))
+        top = np.argpartition(d, k - 1, axis=0)[:k] if k < len(ids) else np.repeat(np.arange(len(ids))[:, None], len(queries), axis=1)
+        top_d = np.take_along_axis(d, top, axis=0)
+        order = np.argsort(top_d, axis=0, kind="stable")
+        top = np.take_along_axis(top, order, axis=0).T
+        top_d = np.take_along_axis(top_d, order, axis=0).T
+        records: Dict[str, Tuple[str | None, dict | None]] = {}
+        wanted = [ids[r] for r in dict.fromkeys(int(r) for r in top.ravel())]
+        if "documents" in include or "metadatas" in include:
+            got = self._coll.get(ids=wanted, include=["documents", "metadatas"])
+            for i, doc, meta in zip(got.get("ids", []), got.get("documents") or [], got.get("metadatas") or []):
+                records[i] = (doc, meta)
+        for q_rows, q_dists in zip(top, top_d):
+            hit_ids = [ids[int(r)] for r in q_rows]
+            out["ids"].append(hit_ids)
+            if "documents" in include:
+                out["documents"].append([records.get(i, (None, None))[0] for i in hit_ids])
+            if "metadatas" in include:
+                out["metadatas"].append([records.get(i, (None, None))[1] for i in hit_ids])
+            if "distances" in include:
+                out["distances"].append([float(x) for x in q_dists])
+            if "embeddings" in include:
+                out["embeddings"].append(vecs[q_rows])
+        return out
+
+    def close(self) -> None:
+        if self._owns_index:
+            self._index.close()
+
+
+def store_root(db_path: Path, store: str = "chroma") -> Path:
+    """Directory holding a store's data; numpy and hnsw share theirs (same matrix, different search)."""
+    return db_path if store == "chroma" else db_path / MATRIX_DIR
+
+
+def check_store_dtype(store: str, dtype: str) -> None:
+    """Only the numpy store keeps float16/int8 codes; chroma and hnsw would silently store float32."""
+    if store not in STORES:
+        raise ValueError(f"Unknown vector store: {store}")
+    if dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype: {dtype}")
+    if dtype != "float32" and store != "numpy":
+        raise ValueError(f"Vector dtype {dtype} needs the numpy store (got {store})")
+
+
+def get_collection(db_path: Path, name: str, store: str = "chroma", dtype: str = "float32"):
+    check_store_dtype(store, dtype)
     db_path.mkdir(parents=True, exist_ok=True)
+    if store == "numpy":
+        return MatrixCollection(db_path / MATRIX_DIR, name, dtype=dtype)
+    if store == "hnsw":
+        return HnswCollection(db_path / MATRIX_DIR, name)
     client = PersistentClient(path=str(db_path), settings=Settings())
-    return client.get_or_create_collection(name=name)
+    return ChromaCollection(client.get_or_create_collection(name=name), ChromaIndex(db_path / CHROMA_INDEX_FILE), owns_index=True)
+
+
+class CollectionRegistry:
+    """One client (or one handle per matrix collection) per process, cached and safe to share between threads."""
+
+    def __init__(self, db_path: Path, store: str = "chroma", dtype: str = "float32") -> None:
+        check_store_dtype(store, dtype)
+        db_path.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.store = store
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._client = PersistentClient(path=str(db_path), settings=Settings()) if store == "chroma" else None
+        self._index = ChromaIndex(db_path / CHROMA_INDEX_FILE) if store == "chroma" else None
+        self._collections: Dict[str, object] = {}
+
+    def _open(self, name: str):
+        if self._client is not None:
+            return ChromaCollection(self._client.get_or_create_collection(name=name), self._index)
+        return get_collection(self.db_path, name, self.store, self.dtype)
 
+    def get(self, name: str):
+        coll = self._collections.get(name)
+        if coll is not None:
+            return coll
+        with self._lock:
+            coll = self._collections.get(name)
+            if coll is None:
+                coll = self._open(name)
+                self._collections[name] = coll
+            return coll
 
-def upsert_chunks(collection, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[dict], embeddings: Sequence[Sequence[float]]):
+    def invalidate(self, name: str) -> None:
+        with self._lock:
+            coll = self._collections.pop(name, None)
+        if coll is not None and self._client is None:
+            coll.close()
+
+    def call(self, name: str, fn: Callable):
+        """Run ``fn(collection)``; if the cached handle went stale (collection deleted elsewhere), retry once."""
+        try:
+            return fn(self.get(name))
+        except Exception:
+            self.invalidate(name)
+            return fn(self.get(name))
+
+    def _list(self) -> List[str]:
+        if self._client is not None:
+            return [c.name if hasattr(c, "name") else str(c) for c in self._client.list_collections()]
+        root = self.db_path / MATRIX_DIR
+        if not root.exists():
+            return []
+        return sorted(p.name for p in root.iterdir() if (p / "items.sqlite3").exists())
+
+    def names(self) -> List[str]:
+        with self._lock:
+            names = self._list()
+            # Bỏ handle của collection đã bị xoá từ tiến trình khác
+            for stale in set(self._collections) - set(names):
+                coll = self._collections.pop(stale)
+                if self._client is None:
+                    coll.close()
+        return names
+
+    def delete(self, name: str) -> None:
+        with self._lock:
+            coll = self._collections.pop(name, None)
+            if self._client is not None:
+                self._client.delete_collection(name=name)
+                self._index.drop(name)
+                return
+            if coll is not None:
+                coll.close()
+            shutil.rmtree(self.db_path / MATRIX_DIR / name, ignore_errors=True)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is None:
+                for coll in self._collections.values():
+                    coll.close()
+            self._collections.clear()
+            close = getattr(self._client, "close", None)
+            if close is not None:
+                close()
+            if self._index is not None:
+                self._index.close()
+
+
+def upsert_chunks(collection, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[dict], embeddings: np.ndarray):
+    # Truyền thẳng mảng float32 [n, dim]: Chroma và MatrixCollection đều nhận ndarray, không cần list float
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
     if hasattr(collection, "upsert"):
-        collection.upsert(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=list(embeddings))
+        collection.upsert(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=embeddings)
         return
     try:
-        collection.add(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=list(embeddings))
+        collection.add(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=embeddings)
         return
     except Exception:
         try:
             collection.delete(ids=list(ids))
         except Exception:
             pass
-        collection.add(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=list(embeddings))
-
-
-def query_chunks(collection, query_embedding: Sequence[float], top_k: int) -> List[Tuple[str, dict, float]]:
-    result = collection.query(
-        query_embeddings=[list(query_embedding)],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"],
-    )
-    docs = result.get("documents", [[]])[0]
-    metas = result.get("metadatas", [[]])[0]
-    dists = result.get("distances", [[]])[0]
-    return list(zip(docs, metas, dists))
+        collection.add(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=embeddings)
+
+
+def update_metadatas(collection, ids: Sequence[str], metadatas: Sequence[dict], batch_size: int = 1000) -> None:
+    ids = list(ids)
+    metadatas = list(metadatas)
+    for start in range(0, len(ids), batch_size):
+        collection.update(ids=ids[start : start + batch_size], metadatas=metadatas[start : start + batch_size])
+
+
+def delete_chunks(collection, ids: Sequence[str], batch_size: int = 1000) -> int:
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[start : start + batch_size])
+    return len(ids)
+
+
+def existing_ids(collection, ids: Sequence[str]) -> set:
+    if not ids:
+        return set()
+    try:
+        result = collection.get(ids=list(ids), include=[])
+    except Exception:
+        return set()
+    return set(result.get("ids", []) or [])
+
+
+# (id, document, metadata, distance)
+Record = Tuple[str, str, dict, float]
+
+
+def query_records_batch(
+    collection, query_embeddings, top_k: int, batch_size: int = 256, where: dict | None = None
+) -> List[List[Record]]:
+    """One vectorized search per ``batch_size`` queries; returns (id, document, metadata, distance) per query.
+
+    ``where`` (see ``where_filter``) restricts the search to matching chunks before ranking.
+    """
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    extra = {"where": where} if where else {}
+    out: List[List[Record]] = []
+    for start in range(0, len(queries), batch_size):
+        result = collection.query(
+            query_embeddings=queries[start : start + batch_size],
+            n_results=top_k,
+            include=["documents", "metadatas", "distances"],
+            **extra,
+        )
+        for ids, docs, metas, dists in zip(
+            result.get("ids", []), result.get("documents", []), result.get("metadatas", []), result.get("distances", [])
+        ):
+            out.append(list(zip(ids, docs, metas, dists)))
+    return out
+
+
+def query_chunks_batch(
+    collection, query_embeddings, top_k: int, batch_size: int = 256, where: dict | None = None
+) -> List[List[Tuple[str, dict, float]]]:
+    """One vectorized search per ``batch_size`` queries; returns (document, metadata, distance) hits per query."""
+    return [
+        [(doc, meta, dist) for _, doc, meta, dist in records]
+        for records in query_records_batch(collection, query_embeddings, top_k, batch_size, where=where)
+    ]
+
+
+def query_chunks(
+    collection, query_embedding: Sequence[float], top_k: int, where: dict | None = None
+) -> List[Tuple[str, dict, float]]:
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+    return query_chunks_batch(collection, query, top_k, where=where)[0]
+
+
+def filter_ids(collection, where: dict) -> List[str]:
+    """Ids of the chunks matching ``where`` (no documents or vectors are read)."""
+    return list(collection.get(where=where, include=[]).get("ids", []) or [])
+
+
+def get_chunks(collection, ids: Sequence[str], query_embedding=None) -> List[Record]:
+    """Stored chunks for ``ids`` in the given order (missing ids dropped); distance is squared L2
+    to ``query_embedding`` like the stores report it, or None without one."""
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+    include = ["documents", "metadatas"] + (["embeddings"] if query_embedding is not None else [])
+    result = collection.get(ids=ids, include=include)
+    found = {doc_id: i for i, doc_id in enumerate(result.get("ids", []))}
+    dists = None
+    if query_embedding is not None and found:
+        emb = np.asarray(result["embeddings"], dtype=np.float32)
+        dists = ((emb - np.asarray(query_embedding, dtype=np.float32)) ** 2).sum(axis=1)
+    return [
+        (doc_id, result["documents"][found[doc_id]], result["metadatas"][found[doc_id]], None if dists is None else float(dists[found[doc_id]]))
+        for doc_id in ids
+        if doc_id in found
+    ]